@@ -0,0 +1,64 @@
+# @file: benchmark.py
+# @brief: Requests per second of /insultme with and without the pre-rendered page.
+#
+# Run with `python benchmark.py` in this directory, or `python benchmark.py ../flask_js`
+# to benchmark the app in another directory.
+
+import http.client
+import logging
+import os
+import sys
+import threading
+import time
+
+from werkzeug.serving import make_server
+
+# Import app.py from the directory given on the command line (default: this one)
+app_dir = os.path.abspath(sys.argv[1] if len(sys.argv) > 1 else os.path.dirname(__file__))
+sys.path.insert(0, app_dir)
+os.chdir(app_dir)
+import app as insult_app  # noqa: E402
+
+REQUESTS = 5000
+
+
+def wsgi_requests_per_second(count=REQUESTS):
+    """Call the WSGI application directly, without any HTTP server."""
+    environ = {
+        "REQUEST_METHOD": "GET",
+        "PATH_INFO": "/insultme",
+        "SERVER_NAME": "localhost",
+        "SERVER_PORT": "80",
+        "wsgi.url_scheme": "http",
+        "wsgi.input": None,
+        "wsgi.errors": sys.stderr,
+    }
+    start = time.perf_counter()
+    for _ in range(count):
+        b"".join(insult_app.app(dict(environ), lambda status, headers: None))
+    return count / (time.perf_counter() - start)
+
+
+def server_requests_per_second(count=REQUESTS):
+    """Run the app under Werkzeug's WSGI server and send it requests over HTTP."""
+    logging.getLogger("werkzeug").setLevel(logging.ERROR)  # no access log lines
+    server = make_server("127.0.0.1", 0, insult_app.app, threaded=True)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    connection = http.client.HTTPConnection("127.0.0.1", server.server_port)
+    start = time.perf_counter()
+    for _ in range(count):
+        connection.request("GET", "/insultme")
+        connection.getresponse().read()
+    elapsed = time.perf_counter() - start
+    connection.close()
+    server.shutdown()
+    return count / elapsed
+
+
+if __name__ == '__main__':
+    print(f"/insultme requests per second ({app_dir})")
+    print(f"{'mode':<12} {'WSGI call':>10} {'HTTP server':>12}")
+    for mode in ["jinja", "prerendered"]:
+        insult_app.RENDER_MODE = mode
+        print(f"{mode:<12} {wsgi_requests_per_second():>10,.0f} {server_requests_per_second():>12,.0f}")
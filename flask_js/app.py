@@ -1,14 +1,27 @@
 # @file: app.py
 # @brief: This is a simple Flask application that generates random Shakespearean insults.
 
+import os
 import random
-from flask import Flask, render_template
+from flask import Flask, Response, render_template
+from markupsafe import escape
 
 import vocab
 
 # Instantiate the Flask application
 app = Flask(__name__)
 
+# How /insultme builds its page:
+#   "prerendered": index.html is rendered once at startup and each request only
+#                  glues the (escaped) insult between the two halves of the page
+#   "jinja":       index.html is rendered with Jinja on every request
+# The pre-rendered page is not reloaded when index.html changes, so use
+# RENDER_MODE=jinja while editing the template.
+RENDER_MODE = os.environ.get("RENDER_MODE", "prerendered")
+
+# Placeholder rendered where the insult goes, so we can split the page around it
+INSULT_SLOT = "@@INSULT@@"
+
 def generate_insult():
     """Generate a random Shakespearean insult.
     This function randomly selects words from three columns of a vocabulary
@@ -24,6 +37,18 @@ def generate_insult():
     insult += random.choice(vocab.column3) + "!"
     return insult
     
+def prerender(template_name):
+    """Render a template once with a placeholder in place of the insult.
+    
+    @return: The bytes of the page before and after the insult, as a (prefix, suffix) tuple
+    """
+    with app.test_request_context():
+        page = render_template(template_name, insult=INSULT_SLOT)
+    prefix, suffix = page.split(INSULT_SLOT)
+    return prefix.encode(), suffix.encode()
+
+INDEX_PREFIX, INDEX_SUFFIX = prerender("index.html")
+
 @app.route('/')
 def index():
     return "Have a nice day!"
@@ -36,6 +61,10 @@ def insulter():
     @return: Rendered HTML template index.html (in the templates/ directory)
     """
     some_insult = generate_insult()
+    if RENDER_MODE == "prerendered":
+        # Same page as render_template() below, without running Jinja
+        body = INDEX_PREFIX + escape(some_insult).encode() + INDEX_SUFFIX
+        return Response(body, mimetype="text/html")
     return render_template("index.html", insult=some_insult)
 
 if __name__ == '__main__':
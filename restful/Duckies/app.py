@@ -1,31 +1,189 @@
+import functools
 import os
-from typing import Any, Dict, List, Optional, Union
+from typing import Any, Callable, Dict, List, Optional, Set, Union
 
-from flask import Flask, Response, jsonify, render_template, request
-from pymongo import MongoClient
-from pymongo.collection import Collection
+from bson.errors import InvalidId
+from flask import Flask, Response, jsonify, make_response, render_template, request
+from pymongo import ASCENDING, IndexModel, MongoClient
 from pymongo.database import Database
 
+from bulk import array_items, insert_ducks, ndjson_items
+from cache import Cache, cache_from_env
+from clients import client_options, get_client, on_fork, pool_stats
+from events import ChangeStreamFeed, EventHub, change_streams_supported, sse_stream
+from schema import DUCK_SCHEMA, DUCK_VALIDATOR, json_schema
+from search import SEARCH_FIELD, normalize
+from serialization import BSONJSONProvider
+from stats import StatsCounters, format_stats
+from storage import DuckStore, DuplicateDuck, MemoryDuckStore, MongoDuckStore, duck_etag
+from streaming import ENCODERS, MIMETYPES
+
+# Page size of GET /ducks when ?limit= is not given, and the largest allowed
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+
+# Results of GET /ducks/search when ?limit= is not given, and the most allowed
+DEFAULT_SEARCH_LIMIT = 10
+MAX_SEARCH_LIMIT = 100
+
+
+def if_match_etags() -> Optional[Set[str]]:
+    """ETags listed in the If-Match header of the request (None: any will do)"""
+    if not request.if_match or request.if_match.star_tag:
+        return None
+    return request.if_match.as_set()
+
+
+def not_modified(etag: str) -> Response:
+    """304 Not Modified response: the client's copy (with this ETag) is up to date"""
+    response = Response(status=304)
+    response.set_etag(etag)
+    return response
+
 
 class DuckApp:
-    def __init__(self, test_mode: bool = False) -> None:
+    # Indexes of the duck collection, created at startup if they are missing.
+    # Every lookup by name (GET/PUT/DELETE /ducks/<name>, /find_duck) uses the
+    # first one, listing by type uses the second, already sorted by name, and
+    # /ducks/search scans the third, of the search keys (see search.py).
+    INDEXES = [
+        IndexModel([("name", ASCENDING)], name="name_unique", unique=True),
+        IndexModel([("type", ASCENDING), ("name", ASCENDING)], name="type_name"),
+        IndexModel([(SEARCH_FIELD, ASCENDING)], name="search"),
+    ]
+
+    def __init__(
+        self,
+        test_mode: bool = False,
+        cache: Optional[Cache] = None,
+        stats_counters: Optional[bool] = None,
+        store: Optional[DuckStore] = None,
+    ) -> None:
         self.app = Flask(__name__)
-        self.setup_database(test_mode)
+        # Encodes ObjectId, datetime and Decimal128 as they are (see serialization.py)
+        self.app.json = BSONJSONProvider(self.app)
+        # Cache of GET /ducks/<name> (by default, chosen by the DUCK_CACHE variables)
+        self.cache = cache or cache_from_env()
+        self._client: Optional[MongoClient] = None
+        self._store: Optional[DuckStore] = None
+        self._stats: Optional[StatsCounters] = None
+        self._change_feed: Optional[ChangeStreamFeed] = None
+        # Where the ducks are kept (by default, chosen by DUCK_STORE, see storage.py)
+        if store is None:
+            backend = os.environ.get("DUCK_STORE", "mongo")
+            if backend == "memory":
+                store = MemoryDuckStore()
+            elif backend != "mongo":
+                raise ValueError(f"Unknown DUCK_STORE backend '{backend}'")
+        if store is None:
+            self.setup_database(test_mode)
+        else:
+            self._store = store
+        self.store.ensure_indexes()
+        # Also have the store check every write against the schema (see schema.py)
+        if os.environ.get("DUCK_JSON_SCHEMA") == "1":
+            self.store.set_validator(json_schema(DUCK_SCHEMA))
+        # Per-type statistics kept up to date on writes (default: the
+        # DUCK_STATS_COUNTERS variable); without them, /stats aggregates.
+        # They live in MongoDB: the memory store always computes them.
+        if stats_counters is None:
+            stats_counters = os.environ.get("DUCK_STATS_COUNTERS") == "1"
+        if stats_counters and isinstance(self.store, MongoDuckStore):
+            self._stats = StatsCounters(self.store.counters, self.store.collection)
+            if not self.store.counters.find_one({"_id": {"$regex": "^type:"}}):
+                self._stats.rebuild()
+        # Live feed of the changes, for GET /ducks/events: from a change stream
+        # if the server has them, else from the writes of this app
+        self.events = EventHub()
+        if isinstance(self.store, MongoDuckStore) and change_streams_supported(
+            self.store.collection
+        ):
+            self._change_feed = ChangeStreamFeed(self.store.collection, self.events)
         self.setup_routes()
 
     def setup_database(self, test_mode: bool) -> None:
         """Set up database connection"""
         if test_mode:
             # Use test database for testing
-            self.client = MongoClient("localhost", 27017)
-            self.db = self.client.test_duckdb
-            self.collection = self.db.test_ducks
+            self.mongodb_uri = "mongodb://localhost:27017"
+            self.db_name = "test_duckdb"
+            self.collection_names = ("test_ducks", "test_counters")
         else:
             # Use production database (in docker compose)
-            mongodb_uri = os.environ.get("MONGODB_URI", "mongodb://localhost:27017")
-            self.client = MongoClient(mongodb_uri)
-            self.db = self.client.duckdb
-            self.collection = self.db.ducks
+            self.mongodb_uri = os.environ.get("MONGODB_URI", "mongodb://localhost:27017")
+            self.db_name = "duckdb"
+            self.collection_names = ("ducks", "counters")
+        self.connect()
+        # A worker forked from this process must not use its client
+        on_fork(self.disconnect)
+
+    def connect(self) -> None:
+        """Get the shared client of this process (see clients.py) and a store on its collections"""
+        self._client = get_client(self.mongodb_uri, **client_options())
+        db: Database = self._client[self.db_name]
+        store = MongoDuckStore(
+            db[self.collection_names[0]], db[self.collection_names[1]], self.INDEXES
+        )
+        self._store = store
+        if self._stats is not None:
+            self._stats.counters, self._stats.ducks = store.counters, store.collection
+        if self._change_feed is not None:
+            self._change_feed.collection = store.collection
+
+    def disconnect(self) -> None:
+        """Forget the client inherited from the parent process (called after a fork)
+
+        Nothing is opened here: the worker gets its own client when it first
+        uses the store (see connect()).
+        """
+        self._client = None
+        self._store = None
+
+    @property
+    def client(self) -> MongoClient:
+        """The MongoClient of this process"""
+        if self._client is None:
+            self.connect()
+        assert self._client is not None
+        return self._client
+
+    @property
+    def store(self) -> DuckStore:
+        """Where the ducks are kept (in a forked worker, connected on first use)"""
+        if self._store is None:
+            self.connect()
+        assert self._store is not None
+        return self._store
+
+    @property
+    def stats(self) -> Optional[StatsCounters]:
+        """Per-type statistics counters, if kept (on the collections of this process)"""
+        if self._stats is not None and self._store is None:
+            self.connect()
+        return self._stats
+
+    @property
+    def change_feed(self) -> Optional[ChangeStreamFeed]:
+        """The change stream feed, if any (on the collection of this process)"""
+        if self._change_feed is not None and self._store is None:
+            self.connect()
+        return self._change_feed
+
+    def load_duck(self, name: str) -> Optional[Dict[str, Any]]:
+        """Get a duck from the store"""
+        return self.store.get(name)
+
+    def publish(self, event: Dict[str, Any]) -> None:
+        """Send a change to the subscribers of /ducks/events (unless the change stream does)"""
+        if self.change_feed is None:
+            self.events.publish(event)
+
+    def record_insert(self, ducks: List[Dict[str, Any]]) -> None:
+        """Count and publish new ducks"""
+        if self.stats:
+            self.stats.record_insert(ducks)
+        for duck in ducks:
+            self.publish({"op": "insert", "_id": duck["_id"], "duck": duck})
 
     def setup_routes(self) -> None:
         """Set up Flask routes"""
@@ -34,62 +192,243 @@ class DuckApp:
         def home() -> str:
             return render_template("index.html")
 
+        def conditional(view: Callable[..., Any]) -> Callable[..., Response]:
+            """Tag a listing with the collection's ETag, and answer 304 if the client has it
+
+            The ETag is read before the ducks: if a write happens in between,
+            the response has new ducks with the old ETag, so the client just
+            fetches them again on its next request (never the other way around).
+            """
+
+            @functools.wraps(view)
+            def conditional_view(*args: Any, **kwargs: Any) -> Response:
+                etag = self.store.etag()
+                if request.if_none_match.contains_weak(etag):
+                    return not_modified(etag)
+                response = make_response(view(*args, **kwargs))
+                if response.status_code == 200:
+                    response.set_etag(etag)
+                return response
+
+            return conditional_view
+
         # ----------------------------------------------------------------------
         # New RESTful endpoints
         # ----------------------------------------------------------------------
         @self.app.route("/ducks", methods=["GET"])
+        @conditional
         def get_all_ducks() -> tuple[Response, int]:
-            """Get all ducks in JSON format"""
-            ducks = list(self.collection.find())
-            for duck in ducks:
-                duck["_id"] = str(duck["_id"])
-            return jsonify(ducks), 200
+            """Get all ducks in JSON format
+
+            With ?after=, ?limit= or ?fields=, return one page instead:
+            {"ducks": [...], "next": <cursor>}, where "next" is the value of
+            ?after= for the next page (null on the last page).
+            With ?stream=json or ?stream=ndjson, stream all the ducks instead.
+            With If-None-Match, answer 304 if no duck changed since.
+            """
+            if "stream" in request.args:
+                return stream_ducks(None)
+            if any(arg in request.args for arg in ("after", "limit", "fields")):
+                return get_ducks_page(None)
+            return jsonify(list(self.store.find())), 200
+
+        @self.app.route("/ducks/search", methods=["GET"])
+        def search_ducks() -> tuple[Response, int]:
+            """Find ducks as their name is typed: ?q= and ?limit=, best matches first
+
+            ?q= matches the names that have a word starting with it (or with
+            words that start with it, for several words), whatever the case,
+            see search.py.
+            """
+            query = normalize(request.args.get("q", ""))
+            if not query:
+                return jsonify({"error": "q must contain a letter or a digit"}), 400
+            limit = request.args.get("limit", str(DEFAULT_SEARCH_LIMIT))
+            if not limit.isdigit() or not 1 <= int(limit) <= MAX_SEARCH_LIMIT:
+                return jsonify({"error": f"limit must be between 1 and {MAX_SEARCH_LIMIT}"}), 400
+            return jsonify(self.store.search(query, int(limit))), 200
+
+        @self.app.route("/ducks/stats", methods=["GET"])
+        @conditional
+        def get_duck_stats() -> tuple[Response, int]:
+            """Number of ducks and total/average/min/max value, overall and per type"""
+            if self.stats:
+                groups = self.stats.groups()
+            else:
+                groups = self.store.stats_groups()
+            types = [{"type": group["_id"], **format_stats([group])} for group in groups]
+            return jsonify({**format_stats(groups), "types": types}), 200
+
+        @self.app.route("/ducks/type/<duck_type>/stats", methods=["GET"])
+        @conditional
+        def get_duck_type_stats(duck_type: str) -> tuple[Response, int]:
+            """Number of ducks of one type and their total/average/min/max value"""
+            if self.stats:
+                groups = self.stats.groups(duck_type)
+            else:
+                groups = self.store.stats_groups(duck_type)
+            return jsonify({"type": duck_type, **format_stats(groups)}), 200
+
+        @self.app.route("/metrics", methods=["GET"])
+        def metrics() -> tuple[Response, int]:
+            """Counters of the cache and of the MongoDB connection pools (if any)"""
+            return jsonify({"cache": self.cache.stats(), "mongodb": pool_stats()}), 200
+
+        @self.app.route("/ducks/events", methods=["GET"])
+        def duck_events() -> Response:
+            """Server-Sent Events with every change to the ducks, as deltas (see events.py)
+
+            A client that reconnects with the Last-Event-ID header (or
+            ?last_event_id=) first gets the changes it missed, or a reset
+            event if they are too old. Each client holds a worker thread for
+            as long as it stays connected: for many of them, use async_app.py.
+            """
+            last_event_id = request.headers.get("Last-Event-ID", request.args.get("last_event_id"))
+            subscription = self.events.subscribe(last_event_id)
+            if self.change_feed:
+                self.change_feed.start()
+            response = Response(
+                sse_stream(self.events, subscription, self.app.json.dumps),
+                mimetype="text/event-stream",
+            )
+            response.headers["Cache-Control"] = "no-cache"
+            # Tells nginx not to buffer the stream
+            response.headers["X-Accel-Buffering"] = "no"
+            return response
+
+        @self.app.route("/ducks/bulk", methods=["POST"])
+        def add_ducks_bulk() -> tuple[Response, int]:
+            """Add many ducks at once, from a JSON array or from NDJSON (one duck per line)
+
+            Each duck is checked like in /add_duck. Valid ducks are inserted
+            even if others are not; the response lists the ones that failed.
+            """
+            if request.mimetype == "application/x-ndjson":
+                items = ndjson_items(request.stream)
+            else:
+                ducks = request.get_json(silent=True)
+                if not isinstance(ducks, list):
+                    return jsonify({"error": "Expected a JSON array of ducks or NDJSON"}), 400
+                items = array_items(ducks)
+            # Only existing ducks are cached, so there is no need to invalidate
+            # the new names one by one like /add_duck does
+            report = insert_ducks(
+                self.store.write_batch, items, DUCK_VALIDATOR.validate, self.record_insert
+            )
+            if report.inserted:
+                self.store.record_change()
+            return jsonify(report.to_json()), 200
 
         @self.app.route("/ducks/<name>", methods=["GET"])
         def get_duck(name: str) -> tuple[Response, int]:
-            """Get a specific duck by name"""
-            duck = self.collection.find_one({"name": name})
+            """Get a specific duck by name (through the cache)
+
+            With If-None-Match, answer 304 if the duck did not change since.
+            """
+            duck = self.cache.get_or_load(name, lambda: self.load_duck(name))
             if duck:
-                duck["_id"] = str(duck["_id"])
-                return jsonify(duck), 200
+                if request.if_none_match.contains_weak(duck_etag(duck)):
+                    return not_modified(duck_etag(duck)), 304
+                response = jsonify(duck)
+                response.set_etag(duck_etag(duck))
+                return response, 200
             return jsonify({"message": f"Duck '{name}' not found"}), 404
 
         @self.app.route("/ducks/<name>", methods=["PUT"])
         def update_duck(name: str) -> tuple[Response, int]:
-            """Update a duck's information"""
-            duck = self.collection.find_one({"name": name})
-            if not duck:
-                return jsonify({"message": f"Duck '{name}' not found"}), 404
+            """Update a duck's information
 
+            The update is a single atomic step (find_one_and_update in MongoDB),
+            which also increments the duck's version. With an If-Match header (the ETag of a GET),
+            the update only happens if nobody changed the duck since: otherwise
+            the answer is 412 Precondition Failed.
+            """
             data = request.get_json()
             if not data:
                 return jsonify({"error": "No data provided"}), 400
 
-            # Update only provided fields
-            update_data = {k: v for k, v in data.items() if k in ["type", "value"]}
+            # Update only the fields the schema lets clients change (see schema.py)
+            update_data = DUCK_VALIDATOR.updates(data)
             if not update_data:
                 return jsonify({"error": "No valid fields to update"}), 400
+            error = DUCK_VALIDATOR.validate(update_data, partial=True)
+            if error:
+                return jsonify({"error": error}), 400
+
+            etags = if_match_etags()
+            # Only updates if something actually changes
+            before = self.store.update(name, update_data, etags)
+            if before:
+                after = {**before, **update_data, "version": before.get("version", 0) + 1}
+                self.cache.invalidate(name)
+                self.store.record_change()
+                if self.stats:
+                    self.stats.record_update(before, after)
+                changes = {**update_data, "version": after["version"]}
+                self.publish({"op": "update", "_id": before["_id"], "changes": changes})
+                response = jsonify({"message": f"Duck '{name}' updated successfully"})
+                response.set_etag(duck_etag(after))
+                return response, 200
 
-            result = self.collection.update_one({"name": name}, {"$set": update_data})
-            if result.modified_count > 0:
-                return jsonify({"message": f"Duck '{name}' updated successfully"}), 200
-            return jsonify({"message": "No changes made"}), 200
+            # Not updated: find out why (a second round trip, but only on this rare path)
+            duck = self.store.get(name, ["version"])
+            if not duck:
+                return jsonify({"message": f"Duck '{name}' not found"}), 404
+            if etags is not None and duck_etag(duck) not in etags:
+                return jsonify({"message": f"Duck '{name}' was changed by someone else"}), 412
+            response = jsonify({"message": "No changes made"})
+            response.set_etag(duck_etag(duck))
+            return response, 200
 
         @self.app.route("/ducks/<name>", methods=["DELETE"])
         def delete_duck(name: str) -> tuple[Response, int]:
-            """Delete a duck"""
-            result = self.collection.delete_one({"name": name})
-            if result.deleted_count > 0:
+            """Delete a duck (only if it still matches the If-Match header, if any)"""
+            etags = if_match_etags()
+            duck = self.store.delete(name, etags)
+            if duck:
+                self.cache.invalidate(name)
+                self.store.record_change()
+                if self.stats:
+                    self.stats.record_delete(duck)
+                self.publish({"op": "delete", "_id": duck["_id"]})
                 return jsonify({"message": f"Duck '{name}' deleted successfully"}), 200
+            if etags is not None and self.store.get(name, ["_id"]):
+                return jsonify({"message": f"Duck '{name}' was changed by someone else"}), 412
             return jsonify({"message": f"Duck '{name}' not found"}), 404
 
         @self.app.route("/ducks/type/<duck_type>", methods=["GET"])
+        @conditional
         def get_ducks_by_type(duck_type: str) -> tuple[Response, int]:
-            """Get all ducks of a specific type"""
-            ducks = list(self.collection.find({"type": duck_type}))
-            for duck in ducks:
-                duck["_id"] = str(duck["_id"])
-            return jsonify(ducks), 200
+            """Get all ducks of a specific type (?stream= as for /ducks)"""
+            if "stream" in request.args:
+                return stream_ducks(duck_type)
+            return jsonify(list(self.store.find(duck_type))), 200
+
+        def get_ducks_page(duck_type: Optional[str]) -> tuple[Response, int]:
+            """Get the page of ducks described by the ?after=, ?limit= and ?fields= arguments"""
+            limit = request.args.get("limit", str(DEFAULT_PAGE_SIZE))
+            if not limit.isdigit() or not 1 <= int(limit) <= MAX_PAGE_SIZE:
+                return jsonify({"error": f"limit must be between 1 and {MAX_PAGE_SIZE}"}), 400
+            fields = None
+            if "fields" in request.args:
+                fields = [field.strip() for field in request.args["fields"].split(",")]
+                if not all(fields) or any(field.startswith("$") for field in fields):
+                    return jsonify({"error": "Invalid fields"}), 400
+            try:
+                page = self.store.find_page(
+                    duck_type, request.args.get("after"), int(limit), fields
+                )
+            except InvalidId:
+                return jsonify({"error": "Invalid cursor"}), 400
+            return jsonify(page), 200
+
+        def stream_ducks(duck_type: Optional[str]) -> Union[Response, tuple[Response, int]]:
+            """Stream the ducks (of `duck_type`, if given) as a JSON array or as NDJSON"""
+            stream_format = request.args["stream"]
+            if stream_format not in ENCODERS:
+                return jsonify({"error": "stream must be 'json' or 'ndjson'"}), 400
+            chunks = ENCODERS[stream_format](self.store.find(duck_type), self.app.json.dumps)
+            return Response(chunks, mimetype=MIMETYPES[stream_format])
 
         # ----------------------------------------------------------------------
         # Old end points -- not RESTful
@@ -98,31 +437,25 @@ class DuckApp:
         def add_duck() -> tuple[Response, int]:
             # Get duck data from request
             duck = request.get_json()
-            print(duck)
-
-            # Validate required fields
-            required_fields = ["name", "type", "value"]
-            missing_fields = [
-                field
-                for field in required_fields
-                if field not in duck or not duck[field]
-            ]
-
-            if missing_fields:
-                return (
-                    jsonify(
-                        {
-                            "error": f"Missing required fields: {', '.join(missing_fields)}"
-                        }
-                    ),
-                    400,
-                )
+
+            # Validate the fields against the schema (see schema.py)
+            error = DUCK_VALIDATOR.validate(duck)
+            if error:
+                return jsonify({"error": error}), 400
 
             # Remove test_marker from the duck data before storing
             duck.pop("test_marker", None)
+            # Every write increments the version (see update_duck)
+            duck["version"] = 1
 
-            # Add duck to database
-            self.collection.insert_one(duck)
+            # Add duck to database (names are unique, see INDEXES)
+            try:
+                self.store.insert(duck)
+            except DuplicateDuck:
+                return jsonify({"error": f"Duck '{duck['name']}' already exists"}), 409
+            self.cache.invalidate(duck["name"])
+            self.store.record_change()
+            self.record_insert([duck])
 
             # Return success message
             return jsonify({"message": "Duck added successfully"}), 201
@@ -133,11 +466,9 @@ class DuckApp:
             name = request.args.get("name")
 
             # Search for duck in database
-            duck = self.collection.find_one({"name": name})
+            duck = self.store.get(name)
 
             if duck:
-                # Convert MongoDB document to JSON
-                duck["_id"] = str(duck["_id"])
                 return jsonify(duck), 200
 
             return jsonify({"message": "Duck not found"}), 404
@@ -145,10 +476,7 @@ class DuckApp:
         @self.app.route("/all_ducks", methods=["GET"])
         def all_ducks() -> str:
             # Get all ducks from database
-            ducks = list(self.collection.find())
-            # Convert ObjectId to string for each duck
-            for duck in ducks:
-                duck["_id"] = str(duck["_id"])
+            ducks = list(self.store.find())
             return render_template("all_ducks.html", ducks=ducks)
 
     def run(self, host: str = "0.0.0.0", port: int = 6006, debug: bool = True) -> None:
@@ -0,0 +1,356 @@
+"""The duck app (app.py) on asyncio: the same routes and responses, served by
+Quart with pymongo's async API (AsyncMongoClient).
+
+In app.py, each request holds a worker thread for as long as it waits for
+MongoDB, so the number of threads caps the number of requests in flight.
+Here a request that waits for MongoDB only holds a coroutine, and one
+process can keep thousands of requests in flight.
+
+Run it with an ASGI server, e.g.:
+    hypercorn "async_app:create_app()" --bind 0.0.0.0:6006
+
+Differences with app.py: the statistics are always aggregated (there are no
+DUCK_STATS_COUNTERS), and a DUCK_CACHE=redis cache blocks the event loop
+while it talks to Redis. A subscriber of GET /ducks/events only holds a
+coroutine here, where it holds a worker thread in app.py.
+"""
+
+import functools
+import os
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Set, Union
+
+from bson.errors import InvalidId
+from pymongo import AsyncMongoClient
+from quart import Quart, Response, jsonify, make_response, render_template, request
+
+from app import DEFAULT_PAGE_SIZE, DEFAULT_SEARCH_LIMIT, MAX_PAGE_SIZE, MAX_SEARCH_LIMIT, DuckApp
+from bulk import array_items, insert_ducks_async, ndjson_items_async
+from cache import Cache, cache_from_env
+from clients import PoolMetrics, client_options
+from events import (
+    AsyncChangeStreamFeed,
+    AsyncSubscription,
+    EventHub,
+    async_sse_stream,
+    change_streams_supported_async,
+)
+from schema import DUCK_SCHEMA, DUCK_VALIDATOR, json_schema
+from search import normalize
+from serialization import BSONJSONProvider
+from stats import format_stats
+from storage import AsyncMongoDuckStore, DuplicateDuck, duck_etag
+from streaming import ASYNC_ENCODERS, MIMETYPES
+
+ViewResult = Union[Response, tuple[Response, int]]
+
+
+def if_match_etags() -> Optional[Set[str]]:
+    """ETags listed in the If-Match header of the request (None: any will do)"""
+    if not request.if_match or request.if_match.star_tag:
+        return None
+    return request.if_match.as_set()
+
+
+def not_modified(etag: str) -> Response:
+    """304 Not Modified response: the client's copy (with this ETag) is up to date"""
+    response = Response("", status=304)
+    response.set_etag(etag)
+    return response
+
+
+class AsyncDuckApp:
+    def __init__(self, test_mode: bool = False, cache: Optional[Cache] = None) -> None:
+        self.app = Quart(__name__)
+        # Encodes ObjectId, datetime and Decimal128 as they are (see serialization.py)
+        self.app.json = BSONJSONProvider(self.app)
+        # Cache of GET /ducks/<name> (by default, chosen by the DUCK_CACHE variables)
+        self.cache = cache or cache_from_env()
+        # Live feed of the changes, for GET /ducks/events (see DuckApp)
+        self.events = EventHub()
+        self.change_feed: Optional[AsyncChangeStreamFeed] = None
+        self.setup_database(test_mode)
+        self.app.before_serving(self.prepare_store)
+        self.setup_routes()
+
+    def setup_database(self, test_mode: bool) -> None:
+        """Set up database connection (the client connects on its first request)"""
+        # The same pool size, compression and timeouts as DuckApp (see clients.py)
+        self.pool_metrics = PoolMetrics()
+        options = {**client_options(), "event_listeners": [self.pool_metrics]}
+        if test_mode:
+            # Use test database for testing
+            self.client: AsyncMongoClient = AsyncMongoClient("localhost", 27017, **options)
+            db = self.client.test_duckdb
+            collections = (db.test_ducks, db.test_counters)
+        else:
+            mongodb_uri = os.environ.get("MONGODB_URI", "mongodb://localhost:27017")
+            self.client = AsyncMongoClient(mongodb_uri, **options)
+            db = self.client.duckdb
+            collections = (db.ducks, db.counters)
+        # The same queries as DuckApp's MongoDuckStore (see storage.py)
+        self.store = AsyncMongoDuckStore(*collections, DuckApp.INDEXES)
+
+    async def prepare_store(self) -> None:
+        """Create the indexes, the validator and the change feed, as DuckApp does
+
+        Run before the app starts serving.
+        """
+        await self.store.ensure_indexes()
+        if os.environ.get("DUCK_JSON_SCHEMA") == "1":
+            await self.store.set_validator(json_schema(DUCK_SCHEMA))
+        if await change_streams_supported_async(self.store.collection):
+            self.change_feed = AsyncChangeStreamFeed(self.store.collection, self.events)
+
+    def publish(self, event: Dict[str, Any]) -> None:
+        """Send a change to the subscribers of /ducks/events (unless the change stream does)"""
+        if self.change_feed is None:
+            self.events.publish(event)
+
+    def publish_inserts(self, ducks: List[Dict[str, Any]]) -> None:
+        """Publish new ducks"""
+        for duck in ducks:
+            self.publish({"op": "insert", "_id": duck["_id"], "duck": duck})
+
+    def setup_routes(self) -> None:
+        """Set up Quart routes (the same as DuckApp.setup_routes())"""
+
+        @self.app.route("/")
+        async def home() -> str:
+            return await render_template("index.html")
+
+        def conditional(view: Callable[..., Awaitable[Any]]) -> Callable[..., Awaitable[Response]]:
+            """Tag a listing with the collection's ETag, and answer 304 if the client has it"""
+
+            @functools.wraps(view)
+            async def conditional_view(*args: Any, **kwargs: Any) -> Response:
+                etag = await self.store.etag()
+                if request.if_none_match.contains_weak(etag):
+                    return not_modified(etag)
+                response = await make_response(await view(*args, **kwargs))
+                if response.status_code == 200:
+                    response.set_etag(etag)
+                return response
+
+            return conditional_view
+
+        # ----------------------------------------------------------------------
+        # New RESTful endpoints
+        # ----------------------------------------------------------------------
+        @self.app.route("/ducks", methods=["GET"])
+        @conditional
+        async def get_all_ducks() -> ViewResult:
+            """Get all ducks in JSON format (with ?after=, ?limit=, ?fields= and ?stream=)"""
+            if "stream" in request.args:
+                return stream_ducks(None)
+            if any(arg in request.args for arg in ("after", "limit", "fields")):
+                return await get_ducks_page(None)
+            return jsonify(await self.store.find().to_list()), 200
+
+        @self.app.route("/ducks/search", methods=["GET"])
+        async def search_ducks() -> ViewResult:
+            """Find ducks as their name is typed (see DuckApp's search_ducks())"""
+            query = normalize(request.args.get("q", ""))
+            if not query:
+                return jsonify({"error": "q must contain a letter or a digit"}), 400
+            limit = request.args.get("limit", str(DEFAULT_SEARCH_LIMIT))
+            if not limit.isdigit() or not 1 <= int(limit) <= MAX_SEARCH_LIMIT:
+                return jsonify({"error": f"limit must be between 1 and {MAX_SEARCH_LIMIT}"}), 400
+            return jsonify(await self.store.search(query, int(limit))), 200
+
+        @self.app.route("/ducks/stats", methods=["GET"])
+        @conditional
+        async def get_duck_stats() -> ViewResult:
+            """Number of ducks and total/average/min/max value, overall and per type"""
+            groups = await self.store.stats_groups()
+            types = [{"type": group["_id"], **format_stats([group])} for group in groups]
+            return jsonify({**format_stats(groups), "types": types}), 200
+
+        @self.app.route("/ducks/type/<duck_type>/stats", methods=["GET"])
+        @conditional
+        async def get_duck_type_stats(duck_type: str) -> ViewResult:
+            """Number of ducks of one type and their total/average/min/max value"""
+            groups = await self.store.stats_groups(duck_type)
+            return jsonify({"type": duck_type, **format_stats(groups)}), 200
+
+        @self.app.route("/metrics", methods=["GET"])
+        async def metrics() -> ViewResult:
+            """Counters of the cache and of the MongoDB connection pool"""
+            body = {"cache": self.cache.stats(), "mongodb": [self.pool_metrics.stats()]}
+            return jsonify(body), 200
+
+        @self.app.route("/ducks/events", methods=["GET"])
+        async def duck_events() -> Response:
+            """Server-Sent Events with every change to the ducks (see DuckApp's duck_events())"""
+            last_event_id = request.headers.get("Last-Event-ID", request.args.get("last_event_id"))
+            subscription = AsyncSubscription()
+            self.events.subscribe(last_event_id, subscription)
+            if self.change_feed:
+                self.change_feed.start()
+            stream = async_sse_stream(self.events, subscription, self.app.json.dumps)
+            response = Response(stream, mimetype="text/event-stream")
+            response.headers["Cache-Control"] = "no-cache"
+            # Tells nginx not to buffer the stream
+            response.headers["X-Accel-Buffering"] = "no"
+            # No time limit: the stream lasts as long as the client stays
+            response.timeout = None
+            return response
+
+        @self.app.route("/ducks/bulk", methods=["POST"])
+        async def add_ducks_bulk() -> ViewResult:
+            """Add many ducks at once, from a JSON array or from NDJSON (one duck per line)"""
+            if request.mimetype == "application/x-ndjson":
+                items: Any = ndjson_items_async(request.body)
+            else:
+                ducks = await request.get_json(silent=True)
+                if not isinstance(ducks, list):
+                    return jsonify({"error": "Expected a JSON array of ducks or NDJSON"}), 400
+                items = array_items(ducks)
+            report = await insert_ducks_async(
+                self.store.write_batch, items, DUCK_VALIDATOR.validate, self.publish_inserts
+            )
+            if report.inserted:
+                await self.store.record_change()
+            return jsonify(report.to_json()), 200
+
+        @self.app.route("/ducks/<name>", methods=["GET"])
+        async def get_duck(name: str) -> ViewResult:
+            """Get a specific duck by name (through the cache)"""
+            duck = await self.cache.get_or_load_async(name, lambda: self.store.get(name))
+            if duck:
+                if request.if_none_match.contains_weak(duck_etag(duck)):
+                    return not_modified(duck_etag(duck)), 304
+                response = jsonify(duck)
+                response.set_etag(duck_etag(duck))
+                return response, 200
+            return jsonify({"message": f"Duck '{name}' not found"}), 404
+
+        @self.app.route("/ducks/<name>", methods=["PUT"])
+        async def update_duck(name: str) -> ViewResult:
+            """Update a duck's information (see DuckApp's update_duck())"""
+            data = await request.get_json()
+            if not data:
+                return jsonify({"error": "No data provided"}), 400
+
+            # Update only the fields the schema lets clients change (see schema.py)
+            update_data = DUCK_VALIDATOR.updates(data)
+            if not update_data:
+                return jsonify({"error": "No valid fields to update"}), 400
+            error = DUCK_VALIDATOR.validate(update_data, partial=True)
+            if error:
+                return jsonify({"error": error}), 400
+
+            etags = if_match_etags()
+            # Only updates if something actually changes
+            before = await self.store.update(name, update_data, etags)
+            if before:
+                after = {**before, **update_data, "version": before.get("version", 0) + 1}
+                self.cache.invalidate(name)
+                await self.store.record_change()
+                changes = {**update_data, "version": after["version"]}
+                self.publish({"op": "update", "_id": before["_id"], "changes": changes})
+                response = jsonify({"message": f"Duck '{name}' updated successfully"})
+                response.set_etag(duck_etag(after))
+                return response, 200
+
+            # Not updated: find out why (a second round trip, but only on this rare path)
+            duck = await self.store.get(name, ["version"])
+            if not duck:
+                return jsonify({"message": f"Duck '{name}' not found"}), 404
+            if etags is not None and duck_etag(duck) not in etags:
+                return jsonify({"message": f"Duck '{name}' was changed by someone else"}), 412
+            response = jsonify({"message": "No changes made"})
+            response.set_etag(duck_etag(duck))
+            return response, 200
+
+        @self.app.route("/ducks/<name>", methods=["DELETE"])
+        async def delete_duck(name: str) -> ViewResult:
+            """Delete a duck (only if it still matches the If-Match header, if any)"""
+            etags = if_match_etags()
+            duck = await self.store.delete(name, etags)
+            if duck:
+                self.cache.invalidate(name)
+                await self.store.record_change()
+                self.publish({"op": "delete", "_id": duck["_id"]})
+                return jsonify({"message": f"Duck '{name}' deleted successfully"}), 200
+            if etags is not None and await self.store.get(name, ["_id"]):
+                return jsonify({"message": f"Duck '{name}' was changed by someone else"}), 412
+            return jsonify({"message": f"Duck '{name}' not found"}), 404
+
+        @self.app.route("/ducks/type/<duck_type>", methods=["GET"])
+        @conditional
+        async def get_ducks_by_type(duck_type: str) -> ViewResult:
+            """Get all ducks of a specific type (?stream= as for /ducks)"""
+            if "stream" in request.args:
+                return stream_ducks(duck_type)
+            return jsonify(await self.store.find(duck_type).to_list()), 200
+
+        async def get_ducks_page(duck_type: Optional[str]) -> ViewResult:
+            """Get the page of ducks described by the ?after=, ?limit= and ?fields= arguments"""
+            limit = request.args.get("limit", str(DEFAULT_PAGE_SIZE))
+            if not limit.isdigit() or not 1 <= int(limit) <= MAX_PAGE_SIZE:
+                return jsonify({"error": f"limit must be between 1 and {MAX_PAGE_SIZE}"}), 400
+            fields = None
+            if "fields" in request.args:
+                fields = [field.strip() for field in request.args["fields"].split(",")]
+                if not all(fields) or any(field.startswith("$") for field in fields):
+                    return jsonify({"error": "Invalid fields"}), 400
+            try:
+                page = await self.store.find_page(
+                    duck_type, request.args.get("after"), int(limit), fields
+                )
+            except InvalidId:
+                return jsonify({"error": "Invalid cursor"}), 400
+            return jsonify(page), 200
+
+        def stream_ducks(duck_type: Optional[str]) -> ViewResult:
+            """Stream the ducks (of `duck_type`, if given) as a JSON array or as NDJSON"""
+            stream_format = request.args["stream"]
+            if stream_format not in ASYNC_ENCODERS:
+                return jsonify({"error": "stream must be 'json' or 'ndjson'"}), 400
+            chunks = ASYNC_ENCODERS[stream_format](self.store.find(duck_type), self.app.json.dumps)
+            return Response(chunks, mimetype=MIMETYPES[stream_format])
+
+        # ----------------------------------------------------------------------
+        # Old end points -- not RESTful
+        # ----------------------------------------------------------------------
+        @self.app.route("/add_duck", methods=["POST"])
+        async def add_duck() -> ViewResult:
+            duck = await request.get_json()
+            error = DUCK_VALIDATOR.validate(duck)
+            if error:
+                return jsonify({"error": error}), 400
+            duck.pop("test_marker", None)
+            duck["version"] = 1
+            try:
+                await self.store.insert(duck)
+            except DuplicateDuck:
+                return jsonify({"error": f"Duck '{duck['name']}' already exists"}), 409
+            self.cache.invalidate(duck["name"])
+            await self.store.record_change()
+            self.publish_inserts([duck])
+            return jsonify({"message": "Duck added successfully"}), 201
+
+        @self.app.route("/find_duck", methods=["GET"])
+        async def find_duck() -> ViewResult:
+            duck = await self.store.get(request.args.get("name"))
+            if duck:
+                return jsonify(duck), 200
+            return jsonify({"message": "Duck not found"}), 404
+
+        @self.app.route("/all_ducks", methods=["GET"])
+        async def all_ducks() -> str:
+            ducks = await self.store.find().to_list()
+            return await render_template("all_ducks.html", ducks=ducks)
+
+    def run(self, host: str = "0.0.0.0", port: int = 6006, debug: bool = True) -> None:
+        """Run the app on Quart's development server"""
+        self.app.run(host=host, port=port, debug=debug)
+
+
+def create_app() -> Quart:
+    """The ASGI app, for servers: hypercorn "async_app:create_app()" """
+    return AsyncDuckApp().app
+
+
+if __name__ == "__main__":
+    AsyncDuckApp().run()
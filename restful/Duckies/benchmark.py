@@ -0,0 +1,291 @@
+"""Benchmarks for the duck REST API.
+
+Run with `python benchmark.py` from this directory. It uses the test database
+of a local mongod (see Mongodb.md). Without a mongod, `python benchmark.py
+--mongomock` runs against mongomock (`pip install mongomock`), an in-process
+stand-in. Its timings mean little, and it copies the whole result when a
+query starts, so only a real mongod shows the flat memory of streaming.
+`python benchmark.py --memory` uses the in-memory store (see storage.py),
+which measures the app itself, without any database.
+"""
+
+import json
+import os
+import random
+import statistics
+import sys
+import threading
+import time
+import timeit
+import tracemalloc
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import pymongo
+
+if "--memory" in sys.argv:
+    os.environ["DUCK_STORE"] = "memory"
+elif "--mongomock" in sys.argv:
+    import mongomock
+
+    _client = mongomock.MongoClient()
+    # mongomock checks unique indexes by scanning, so it slows down as the collection grows
+    pymongo.MongoClient = lambda *args, **kwargs: _client  # type: ignore
+
+from app import DuckApp  # noqa: E402
+from bson import ObjectId  # noqa: E402
+from flask.json.provider import DefaultJSONProvider  # noqa: E402
+
+from bulk import BulkReport  # noqa: E402
+from cache import LRUCache, MemoryStore, NoCache, SharedCache  # noqa: E402
+from schema import DUCK_SCHEMA, DUCK_VALIDATOR, TYPES  # noqa: E402
+from serialization import BSONJSONProvider  # noqa: E402
+
+# Collection sizes to measure, and number of ducks added by bench_bulk()
+SIZES = [1000, 10000, 50000]
+BULK_COUNT = 1000 if "--mongomock" in sys.argv else 100000
+
+# Ducks searched by bench_search()
+SEARCH_SIZE = 10000 if "--mongomock" in sys.argv else 1000000
+
+
+def fill(duck_app: DuckApp, size: int) -> None:
+    """Replace the test collection with `size` ducks"""
+    duck_app.store.clear()
+    ducks = [{"name": f"duck_{i}", "type": f"type_{i % 10}", "value": i} for i in range(size)]
+    for start in range(0, size, 10000):
+        duck_app.store.write_batch(list(enumerate(ducks[start:start + 10000])), BulkReport())
+
+
+def measure(request: Callable[[], Tuple[float, int]]) -> Tuple[float, float, int]:
+    """Run a request; return (time to first byte, total time, peak memory)"""
+    tracemalloc.start()
+    start = time.perf_counter()
+    first_byte, size = request()
+    elapsed = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return first_byte - start, elapsed, peak
+
+
+def bench_streaming() -> None:
+    """GET /ducks with jsonify vs. ?stream=json and ?stream=ndjson"""
+    duck_app = DuckApp(test_mode=True)
+    client = duck_app.app.test_client()
+
+    def get(url: str) -> Callable[[], Tuple[float, int]]:
+        def request() -> Tuple[float, int]:
+            response = client.get(url, buffered=False)
+            chunks = iter(response.response)
+            size = len(next(chunks, b""))
+            first_byte = time.perf_counter()
+            size += sum(len(chunk) for chunk in chunks)
+            response.close()
+            return first_byte, size
+
+        return request
+
+    print("GET /ducks: time to first byte, total time, peak memory")
+    print(f"{'ducks':>8} {'mode':<14} {'first byte':>11} {'total':>9} {'peak memory':>12}")
+    for size in SIZES:
+        fill(duck_app, size)
+        for mode, url in [("jsonify", "/ducks"), ("stream=json", "/ducks?stream=json"),
+                          ("stream=ndjson", "/ducks?stream=ndjson")]:
+            first_byte, elapsed, peak = measure(get(url))
+            print(f"{size:>8} {mode:<14} {first_byte * 1000:>9.1f}ms {elapsed * 1000:>7.0f}ms "
+                  f"{peak / 2**20:>10.1f}MB")
+    duck_app.store.clear()
+
+
+def bench_bulk(count: int = 20000) -> None:
+    """Add `count` ducks one POST /add_duck at a time vs. one POST /ducks/bulk"""
+    duck_app = DuckApp(test_mode=True)
+    client = duck_app.app.test_client()
+    ducks = [{"name": f"duck_{i}", "type": f"type_{i % 10}", "value": i + 1} for i in range(count)]
+    print(f"Adding {count:,} ducks (ducks/s)")
+
+    duck_app.store.clear()
+    start = time.perf_counter()
+    for duck in ducks:
+        client.post("/add_duck", json=duck)
+    print(f"{'/add_duck':<20} {count / (time.perf_counter() - start):>10,.0f}")
+
+    for mode in ["json", "ndjson"]:
+        duck_app.store.clear()
+        if mode == "json":
+            body, content_type = json.dumps(ducks), "application/json"
+        else:
+            body, content_type = "".join(json.dumps(duck) + "\n" for duck in ducks), "application/x-ndjson"
+        start = time.perf_counter()
+        report = client.post("/ducks/bulk", data=body, content_type=content_type).json
+        assert report["inserted"] == count, report
+        print(f"{'/ducks/bulk ' + mode:<20} {count / (time.perf_counter() - start):>10,.0f}")
+    duck_app.store.clear()
+
+
+def bench_put(requests_per_thread: int = 500) -> None:
+    """p50/p99 latency of PUT /ducks/<name> with several threads writing at once"""
+    duck_app = DuckApp(test_mode=True)
+    fill(duck_app, 1000)
+    print("PUT /ducks/<name> latency under concurrent writers")
+    print(f"{'threads':>8} {'p50':>9} {'p99':>9} {'PUT/s':>8}")
+    for threads in [1, 4, 16]:
+        latencies: List[float] = []
+
+        def writer(number: int) -> None:
+            client = duck_app.app.test_client()
+            for i in range(requests_per_thread):
+                # Writers collide on the same ducks now and then
+                name = f"duck_{(number * 7 + i) % 100}"
+                start = time.perf_counter()
+                client.put(f"/ducks/{name}", json={"value": number * requests_per_thread + i + 1})
+                latencies.append(time.perf_counter() - start)
+
+        workers = [threading.Thread(target=writer, args=(n,)) for n in range(threads)]
+        start = time.perf_counter()
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        elapsed = time.perf_counter() - start
+        cuts = statistics.quantiles(latencies, n=100)
+        print(f"{threads:>8} {cuts[49] * 1000:>7.2f}ms {cuts[98] * 1000:>7.2f}ms "
+              f"{len(latencies) / elapsed:>8,.0f}")
+    duck_app.store.clear()
+
+
+def bench_cache(lookups: int = 5000) -> None:
+    """GET /ducks/<name> from MongoDB vs. from each cache, for 100 popular ducks"""
+    print("GET /ducks/<name> (microseconds per request, and per lookup without Flask)")
+    print(f"{'cache':<12} {'request':>9} {'lookup':>9} {'hit rate':>9}")
+    for cache in [NoCache(), LRUCache(), SharedCache(MemoryStore())]:
+        duck_app = DuckApp(test_mode=True, cache=cache)
+        fill(duck_app, 10000)
+        client = duck_app.app.test_client()
+        names = [f"duck_{random.randrange(100)}" for _ in range(lookups)]
+        request = timeit.timeit(lambda: [client.get(f"/ducks/{name}") for name in names], number=1)
+        lookup = timeit.timeit(
+            lambda: [cache.get_or_load(name, lambda: duck_app.load_duck(name)) for name in names],
+            number=1,
+        )
+        hit_rate = cache.stats()["hit_rate"]
+        print(f"{type(cache).__name__:<12} {request / lookups * 1e6:>9.0f} "
+              f"{lookup / lookups * 1e6:>9.1f} {hit_rate or 0:>9.1%}")
+    duck_app.store.clear()
+
+
+def bench_json() -> None:
+    """Encode throughput of a listing: str(_id) loop + Flask's provider vs. BSONJSONProvider"""
+    duck_app = DuckApp(test_mode=True)
+    flask_json = DefaultJSONProvider(duck_app.app)
+    bson_json = BSONJSONProvider(duck_app.app)
+    print("Encoding a list of ducks (documents/s)")
+    print(f"{'ducks':>8} {'_id loop + Flask':>17} {'BSON, json':>11} {'BSON, orjson':>13}")
+    for size in [10000, 100000]:
+        ducks = [{"_id": ObjectId(), "name": f"duck_{i}", "type": "rubber", "value": i}
+                 for i in range(size)]
+
+        copies: List[dict] = []
+
+        def copy() -> None:
+            # Fresh documents for before() to change, made outside the timing
+            copies[:] = [dict(duck) for duck in ducks]
+
+        def before() -> str:
+            for duck in copies:
+                duck["_id"] = str(duck["_id"])
+            return flask_json.dumps(copies, separators=(",", ":"))
+
+        def after(use_orjson: bool) -> str:
+            bson_json.use_orjson = use_orjson
+            return bson_json.dumps(ducks, separators=(",", ":"))
+
+        rates = [size / min(timeit.repeat(encode, copy, number=1, repeat=3))
+                 for encode in [before, lambda: after(False), lambda: after(True)]]
+        print(f"{size:>8} {rates[0]:>17,.0f} {rates[1]:>11,.0f} {rates[2]:>13,.0f}")
+
+
+def bench_search(size: int = SEARCH_SIZE, searches: int = 2000) -> None:
+    """p50/p99 latency of GET /ducks/search, and of the store's search alone, at `size` ducks"""
+    duck_app = DuckApp(test_mode=True)
+    client = duck_app.app.test_client()
+    adjectives = ["big", "tiny", "happy", "grumpy", "shiny", "sleepy", "brave", "fancy"]
+    colors = ["yellow", "blue", "red", "green", "black", "white", "pink", "golden"]
+    kinds = ["duck", "duckling", "mallard", "teal", "eider", "goose", "swan", "decoy"]
+    duck_app.store.clear()
+    for start in range(0, size, 10000):
+        ducks = [
+            {"name": f"{random.choice(adjectives)} {random.choice(colors)} "
+                     f"{random.choice(kinds)} {i}", "type": "rubber", "value": 1}
+            for i in range(start, min(start + 10000, size))
+        ]
+        duck_app.store.write_batch(list(enumerate(ducks)), BulkReport())
+    queries = {
+        "1 letter": lambda: random.choice("bthgsfyrwpdmeq"),
+        "word prefix": lambda: random.choice(adjectives + colors + kinds)[:3],
+        "2 words": lambda: f"{random.choice(colors)} {random.choice(kinds)[:2]}",
+        "number": lambda: str(random.randrange(size)),
+    }
+    print(f"Searching {size:,} ducks, 10 results (GET /ducks/search, store.search())")
+    print(f"{'query':<12} {'p50':>9} {'p99':>9} {'store p50':>10} {'store p99':>10}")
+    for kind, query in queries.items():
+        requests, lookups = [], []
+        for _ in range(searches):
+            text = query()
+            start = time.perf_counter()
+            assert client.get("/ducks/search", query_string={"q": text}).status_code == 200
+            requests.append(time.perf_counter() - start)
+            start = time.perf_counter()
+            duck_app.store.search(text, 10)
+            lookups.append(time.perf_counter() - start)
+        cuts = [statistics.quantiles(latencies, n=100) for latencies in (requests, lookups)]
+        print(f"{kind:<12} {cuts[0][49] * 1000:>7.2f}ms {cuts[0][98] * 1000:>7.2f}ms "
+              f"{cuts[1][49] * 1000:>8.2f}ms {cuts[1][98] * 1000:>8.2f}ms")
+    duck_app.store.clear()
+
+
+def bench_validation(count: int = 100000) -> None:
+    """Validation cost per duck: the old required-fields scan vs. the schema, read or compiled"""
+    print("Validating a duck (nanoseconds per duck)")
+    print(f"{'validator':<26} {'valid':>7} {'invalid':>8}")
+    required = ["name", "type", "value"]
+
+    def required_only(duck: Dict[str, Any]) -> Optional[str]:
+        # What /add_duck did before schema.py: presence only, no types
+        missing = [field for field in required if field not in duck or not duck[field]]
+        return f"Missing required fields: {', '.join(missing)}" if missing else None
+
+    def schema_per_call(duck: Dict[str, Any]) -> Optional[str]:
+        # DUCK_SCHEMA read again for every duck, as without compiling it
+        missing = [field for field, rule in DUCK_SCHEMA.items()
+                   if rule.get("required") and duck.get(field) in (None, "")]
+        if missing:
+            return f"Missing required fields: {', '.join(missing)}"
+        errors = [f"{field} must be " + " or ".join(TYPES[name][2] for name in rule["types"])
+                  for field, rule in DUCK_SCHEMA.items() if field in duck
+                  and not any(TYPES[name][0](duck[field]) for name in rule["types"])]
+        return "; ".join(errors) if errors else None
+
+    valid = [{"name": f"duck_{i}", "type": "rubber", "value": i} for i in range(count)]
+    invalid = [{"name": f"duck_{i}", "type": "rubber", "value": "ten"} for i in range(count)]
+    for label, validate in [("required fields only", required_only),
+                            ("schema read per call", schema_per_call),
+                            ("compiled (DUCK_VALIDATOR)", DUCK_VALIDATOR.validate)]:
+        times = [min(timeit.repeat(lambda: [validate(duck) for duck in ducks], number=1, repeat=3))
+                 for ducks in (valid, invalid)]
+        print(f"{label:<26} {times[0] / count * 1e9:>7.0f} {times[1] / count * 1e9:>8.0f}")
+
+
+if __name__ == "__main__":
+    bench_streaming()
+    print()
+    bench_bulk()
+    print()
+    bench_put()
+    print()
+    bench_cache()
+    print()
+    bench_json()
+    print()
+    bench_search()
+    print()
+    bench_validation()
@@ -0,0 +1,233 @@
+"""Bulk insertion of ducks for POST /ducks/bulk.
+
+The ducks are validated and written BULK_BATCH_SIZE at a time, each batch
+with one unordered bulk_write: one round trip per batch instead of one per
+duck, and a bad duck only fails itself, not the rest of its batch.
+"""
+
+import json
+import time
+from itertools import islice
+from typing import (
+    IO,
+    Any,
+    AsyncIterable,
+    AsyncIterator,
+    Awaitable,
+    Callable,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Tuple,
+    Union,
+)
+
+from pymongo import InsertOne
+from pymongo.asynchronous.collection import AsyncCollection
+from pymongo.collection import Collection
+from pymongo.errors import BulkWriteError
+
+from search import indexed
+
+# Ducks validated and written per bulk_write
+BULK_BATCH_SIZE = 1000
+
+# Only the first errors are reported in detail, the rest are only counted
+MAX_REPORTED_ERRORS = 100
+
+# (position of the item in the request, the duck or None if it was not valid JSON)
+Item = Tuple[int, Any]
+
+
+def ndjson_items(stream: IO[bytes]) -> Iterator[Item]:
+    """Read ducks from a newline-delimited JSON stream, one line at a time"""
+    position = 0
+    for line in stream:
+        if not line.strip():
+            continue
+        try:
+            yield position, json.loads(line)
+        except ValueError:
+            yield position, None
+        position += 1
+
+
+def array_items(ducks: List[Any]) -> Iterator[Item]:
+    """Number the ducks of a JSON array"""
+    return enumerate(ducks)
+
+
+class BulkReport:
+    """What happened to the ducks of one bulk request"""
+
+    def __init__(self) -> None:
+        self.received = 0
+        self.inserted = 0
+        self.error_count = 0
+        self.errors: List[Dict[str, Any]] = []
+        self.start = time.perf_counter()
+
+    def error(self, position: int, message: str) -> None:
+        self.error_count += 1
+        if len(self.errors) < MAX_REPORTED_ERRORS:
+            self.errors.append({"index": position, "error": message})
+
+    def to_json(self) -> Dict[str, Any]:
+        elapsed = time.perf_counter() - self.start
+        return {
+            "received": self.received,
+            "inserted": self.inserted,
+            "error_count": self.error_count,
+            "errors": self.errors,
+            "seconds": round(elapsed, 3),
+            "docs_per_second": round(self.inserted / elapsed) if elapsed > 0 else None,
+        }
+
+
+def insert_ducks(
+    write: Callable[[List[Item], BulkReport], List[Dict[str, Any]]],
+    items: Iterable[Item],
+    validate: Callable[[Dict[str, Any]], Optional[str]],
+    on_insert: Optional[Callable[[List[Dict[str, Any]]], None]] = None,
+) -> BulkReport:
+    """Validate and insert ducks, BULK_BATCH_SIZE at a time
+
+    Args:
+        write: Inserts a batch of valid ducks and returns those inserted, see
+            DuckStore.write_batch()
+        items: (position, duck) pairs, see ndjson_items() and array_items()
+        validate: Returns the error message for an invalid duck, None for a valid one
+        on_insert: Called with the ducks of each batch that were inserted
+
+    Returns:
+        BulkReport: Counts, per-item errors and throughput
+    """
+    report = BulkReport()
+    items = iter(items)
+    while batch := list(islice(items, BULK_BATCH_SIZE)):
+        valid = check_batch(batch, validate, report)
+        if valid:
+            inserted = write(valid, report)
+            if on_insert and inserted:
+                on_insert(inserted)
+    return report
+
+
+async def insert_ducks_async(
+    write: Callable[[List[Item], BulkReport], Awaitable[List[Dict[str, Any]]]],
+    items: Union[Iterable[Item], AsyncIterable[Item]],
+    validate: Callable[[Dict[str, Any]], Optional[str]],
+    on_insert: Optional[Callable[[List[Dict[str, Any]]], None]] = None,
+) -> BulkReport:
+    """insert_ducks() for the async app (see async_app.py), where `write` is a coroutine function"""
+    report = BulkReport()
+    batches = _async_batches(items if isinstance(items, AsyncIterable) else _async_iter(items))
+    async for batch in batches:
+        valid = check_batch(batch, validate, report)
+        if valid:
+            inserted = await write(valid, report)
+            if on_insert and inserted:
+                on_insert(inserted)
+    return report
+
+
+async def ndjson_items_async(chunks: AsyncIterable[bytes]) -> AsyncIterator[Item]:
+    """ndjson_items() for a request body that arrives in chunks of any size"""
+    lines = _async_lines(chunks)
+    position = 0
+    async for line in lines:
+        if not line.strip():
+            continue
+        try:
+            yield position, json.loads(line)
+        except ValueError:
+            yield position, None
+        position += 1
+
+
+def check_batch(
+    batch: List[Item], validate: Callable[[Dict[str, Any]], Optional[str]], report: BulkReport
+) -> List[Item]:
+    """Return the valid ducks of a batch, ready to insert; report the others"""
+    report.received += len(batch)
+    valid: List[Item] = []
+    for position, duck in batch:
+        if not isinstance(duck, dict):
+            report.error(position, "Not a JSON object" if duck is not None else "Invalid JSON")
+        elif (message := validate(duck)) is not None:
+            report.error(position, message)
+        else:
+            duck.pop("test_marker", None)
+            duck["version"] = 1
+            valid.append((position, duck))
+    return valid
+
+
+def write_batch(
+    collection: Collection, batch: List[Item], report: BulkReport
+) -> List[Dict[str, Any]]:
+    """Insert a batch of valid ducks with one unordered bulk_write; return the inserted ones"""
+    try:
+        requests = [InsertOne(indexed(duck)) for _, duck in batch]
+        result = collection.bulk_write(requests, ordered=False)
+        report.inserted += result.inserted_count
+        return [duck for _, duck in batch]
+    except BulkWriteError as error:
+        return record_write_errors(error, batch, report)
+
+
+async def write_batch_async(
+    collection: AsyncCollection, batch: List[Item], report: BulkReport
+) -> List[Dict[str, Any]]:
+    """write_batch() on an async collection"""
+    try:
+        requests = [InsertOne(indexed(duck)) for _, duck in batch]
+        result = await collection.bulk_write(requests, ordered=False)
+        report.inserted += result.inserted_count
+        return [duck for _, duck in batch]
+    except BulkWriteError as error:
+        return record_write_errors(error, batch, report)
+
+
+def record_write_errors(
+    error: BulkWriteError, batch: List[Item], report: BulkReport
+) -> List[Dict[str, Any]]:
+    """Report the ducks of a batch that could not be inserted; return the inserted ones"""
+    report.inserted += error.details["nInserted"]
+    failed = set()
+    for write_error in error.details["writeErrors"]:
+        failed.add(write_error["index"])
+        position, duck = batch[write_error["index"]]
+        if write_error["code"] == 11000:
+            report.error(position, f"Duck '{duck['name']}' already exists")
+        else:
+            report.error(position, write_error["errmsg"])
+    return [duck for index, (_, duck) in enumerate(batch) if index not in failed]
+
+
+async def _async_iter(items: Iterable[Item]) -> AsyncIterator[Item]:
+    for item in items:
+        yield item
+
+
+async def _async_batches(items: AsyncIterable[Item]) -> AsyncIterator[List[Item]]:
+    batch: List[Item] = []
+    async for item in items:
+        batch.append(item)
+        if len(batch) == BULK_BATCH_SIZE:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+async def _async_lines(chunks: AsyncIterable[bytes]) -> AsyncIterator[bytes]:
+    rest = b""
+    async for chunk in chunks:
+        *lines, rest = (rest + chunk).split(b"\n")
+        for line in lines:
+            yield line
+    if rest:
+        yield rest
@@ -0,0 +1,243 @@
+"""Read-through caches for single-duck lookups (GET /ducks/<name>).
+
+A cache sits in front of MongoDB: get_or_load() returns the cached duck, or
+loads it from the database and remembers it for `ttl` seconds. Every write
+to a duck must call invalidate() with its name.
+
+  - LRUCache keeps the ducks in this process, up to `maxsize` of them, and
+    drops the least recently used one when it is full.
+  - SharedCache keeps them in a store shared by all the server processes,
+    normally Redis (any client with get/set/delete, e.g., redis.Redis). An
+    invalidation then reaches every process at once. MemoryStore is a local
+    stand-in for Redis, for tests and for running on one process.
+  - NoCache always loads from the database.
+
+Choose one with the DUCK_CACHE environment variable, see cache_from_env().
+"""
+
+import datetime
+import json
+import math
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple, Union
+
+from serialization import bson_default
+
+Duck = Dict[str, Any]
+
+
+class Cache:
+    """Base class of the caches: the read-through logic and the counters"""
+
+    def __init__(self, ttl: float) -> None:
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        # Incremented by every invalidation, see get_or_load()
+        self._generation = 0
+
+    def get_or_load(self, key: str, load: Callable[[], Optional[Duck]]) -> Optional[Duck]:
+        """Return the cached value of `key`, or load() it and cache it
+
+        Nothing is cached when load() returns None (e.g., no such duck).
+        """
+        value = self._get(key)
+        if value is not None:
+            self.hits += 1
+            return value
+        self.misses += 1
+        generation = self._generation
+        value = load()
+        # If a write invalidated anything while we were loading, our value
+        # may already be stale: return it but do not cache it
+        if value is not None and generation == self._generation:
+            self._set(key, value)
+        return value
+
+    async def get_or_load_async(
+        self, key: str, load: Callable[[], Awaitable[Optional[Duck]]]
+    ) -> Optional[Duck]:
+        """get_or_load() for the async app: `load` is a coroutine function
+
+        The cache itself is still used synchronously: that is instant for
+        LRUCache, but SharedCache blocks the event loop during each call to Redis.
+        """
+        value = self._get(key)
+        if value is not None:
+            self.hits += 1
+            return value
+        self.misses += 1
+        generation = self._generation
+        value = await load()
+        if value is not None and generation == self._generation:
+            self._set(key, value)
+        return value
+
+    def invalidate(self, key: str) -> None:
+        """Forget `key`; call this after every change to it"""
+        self._generation += 1
+        self.invalidations += 1
+        self._delete(key)
+
+    def stats(self) -> Dict[str, Any]:
+        """Counters since the cache was created"""
+        lookups = self.hits + self.misses
+        return {
+            "backend": type(self).__name__,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else None,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations,
+        }
+
+    def _get(self, key: str) -> Optional[Duck]:
+        raise NotImplementedError
+
+    def _set(self, key: str, value: Duck) -> None:
+        raise NotImplementedError
+
+    def _delete(self, key: str) -> None:
+        raise NotImplementedError
+
+
+class NoCache(Cache):
+    """Never caches anything"""
+
+    def __init__(self) -> None:
+        super().__init__(ttl=0)
+
+    def _get(self, key: str) -> Optional[Duck]:
+        return None
+
+    def _set(self, key: str, value: Duck) -> None:
+        pass
+
+    def _delete(self, key: str) -> None:
+        pass
+
+
+class LRUCache(Cache):
+    """In-process cache of at most `maxsize` entries, each kept for `ttl` seconds"""
+
+    def __init__(self, maxsize: int = 10000, ttl: float = 60.0) -> None:
+        super().__init__(ttl)
+        self.maxsize = maxsize
+        # key -> (expiry time, value), least recently used first
+        self._entries: "OrderedDict[str, Tuple[float, Duck]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def stats(self) -> Dict[str, Any]:
+        return {**super().stats(), "size": len(self._entries), "maxsize": self.maxsize}
+
+    def _get(self, key: str) -> Optional[Duck]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[0] < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return entry[1]
+
+    def _set(self, key: str, value: Duck) -> None:
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def _delete(self, key: str) -> None:
+        with self._lock:
+            self._entries.pop(key, None)
+
+
+class MemoryStore:
+    """Local stand-in for a Redis client: the get/set/delete subset SharedCache uses
+
+    Like redis-py, set() only takes a whole number of seconds (or a timedelta)
+    for `ex`, and Redis refuses one that is not positive.
+    """
+
+    def __init__(self) -> None:
+        self._values: Dict[str, Tuple[Optional[float], bytes]] = {}
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[bytes]:
+        with self._lock:
+            expires, value = self._values.get(key, (None, None))
+            if value is not None and expires is not None and expires < time.monotonic():
+                del self._values[key]
+                return None
+            return value
+
+    def set(
+        self, key: str, value: bytes, ex: Union[int, datetime.timedelta, None] = None
+    ) -> None:
+        if isinstance(ex, datetime.timedelta):
+            ex = int(ex.total_seconds())
+        if ex is not None and (not isinstance(ex, int) or isinstance(ex, bool)):
+            raise TypeError("ex must be datetime.timedelta or int")
+        if ex is not None and ex <= 0:
+            raise ValueError("invalid expire time in 'set' command")
+        with self._lock:
+            self._values[key] = (time.monotonic() + ex if ex else None, value)
+
+    def delete(self, *keys: str) -> None:
+        with self._lock:
+            for key in keys:
+                self._values.pop(key, None)
+
+
+class SharedCache(Cache):
+    """Cache in a store shared between processes (a Redis client or a MemoryStore)
+
+    The store does its own expiry and eviction, so `evictions` stays 0 here.
+    """
+
+    def __init__(self, store: Any, ttl: float = 60.0, prefix: str = "duck:") -> None:
+        super().__init__(ttl)
+        self.store = store
+        self.prefix = prefix
+
+    def _get(self, key: str) -> Optional[Duck]:
+        value = self.store.get(self.prefix + key)
+        return json.loads(value) if value is not None else None
+
+    def _set(self, key: str, value: Duck) -> None:
+        encoded = json.dumps(value, default=bson_default).encode()
+        # Redis only expires keys after a whole, positive number of seconds
+        self.store.set(self.prefix + key, encoded, ex=max(1, math.ceil(self.ttl)))
+
+    def _delete(self, key: str) -> None:
+        self.store.delete(self.prefix + key)
+
+
+def cache_from_env() -> Cache:
+    """Create the cache chosen by the environment variables
+
+    DUCK_CACHE: "lru" (default), "redis" or "none"
+    DUCK_CACHE_SIZE: Maximum number of ducks in the LRU cache (default 10000)
+    DUCK_CACHE_TTL: Seconds a duck stays cached (default 60; rounded up to
+        whole seconds for "redis")
+    DUCK_CACHE_URL: Redis URL for "redis" (default redis://localhost:6379/0)
+    """
+    backend = os.environ.get("DUCK_CACHE", "lru")
+    ttl = float(os.environ.get("DUCK_CACHE_TTL", "60"))
+    if backend == "none":
+        return NoCache()
+    if backend == "redis":
+        import redis  # Only needed for this backend: pip install redis
+
+        url = os.environ.get("DUCK_CACHE_URL", "redis://localhost:6379/0")
+        return SharedCache(redis.Redis.from_url(url), ttl)
+    if backend == "lru":
+        return LRUCache(int(os.environ.get("DUCK_CACHE_SIZE", "10000")), ttl)
+    raise ValueError(f"Unknown DUCK_CACHE backend '{backend}'")
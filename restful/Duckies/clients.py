@@ -0,0 +1,270 @@
+"""One MongoClient per process, shared by every DuckApp that connects to the
+same server with the same options.
+
+A MongoClient owns a pool of connections and background threads that
+monitor the servers, so it is meant to be created once and shared, not
+created for every app (e.g., for every test). get_client() returns the
+same client for the same URI and options, and PoolMetrics counts what its
+pool does, for GET /metrics.
+
+The pool size, wire compression and timeouts come from client_options(),
+which reads the [mongodb] section of app.ini; an environment variable
+overrides each key:
+
+  app.ini key                  Environment variable                   MongoClient option
+  max_pool_size                MONGODB_MAX_POOL_SIZE                  maxPoolSize
+  min_pool_size                MONGODB_MIN_POOL_SIZE                  minPoolSize
+  max_idle_time_ms             MONGODB_MAX_IDLE_TIME_MS               maxIdleTimeMS
+  wait_queue_timeout_ms        MONGODB_WAIT_QUEUE_TIMEOUT_MS          waitQueueTimeoutMS
+  server_selection_timeout_ms  MONGODB_SERVER_SELECTION_TIMEOUT_MS    serverSelectionTimeoutMS
+  connect_timeout_ms           MONGODB_CONNECT_TIMEOUT_MS             connectTimeoutMS
+  socket_timeout_ms            MONGODB_SOCKET_TIMEOUT_MS              socketTimeoutMS
+  compressors                  MONGODB_COMPRESSORS                    compressors
+
+Compressors are tried in the order given, and those whose Python package
+is missing are left out: zstd needs Python 3.14 (compression.zstd) or
+`pip install backports.zstd`, snappy needs `pip install python-snappy`,
+zlib is always there. These are the modules pymongo itself uses: it
+ignores the `zstandard` package.
+
+Fork safety: pre-fork servers (e.g., gunicorn --preload) create the app and
+then fork the workers. A client's sockets and threads must not be shared
+with a child process, so after a fork the child forgets the clients of the
+parent, and calls the methods registered with on_fork(), which drop what
+they got from them (see DuckApp.disconnect()). Nothing is opened in the
+fork hook: the child gets its own client from get_client() on first use.
+"""
+
+import configparser
+import importlib
+import os
+import re
+import threading
+import weakref
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from pymongo import MongoClient
+from pymongo.monitoring import (
+    ConnectionCheckedInEvent,
+    ConnectionCheckedOutEvent,
+    ConnectionCheckOutFailedEvent,
+    ConnectionCheckOutStartedEvent,
+    ConnectionClosedEvent,
+    ConnectionCreatedEvent,
+    ConnectionPoolListener,
+    ConnectionReadyEvent,
+    PoolClearedEvent,
+    PoolClosedEvent,
+    PoolCreatedEvent,
+    PoolReadyEvent,
+)
+
+CONFIG_FILE = Path(__file__).parent / "app.ini"
+
+# app.ini key -> (MongoClient option, type)
+OPTIONS: Dict[str, Tuple[str, type]] = {
+    "max_pool_size": ("maxPoolSize", int),
+    "min_pool_size": ("minPoolSize", int),
+    "max_idle_time_ms": ("maxIdleTimeMS", int),
+    "wait_queue_timeout_ms": ("waitQueueTimeoutMS", int),
+    "server_selection_timeout_ms": ("serverSelectionTimeoutMS", int),
+    "connect_timeout_ms": ("connectTimeoutMS", int),
+    "socket_timeout_ms": ("socketTimeoutMS", int),
+    "compressors": ("compressors", str),
+}
+
+# Modules that provide each compressor, any one of which will do
+COMPRESSOR_MODULES = {
+    "zstd": ["compression.zstd", "backports.zstd"],
+    "snappy": ["snappy"],
+    "zlib": ["zlib"],
+}
+
+
+def available_compressors(names: str) -> str:
+    """The compressors of a comma-separated list whose package is installed"""
+    available = []
+    for name in (name.strip() for name in names.split(",")):
+        for module in COMPRESSOR_MODULES.get(name, []):
+            try:
+                importlib.import_module(module)
+            except ImportError:
+                continue
+            available.append(name)
+            break
+    return ",".join(available)
+
+
+def client_options(config_file: Path = CONFIG_FILE) -> Dict[str, Any]:
+    """MongoClient options from the [mongodb] section of app.ini and the environment
+
+    Keys that are missing or empty in both are left to pymongo's defaults.
+    """
+    config = configparser.ConfigParser()
+    config.read(config_file)
+    section = config["mongodb"] if config.has_section("mongodb") else {}
+    options: Dict[str, Any] = {}
+    for key, (option, option_type) in OPTIONS.items():
+        value = os.environ.get(f"MONGODB_{key.upper()}", section.get(key, ""))
+        if value.strip():
+            options[option] = option_type(value)
+    if "compressors" in options:
+        options["compressors"] = available_compressors(options["compressors"])
+        if not options["compressors"]:
+            del options["compressors"]
+    return options
+
+
+class PoolMetrics(ConnectionPoolListener):
+    """Counts what a client's connection pools do (all servers together)
+
+    pymongo calls it from whichever thread uses or maintains the pool.
+    """
+
+    def __init__(self) -> None:
+        self.open = 0
+        self.in_use = 0
+        self.max_in_use = 0
+        self.created = 0
+        self.closed = 0
+        self.checkouts = 0
+        self.checkout_failures = 0
+        self.waiting = 0
+        self.wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+        self.cleared = 0
+        self._lock = threading.Lock()
+
+    def stats(self) -> Dict[str, Any]:
+        """Counters since the client was created"""
+        with self._lock:
+            return {
+                "open": self.open,
+                "in_use": self.in_use,
+                "max_in_use": self.max_in_use,
+                "waiting": self.waiting,
+                "created": self.created,
+                "closed": self.closed,
+                "checkouts": self.checkouts,
+                "checkout_failures": self.checkout_failures,
+                "avg_wait_ms": round(1000 * self.wait_seconds / self.checkouts, 3)
+                if self.checkouts else None,
+                "max_wait_ms": round(1000 * self.max_wait_seconds, 3),
+                "cleared": self.cleared,
+            }
+
+    def connection_created(self, event: ConnectionCreatedEvent) -> None:
+        with self._lock:
+            self.created += 1
+            self.open += 1
+
+    def connection_closed(self, event: ConnectionClosedEvent) -> None:
+        with self._lock:
+            self.closed += 1
+            self.open -= 1
+
+    def connection_check_out_started(self, event: ConnectionCheckOutStartedEvent) -> None:
+        with self._lock:
+            self.waiting += 1
+
+    def connection_check_out_failed(self, event: ConnectionCheckOutFailedEvent) -> None:
+        with self._lock:
+            self.waiting -= 1
+            self.checkout_failures += 1
+
+    def connection_checked_out(self, event: ConnectionCheckedOutEvent) -> None:
+        with self._lock:
+            self.waiting -= 1
+            self.checkouts += 1
+            self.in_use += 1
+            self.max_in_use = max(self.max_in_use, self.in_use)
+            # The time spent waiting for the connection (pymongo 4.9+)
+            wait = getattr(event, "duration", None) or 0.0
+            self.wait_seconds += wait
+            self.max_wait_seconds = max(self.max_wait_seconds, wait)
+
+    def connection_checked_in(self, event: ConnectionCheckedInEvent) -> None:
+        with self._lock:
+            self.in_use -= 1
+
+    def pool_cleared(self, event: PoolClearedEvent) -> None:
+        with self._lock:
+            self.cleared += 1
+
+    def pool_created(self, event: PoolCreatedEvent) -> None:
+        pass
+
+    def pool_ready(self, event: PoolReadyEvent) -> None:
+        pass
+
+    def pool_closed(self, event: PoolClosedEvent) -> None:
+        pass
+
+    def connection_ready(self, event: ConnectionReadyEvent) -> None:
+        pass
+
+
+# (uri, options) -> the client of this process and its metrics
+_clients: Dict[Tuple[str, Tuple[Tuple[str, Any], ...]], Tuple[MongoClient, PoolMetrics]] = {}
+_clients_lock = threading.Lock()
+_fork_callbacks: List[weakref.WeakMethod] = []
+
+
+def get_client(uri: str, **options: Any) -> MongoClient:
+    """The MongoClient of this process for `uri` and `options`, created on first use"""
+    key = (uri, tuple(sorted(options.items())))
+    with _clients_lock:
+        if key not in _clients:
+            metrics = PoolMetrics()
+            client = MongoClient(uri, event_listeners=[metrics], **options)
+            _clients[key] = (client, metrics)
+        return _clients[key][0]
+
+
+def redact(uri: str) -> str:
+    """A URI without its user name and password, to show in metrics"""
+    return re.sub(r"//[^@/]*@", "//", uri)
+
+
+def pool_stats() -> List[Dict[str, Any]]:
+    """Pool metrics of every client of this process"""
+    with _clients_lock:
+        clients = list(_clients.items())
+    return [
+        {"uri": redact(uri), "options": dict(options), **metrics.stats()}
+        for (uri, options), (_, metrics) in clients
+    ]
+
+
+def close_clients() -> None:
+    """Close every client of this process (e.g., at shutdown)"""
+    with _clients_lock:
+        clients = list(_clients.values())
+        _clients.clear()
+    for client, _ in clients:
+        client.close()
+
+
+def on_fork(method: Callable[[], None]) -> None:
+    """Call a bound method in every child process forked from now on
+
+    Only a weak reference is kept, so this does not keep its object alive.
+    """
+    _fork_callbacks.append(weakref.WeakMethod(method))  # type: ignore[arg-type]
+
+
+def _after_fork_in_child() -> None:
+    global _clients_lock
+    # Another thread of the parent may have held the lock when it forked
+    _clients_lock = threading.Lock()
+    # The parent's clients are not closed: their sockets belong to the parent
+    _clients.clear()
+    _fork_callbacks[:] = [ref for ref in _fork_callbacks if ref() is not None]
+    for ref in _fork_callbacks:
+        method: Optional[Callable[[], None]] = ref()
+        if method is not None:
+            method()
+
+
+os.register_at_fork(after_in_child=_after_fork_in_child)
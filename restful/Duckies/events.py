@@ -0,0 +1,367 @@
+"""Live feed of duck changes, for GET /ducks/events (Server-Sent Events).
+
+Each change is sent as a delta that a client applies to its own copy of
+the ducks, keyed by _id, instead of fetching /ducks again:
+
+  insert  {"_id": ..., "duck": {...the whole duck...}}  (also for a replaced duck)
+  update  {"_id": ..., "changes": {"value": 12, "version": 3}}
+  delete  {"_id": ...}
+  reset   {}  the client missed changes and must fetch /ducks again
+
+An EventHub fans the changes out to every subscriber of this process, and
+keeps the last HISTORY_SIZE of them so that a client that reconnects with
+the id of the last event it saw (the Last-Event-ID header, which browsers
+send by themselves) gets the ones it missed. The changes come from one of:
+
+  - ChangeStreamFeed (AsyncChangeStreamFeed in the async app): one MongoDB
+    change stream per process, whatever the number of subscribers. It sees
+    every write, including those of other processes and of mongosh, but
+    needs a replica set (or sharded cluster). It resumes after a network
+    error from its last resume token.
+  - The app itself, which publishes its own writes, when change streams
+    are not available (a standalone mongod, or the memory store). Other
+    processes' writes are then not seen.
+
+In app.py, each subscriber holds one of the server's worker threads for as
+long as it stays connected (sse_stream() blocks it); in async_app.py it only
+holds a coroutine (async_sse_stream()).
+"""
+
+import asyncio
+import threading
+import time
+import uuid
+from collections import deque
+from typing import (
+    Any,
+    AsyncIterator,
+    Callable,
+    Deque,
+    Dict,
+    Iterator,
+    List,
+    Optional,
+    Set,
+    Tuple,
+)
+
+from pymongo.asynchronous.collection import AsyncCollection
+from pymongo.collection import Collection
+from pymongo.errors import OperationFailure, PyMongoError
+
+from search import SEARCH_FIELD
+
+Event = Dict[str, Any]
+
+# Events kept for reconnecting clients, and events a slow client may fall behind
+HISTORY_SIZE = 1000
+QUEUE_SIZE = 1000
+
+# Seconds between keep-alive comments on an idle stream
+KEEP_ALIVE = 15.0
+
+
+class Subscription:
+    """The events waiting for one subscriber"""
+
+    def __init__(self) -> None:
+        self.events: Deque[Tuple[int, Event]] = deque()
+        # Set if the subscriber fell QUEUE_SIZE events behind and must start over
+        self.reset = False
+        self.condition = threading.Condition()
+
+    def put(self, seq: int, event: Event) -> None:
+        with self.condition:
+            if len(self.events) >= QUEUE_SIZE:
+                self.events.clear()
+                self.reset = True
+            self.events.append((seq, event))
+            self.condition.notify()
+
+    def get(self, timeout: float) -> Tuple[bool, List[Tuple[int, Event]]]:
+        """Wait up to `timeout` seconds for events; return (reset, events)"""
+        with self.condition:
+            if not self.events and not self.reset:
+                self.condition.wait(timeout)
+            reset, self.reset = self.reset, False
+            events = list(self.events)
+            self.events.clear()
+            return reset, events
+
+
+class AsyncSubscription(Subscription):
+    """A Subscription that a coroutine waits on, for the async app
+
+    It must be created on the event loop of the coroutine. Events may still
+    be put from any thread (e.g., a change stream's).
+    """
+
+    def __init__(self) -> None:
+        super().__init__()
+        self._loop = asyncio.get_running_loop()
+        self._ready = asyncio.Event()
+
+    def put(self, seq: int, event: Event) -> None:
+        super().put(seq, event)
+        self._loop.call_soon_threadsafe(self._ready.set)
+
+    async def get_async(self, timeout: float) -> Tuple[bool, List[Tuple[int, Event]]]:
+        """get() without blocking the event loop while it waits"""
+        # Cleared before looking, so an event put after the look sets it again
+        self._ready.clear()
+        reset, events = self.get(0)
+        if reset or events:
+            return reset, events
+        try:
+            await asyncio.wait_for(self._ready.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        return self.get(0)
+
+
+class EventHub:
+    """Fans out events to subscribers, and remembers the last ones for reconnects
+
+    Event ids are "<epoch>-<number>": the epoch is chosen at random for each
+    hub, so an id from another process (or from before a restart) is never
+    mistaken for one of ours, and gets a reset instead.
+    """
+
+    def __init__(self, history_size: int = HISTORY_SIZE) -> None:
+        self.epoch = uuid.uuid4().hex[:12]
+        self._seq = 0
+        self._history: Deque[Tuple[int, Event]] = deque(maxlen=history_size)
+        self._subscribers: Set[Subscription] = set()
+        self._lock = threading.Lock()
+
+    def event_id(self, seq: int) -> str:
+        return f"{self.epoch}-{seq}"
+
+    def publish(self, event: Event) -> None:
+        # Under the lock, so that every subscriber gets the events in order
+        with self._lock:
+            self._seq += 1
+            self._history.append((self._seq, event))
+            for subscription in self._subscribers:
+                subscription.put(self._seq, event)
+
+    def subscribe(
+        self, last_event_id: Optional[str] = None, subscription: Optional[Subscription] = None
+    ) -> Subscription:
+        """Start receiving events, after `last_event_id` if the client has one
+
+        Pass an AsyncSubscription as `subscription` to wait for them in a coroutine.
+        """
+        subscription = subscription or Subscription()
+        with self._lock:
+            if last_event_id:
+                epoch, _, seq = last_event_id.rpartition("-")
+                oldest = self._history[0][0] if self._history else self._seq + 1
+                if epoch == self.epoch and seq.isdigit() and oldest - 1 <= int(seq) <= self._seq:
+                    subscription.events.extend(
+                        (number, event) for number, event in self._history if number > int(seq)
+                    )
+                else:
+                    subscription.reset = True
+            self._subscribers.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription) -> None:
+        with self._lock:
+            self._subscribers.discard(subscription)
+
+    def subscriber_count(self) -> int:
+        with self._lock:
+            return len(self._subscribers)
+
+
+def visible(field: str) -> bool:
+    """Whether clients see a field (or a path in it) of a duck: all but the search keys"""
+    return field != SEARCH_FIELD and not field.startswith(SEARCH_FIELD + ".")
+
+
+def change_to_event(change: Dict[str, Any]) -> Optional[Event]:
+    """The delta for a change stream document (None if it only changed the search keys)"""
+    operation = change["operationType"]
+    if operation in ("insert", "replace"):
+        return {"op": "insert", "_id": change["documentKey"]["_id"], "duck": change["fullDocument"]}
+    if operation == "update":
+        description = change["updateDescription"]
+        changes = {
+            field: value
+            for field, value in description.get("updatedFields", {}).items()
+            if visible(field)
+        }
+        changes.update(dict.fromkeys(filter(visible, description.get("removedFields", []))))
+        if not changes:
+            return None
+        return {"op": "update", "_id": change["documentKey"]["_id"], "changes": changes}
+    if operation == "delete":
+        return {"op": "delete", "_id": change["documentKey"]["_id"]}
+    # drop, rename, invalidate, ...: the client's copy can no longer be patched
+    return {"op": "reset"}
+
+
+def watch_options(resume_token: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+    """Arguments of the watch() of a change stream feed"""
+    return {
+        # Clients never see the search keys (see search.py, and change_to_event())
+        "pipeline": [{"$unset": f"fullDocument.{SEARCH_FIELD}"}],
+        "full_document": "updateLookup",
+        "resume_after": resume_token,
+        "max_await_time_ms": 1000,
+    }
+
+
+def change_streams_supported(collection: Collection) -> bool:
+    """Whether the server can open change streams (a replica set or sharded cluster)"""
+    try:
+        collection.watch().close()
+        return True
+    except (OperationFailure, NotImplementedError):
+        return False
+
+
+async def change_streams_supported_async(collection: AsyncCollection) -> bool:
+    """change_streams_supported() for an async collection"""
+    try:
+        await (await collection.watch()).close()
+        return True
+    except (OperationFailure, NotImplementedError):
+        return False
+
+
+class ChangeStreamFeed:
+    """Publishes every change to the duck collection, from one change stream
+
+    The stream is opened by a background thread on the first start(), i.e.,
+    when the first client subscribes, and then stays open for all of them.
+    """
+
+    def __init__(self, collection: Collection, hub: EventHub) -> None:
+        self.collection = collection
+        self.hub = hub
+        self.resume_token: Optional[Dict[str, Any]] = None
+        self._thread: Optional[threading.Thread] = None
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+
+    def start(self) -> None:
+        """Start watching, unless already watching
+
+        Also restarts the thread in a forked child, which the parent's thread
+        did not follow.
+        """
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._stop.clear()
+                self._thread = threading.Thread(target=self._watch, daemon=True)
+                self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+
+    def _watch(self) -> None:
+        while not self._stop.is_set():
+            try:
+                with self.collection.watch(**watch_options(self.resume_token)) as stream:
+                    while not self._stop.is_set():
+                        change = stream.try_next()
+                        event = change_to_event(change) if change is not None else None
+                        if event is not None:
+                            self.hub.publish(event)
+                        # Also moves on while no change comes, see resume_token
+                        self.resume_token = stream.resume_token
+            except OperationFailure:
+                # E.g., the resume token is too old for the oplog: start over
+                if self.resume_token is not None:
+                    self.resume_token = None
+                    self.hub.publish({"op": "reset"})
+                time.sleep(1)
+            except PyMongoError:
+                # pymongo already retried once: wait, then resume where we were
+                time.sleep(1)
+
+
+class AsyncChangeStreamFeed:
+    """ChangeStreamFeed for the async app: the stream is watched by a task, not a thread"""
+
+    def __init__(self, collection: AsyncCollection, hub: EventHub) -> None:
+        self.collection = collection
+        self.hub = hub
+        self.resume_token: Optional[Dict[str, Any]] = None
+        self._task: Optional["asyncio.Task[None]"] = None
+
+    def start(self) -> None:
+        """Start watching, unless already watching (call it on the app's event loop)"""
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self._watch())
+
+    def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+
+    async def _watch(self) -> None:
+        while True:
+            try:
+                async with await self.collection.watch(
+                    **watch_options(self.resume_token)
+                ) as stream:
+                    while True:
+                        change = await stream.try_next()
+                        event = change_to_event(change) if change is not None else None
+                        if event is not None:
+                            self.hub.publish(event)
+                        self.resume_token = stream.resume_token
+            except OperationFailure:
+                if self.resume_token is not None:
+                    self.resume_token = None
+                    self.hub.publish({"op": "reset"})
+                await asyncio.sleep(1)
+            except PyMongoError:
+                await asyncio.sleep(1)
+
+
+def sse_messages(
+    hub: EventHub, reset: bool, events: List[Tuple[int, Event]], dumps: Callable[[Any], str]
+) -> Iterator[str]:
+    """The Server-Sent Events messages for what a subscription's get() returned"""
+    if reset:
+        yield "event: reset\ndata: {}\n\n"
+    for seq, event in events:
+        data = {key: value for key, value in event.items() if key != "op"}
+        yield f"id: {hub.event_id(seq)}\nevent: {event['op']}\ndata: {dumps(data)}\n\n"
+    if not reset and not events:
+        # Comment line: keeps proxies from closing an idle connection
+        yield ": keep-alive\n\n"
+
+
+def sse_stream(
+    hub: EventHub, subscription: Subscription, dumps: Callable[[Any], str]
+) -> Iterator[str]:
+    """Encode events as Server-Sent Events until the client disconnects
+
+    This holds the calling thread until then.
+    """
+    try:
+        # Ask browsers to reconnect after 3 s rather than their default
+        yield "retry: 3000\n\n"
+        while True:
+            reset, events = subscription.get(KEEP_ALIVE)
+            yield from sse_messages(hub, reset, events, dumps)
+    finally:
+        hub.unsubscribe(subscription)
+
+
+async def async_sse_stream(
+    hub: EventHub, subscription: AsyncSubscription, dumps: Callable[[Any], str]
+) -> AsyncIterator[str]:
+    """sse_stream() for the async app, which only holds a coroutine"""
+    try:
+        yield "retry: 3000\n\n"
+        while True:
+            reset, events = await subscription.get_async(KEEP_ALIVE)
+            for message in sse_messages(hub, reset, events, dumps):
+                yield message
+    finally:
+        hub.unsubscribe(subscription)
@@ -0,0 +1,131 @@
+"""Load test: many concurrent clients keep requesting one URL.
+
+Each client sends its next request as soon as the previous response has
+arrived, on the same connection if the server keeps it open (Flask's
+development server closes it after every response). The test reports the
+requests per second, the latency percentiles and the errors, which is
+enough to compare the thread-per-request app (app.py) with the asyncio one
+(async_app.py) at the same concurrency. For example, with a mongod running
+and the test ducks added:
+
+    python app.py                                            # port 6006
+    python loadtest.py http://localhost:6006/ducks/duck_1 --connections 1000
+
+    hypercorn "async_app:create_app()" --bind 0.0.0.0:6007
+    python loadtest.py http://localhost:6007/ducks/duck_1 --connections 1000
+
+Set DUCK_CACHE=none on the servers to measure the database round trips
+rather than the cache. Opening 1000 connections needs `ulimit -n` above
+1000 for both the server and this script.
+"""
+
+import argparse
+import asyncio
+import statistics
+import time
+from typing import List, Optional, Tuple
+from urllib.parse import urlsplit
+
+# Seconds to wait for a response before counting it as an error
+REQUEST_TIMEOUT = 30.0
+
+
+async def read_response(reader: asyncio.StreamReader) -> Tuple[int, bool]:
+    """Read one HTTP/1.1 response (Content-Length or chunked)
+
+    Returns:
+        The status, and whether the server keeps the connection open.
+    """
+    status_line = await reader.readline()
+    if not status_line:
+        raise ConnectionError("Connection closed by the server")
+    status = int(status_line.split()[1])
+    length: Optional[int] = None
+    chunked = False
+    keep_alive = True
+    while (line := await reader.readline()) not in (b"\r\n", b""):
+        name, _, value = line.decode("latin-1").partition(":")
+        name, value = name.lower(), value.strip().lower()
+        if name == "content-length":
+            length = int(value)
+        elif name == "transfer-encoding":
+            chunked = "chunked" in value
+        elif name == "connection":
+            keep_alive = value != "close"
+    if chunked:
+        while size := int((await reader.readline()).split(b";")[0], 16):
+            await reader.readexactly(size + 2)
+        await reader.readline()
+    elif length:
+        await reader.readexactly(length)
+    return status, keep_alive
+
+
+async def client(
+    host: str, port: int, request: bytes, deadline: float, latencies: List[float], errors: List[str]
+) -> None:
+    """Send requests until the deadline, recording each latency
+
+    The connection is reused as long as the server keeps it open; when the
+    server closes it, the time to open a new one counts in the next latency.
+    """
+    writer: Optional[asyncio.StreamWriter] = None
+    while time.perf_counter() < deadline:
+        start = time.perf_counter()
+        try:
+            if writer is None:
+                reader, writer = await asyncio.open_connection(host, port)
+            writer.write(request)
+            status, keep_alive = await asyncio.wait_for(read_response(reader), REQUEST_TIMEOUT)
+        except (OSError, ConnectionError, asyncio.IncompleteReadError, asyncio.TimeoutError) as error:
+            errors.append(type(error).__name__)
+            keep_alive = False
+        else:
+            if status >= 400:
+                errors.append(f"HTTP {status}")
+            else:
+                latencies.append(time.perf_counter() - start)
+        if not keep_alive and writer is not None:
+            writer.close()
+            writer = None
+    if writer is not None:
+        writer.close()
+
+
+async def load_test(url: str, connections: int, seconds: float) -> Tuple[List[float], List[str]]:
+    """Run `connections` clients against `url` for `seconds`; return latencies and errors"""
+    parts = urlsplit(url)
+    path = parts.path + (f"?{parts.query}" if parts.query else "")
+    request = f"GET {path or '/'} HTTP/1.1\r\nHost: {parts.netloc}\r\n\r\n".encode()
+    latencies: List[float] = []
+    errors: List[str] = []
+    deadline = time.perf_counter() + seconds
+    await asyncio.gather(*(
+        client(parts.hostname or "localhost", parts.port or 80, request, deadline, latencies, errors)
+        for _ in range(connections)
+    ))
+    return latencies, errors
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("url")
+    parser.add_argument("--connections", type=int, default=1000)
+    parser.add_argument("--seconds", type=float, default=10.0)
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    latencies, errors = asyncio.run(load_test(args.url, args.connections, args.seconds))
+    elapsed = time.perf_counter() - start
+    print(f"{args.connections} connections, {elapsed:.1f} s")
+    print(f"requests/s: {len(latencies) / elapsed:,.0f} ({len(latencies)} ok, {len(errors)} errors)")
+    if len(latencies) >= 2:
+        percentiles = statistics.quantiles(latencies, n=100)
+        print(f"latency ms: p50 {percentiles[49] * 1000:.1f}, p99 {percentiles[98] * 1000:.1f}, "
+              f"max {max(latencies) * 1000:.1f}")
+    for error in sorted(set(errors)):
+        print(f"  {errors.count(error)} x {error}")
+
+
+if __name__ == "__main__":
+    main()
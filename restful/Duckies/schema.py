@@ -0,0 +1,136 @@
+"""The fields of a duck, declared once and checked by every write.
+
+DUCK_SCHEMA lists the fields that clients set, with the types each one
+accepts. It is compiled once, at import, into DUCK_VALIDATOR, which
+POST /add_duck, POST /ducks/bulk and PUT /ducks/<name> all use (in app.py
+and async_app.py): a duck is then checked with one pass over a list of
+prepared checks, instead of reading the schema again for every request.
+
+json_schema() gives the same rules as a MongoDB $jsonSchema, which the
+database itself checks on every write when DUCK_JSON_SCHEMA=1, also for
+writes that do not go through the app (mongosh, other services).
+
+Fields that are not in the schema are kept as they are, except those the
+server sets itself (SERVER_FIELDS), which clients may not send.
+"""
+
+import re
+from typing import Any, Callable, Dict, FrozenSet, List, Optional, Tuple
+
+from search import SEARCH_FIELD
+
+Duck = Dict[str, Any]
+Check = Callable[[Any], bool]
+
+# Values that count as a missing field
+EMPTY = (None, "")
+
+# Fields set by the server: the _id, the version behind the ETags, and the search keys
+SERVER_FIELDS = ("_id", "version", SEARCH_FIELD)
+
+# What the "Add a Duck" form sends for a value (stats.py counts it as a number)
+NUMERIC_STRING = re.compile(r"-?[0-9]+(\.[0-9]+)?")
+
+# Each type of DUCK_SCHEMA: how the app checks it, its $jsonSchema, and how errors name it
+TYPES: Dict[str, Tuple[Check, Dict[str, Any], str]] = {
+    "string": (
+        lambda value: isinstance(value, str) and value != "",
+        {"bsonType": "string", "minLength": 1},
+        "a non-empty string",
+    ),
+    "number": (
+        lambda value: isinstance(value, (int, float)) and not isinstance(value, bool),
+        {"bsonType": ["int", "long", "double", "decimal"]},
+        "a number",
+    ),
+    "numeric string": (
+        lambda value: isinstance(value, str) and NUMERIC_STRING.fullmatch(value) is not None,
+        {"bsonType": "string", "pattern": f"^{NUMERIC_STRING.pattern}$"},
+        "a numeric string",
+    ),
+}
+
+# Fields set by clients: their accepted types, whether a new duck must have
+# them, and whether PUT /ducks/<name> may change them
+DUCK_SCHEMA: Dict[str, Dict[str, Any]] = {
+    "name": {"types": ["string"], "required": True},
+    "type": {"types": ["string"], "required": True, "updatable": True},
+    "value": {"types": ["number", "numeric string"], "required": True, "updatable": True},
+}
+
+
+def any_of(checks: List[Check]) -> Check:
+    """One check that passes if any of `checks` does (the check itself if there is only one)"""
+    first, *rest = checks
+    if not rest:
+        return first
+    others = any_of(rest)
+    return lambda value: first(value) or others(value)
+
+
+class Validator:
+    """Checks ducks against a schema like DUCK_SCHEMA, compiled once"""
+
+    def __init__(self, schema: Dict[str, Dict[str, Any]]) -> None:
+        self.required: List[str] = [field for field, rule in schema.items() if rule.get("required")]
+        self.updatable: FrozenSet[str] = frozenset(
+            field for field, rule in schema.items() if rule.get("updatable")
+        )
+        # (field, check of all its types, error message), for each field
+        self.checks: List[Tuple[str, Check, str]] = [
+            (
+                field,
+                any_of([TYPES[name][0] for name in rule["types"]]),
+                f"{field} must be " + " or ".join(TYPES[name][2] for name in rule["types"]),
+            )
+            for field, rule in schema.items()
+        ]
+
+    def validate(self, duck: Any, partial: bool = False) -> Optional[str]:
+        """Return why a duck is invalid, or None if it is valid
+
+        A field that is null or "" counts as missing. With partial=True (an
+        update), only the fields present are checked.
+        """
+        if not isinstance(duck, dict):
+            return "Expected a JSON object"
+        for field in SERVER_FIELDS:
+            if field in duck:
+                fields = [field for field in SERVER_FIELDS if field in duck]
+                return f"{', '.join(fields)} cannot be set by clients"
+        # Valid ducks only take the loops; the messages are only made for invalid ones
+        if not partial:
+            for field in self.required:
+                if duck.get(field) in EMPTY:
+                    missing = [field for field in self.required if duck.get(field) in EMPTY]
+                    return f"Missing required fields: {', '.join(missing)}"
+        for field, check, _ in self.checks:
+            if field in duck and not check(duck[field]):
+                return "; ".join(
+                    message
+                    for field, check, message in self.checks
+                    if field in duck and not check(duck[field])
+                )
+        return None
+
+    def updates(self, data: Any) -> Duck:
+        """The fields of a PUT body that may be updated (not yet validated)"""
+        if not isinstance(data, dict):
+            return {}
+        return {field: value for field, value in data.items() if field in self.updatable}
+
+
+def json_schema(schema: Dict[str, Dict[str, Any]]) -> Dict[str, Any]:
+    """The $jsonSchema of a collection validator with the rules of `schema`"""
+    properties = {}
+    for field, rule in schema.items():
+        fragments = [TYPES[name][1] for name in rule["types"]]
+        properties[field] = fragments[0] if len(fragments) == 1 else {"anyOf": fragments}
+    return {
+        "bsonType": "object",
+        "required": [field for field, rule in schema.items() if rule.get("required")],
+        "properties": properties,
+    }
+
+
+DUCK_VALIDATOR = Validator(DUCK_SCHEMA)
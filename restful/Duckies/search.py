@@ -0,0 +1,112 @@
+"""Typeahead search over duck names, for GET /ducks/search?q=.
+
+A name is split into lowercase words ("Big_Yellow Duck": big, yellow, duck)
+and indexed under each suffix of its words: "big yellow duck", "yellow
+duck" and "duck". A query matches a duck if, split the same way, it is the
+prefix of one of its keys: "big yel", "yellow" and "du" all find "Big_Yellow
+Duck", i.e., the last word of the query may be incomplete and the query may
+start at any word of the name.
+
+Each search is then one range scan of a sorted index, however many ducks
+there are: a MongoDB multikey index on the keys, kept in the "search" field
+of each duck (see MongoDuckStore), or a sorted list in MemoryDuckStore.
+The matches are put in the order of rank() before the first `limit` of them
+are kept: by search_pipeline() in MongoDB, where the index scan order says
+nothing about the rank, and in MemoryDuckStore by scanning the keys in
+order, up to the last duck tied with the `limit`-th.
+"""
+
+import re
+from typing import Any, Dict, List
+
+from bson import ObjectId
+from pymongo import UpdateOne
+
+Duck = Dict[str, Any]
+
+# Field of the search keys in MongoDB; never returned to clients
+SEARCH_FIELD = "search"
+
+# Only the first words of a name are indexed, which bounds the keys per duck
+MAX_WORDS = 8
+
+
+def words(text: Any) -> List[str]:
+    """The lowercase words of a name or query (letters and digits)"""
+    return re.findall(r"[^\W_]+", str(text).lower())
+
+
+def normalize(query: str) -> str:
+    """A query as it is matched against the keys ("" if it has no words)"""
+    return " ".join(words(query)[:MAX_WORDS])
+
+
+def search_keys(name: Any) -> List[str]:
+    """The keys of a name, starting with the whole name"""
+    name_words = words(name)[:MAX_WORDS]
+    return [" ".join(name_words[start:]) for start in range(len(name_words))]
+
+
+def indexed(duck: Duck) -> Duck:
+    """The document to insert for a new duck: the duck and its search keys
+
+    The _id is set on `duck` itself, as insert_one() would.
+    """
+    duck.setdefault("_id", ObjectId())
+    return {**duck, SEARCH_FIELD: search_keys(duck["name"])}
+
+
+def search_filter(query: str) -> Dict[str, Any]:
+    """MongoDB filter for the ducks that match a normalized query
+
+    An anchored regex with no special characters is a range scan of the index.
+    """
+    return {SEARCH_FIELD: {"$regex": "^" + re.escape(query)}}
+
+
+def search_pipeline(query: str, limit: int) -> List[Dict[str, Any]]:
+    """Aggregation pipeline for the best `limit` ducks matching a normalized query
+
+    The matches are sorted like rank() does, in MongoDB, before the limit:
+    the smallest key that starts with the query, then whether that key is
+    not the whole name (the first key), then the name.
+    """
+    keys = f"${SEARCH_FIELD}"
+    matching = {
+        "$filter": {
+            "input": keys,
+            "cond": {"$eq": [{"$substrCP": ["$$this", 0, len(query)]}, query]},
+        }
+    }
+    return [
+        {"$match": search_filter(query)},
+        {"$addFields": {"_best": {"$min": matching}}},
+        {"$addFields": {"_partial": {"$ne": ["$_best", {"$arrayElemAt": [keys, 0]}]}}},
+        {"$sort": {"_best": 1, "_partial": 1, "name": 1}},
+        {"$limit": limit},
+        {"$project": {SEARCH_FIELD: 0, "_best": 0, "_partial": 0}},
+    ]
+
+
+def rank(ducks: List[Duck], query: str) -> List[Duck]:
+    """Sort the ducks that match a normalized query, best first
+
+    By their first matching key, in alphabetical order: the exact name comes
+    first, then names that go on with more words, then longer words. For the
+    same key, a match on the whole name comes before a match in the middle.
+    """
+
+    def rank_key(duck: Duck) -> Any:
+        keys = search_keys(duck.get("name"))
+        best = min((key for key in keys if key.startswith(query)), default="")
+        return best, best != keys[0], str(duck.get("name"))
+
+    return sorted(ducks, key=rank_key)
+
+
+def backfill_updates(ducks: List[Duck]) -> List[UpdateOne]:
+    """Updates that give search keys to ducks inserted without them ({_id, name} each)"""
+    return [
+        UpdateOne({"_id": duck["_id"]}, {"$set": {SEARCH_FIELD: search_keys(duck.get("name"))}})
+        for duck in ducks
+    ]
@@ -0,0 +1,184 @@
+"""Duck statistics per type: how many ducks, and the total, average, minimum
+and maximum of their `value`.
+
+Numbers count towards the value statistics, and so do numeric strings (what
+the web form sends, e.g., "10") and Decimal128 values, both as doubles; other
+values are left out. numeric_value() and NUMERIC_VALUE apply the same rule,
+in Python and in the aggregation pipeline. The statistics come either from
+an aggregation pipeline, which reads every duck of the types asked for, or
+from StatsCounters, which keeps them up to date on every write so that
+reading them costs one small query.
+"""
+
+import re
+from collections import defaultdict
+from typing import Any, Dict, Iterable, List, Optional, Union
+
+from bson.decimal128 import Decimal128
+from pymongo.collection import Collection
+
+Duck = Dict[str, Any]
+
+# Fields of a per-type group, see stats_pipeline()
+FIELDS = ("count", "valued", "total", "min", "max")
+
+# The value of a duck as numeric_value() gives it, else null (which $sum/$min/$max ignore)
+NUMERIC_VALUE = {
+    "$switch": {
+        "branches": [
+            {"case": {"$in": [{"$type": "$value"}, ["int", "long", "double"]]}, "then": "$value"},
+            {
+                "case": {"$in": [{"$type": "$value"}, ["string", "decimal"]]},
+                "then": {"$convert": {"input": "$value", "to": "double", "onError": None}},
+            },
+        ],
+        "default": None,
+    }
+}
+
+# The strings $convert turns into a double
+NUMBER_STRING = re.compile(r"[-+]?([0-9]+\.?[0-9]*|\.[0-9]+)([eE][-+]?[0-9]+)?")
+
+Number = Union[int, float]
+
+
+def stats_pipeline(duck_type: Optional[str] = None) -> List[Dict[str, Any]]:
+    """Aggregation pipeline giving one group per type (only `duck_type`, if given)"""
+    return [
+        {"$match": {} if duck_type is None else {"type": duck_type}},
+        {"$project": {"type": 1, "number": NUMERIC_VALUE}},
+        {
+            "$group": {
+                "_id": "$type",
+                "count": {"$sum": 1},
+                "valued": {"$sum": {"$cond": [{"$isNumber": "$number"}, 1, 0]}},
+                "total": {"$sum": "$number"},
+                "min": {"$min": "$number"},
+                "max": {"$max": "$number"},
+            }
+        },
+        {"$sort": {"_id": 1}},
+    ]
+
+
+def numeric_value(value: Any) -> Optional[Number]:
+    """The number a value counts as in the statistics, or None (see NUMERIC_VALUE)
+
+    Numbers count as they are, numeric strings and Decimal128 values as doubles.
+    """
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return value
+    if isinstance(value, str) and NUMBER_STRING.fullmatch(value):
+        return float(value)
+    if isinstance(value, Decimal128):
+        return float(value.to_decimal())
+    return None
+
+
+def format_stats(groups: List[Duck]) -> Dict[str, Any]:
+    """Add up per-type groups (see stats_pipeline()) into the statistics sent to clients"""
+    valued = sum(group["valued"] for group in groups)
+    total = sum(group["total"] for group in groups)
+    minimums = [group["min"] for group in groups if group["min"] is not None]
+    maximums = [group["max"] for group in groups if group["max"] is not None]
+    return {
+        "count": sum(group["count"] for group in groups),
+        "total_value": total,
+        "avg_value": total / valued if valued else None,
+        "min_value": min(minimums) if minimums else None,
+        "max_value": max(maximums) if maximums else None,
+    }
+
+
+class StatsCounters:
+    """Per-type statistics kept up to date on every write
+
+    Each type has a document {"_id": "type:<type>", "type", "count",
+    "valued", "total", "min", "max"} in the counters collection. Inserts
+    can update all of these with $inc, $min and $max, but removing a value
+    that may be the minimum or maximum leaves them unknown: they are then
+    marked stale and recomputed for that type (with an indexed
+    aggregation) the next time they are read.
+
+    The counters only see the writes made through DuckApp.
+    """
+
+    def __init__(self, counters: Collection, ducks: Collection) -> None:
+        self.counters = counters
+        self.ducks = ducks
+
+    def rebuild(self) -> None:
+        """Recompute all the counters from the ducks"""
+        self.counters.delete_many({"_id": {"$regex": "^type:"}})
+        documents = []
+        for group in self.ducks.aggregate(stats_pipeline()):
+            document = {"_id": f"type:{group['_id']}", "type": group["_id"], "stale": 0, "fresh": 0}
+            # Leave out a missing minimum and maximum: $min and $max treat null
+            # as smaller than any number, so they would never replace it
+            known = {field: group[field] for field in FIELDS if group[field] is not None}
+            documents.append({**document, **known})
+        if documents:
+            self.counters.insert_many(documents)
+
+    def record_insert(self, ducks: Iterable[Duck]) -> None:
+        """Count new ducks"""
+        by_type: Dict[Any, List[Any]] = defaultdict(list)
+        for duck in ducks:
+            by_type[duck.get("type")].append(duck.get("value"))
+        # One update per type: a batch of ducks usually has only a few types
+        for duck_type, values in by_type.items():
+            numbers = [number for number in map(numeric_value, values) if number is not None]
+            update: Dict[str, Any] = {
+                "$inc": {"count": len(values), "valued": len(numbers), "total": sum(numbers)},
+                "$setOnInsert": {"type": duck_type, "stale": 0, "fresh": 0},
+            }
+            if numbers:
+                update["$min"] = {"min": min(numbers)}
+                update["$max"] = {"max": max(numbers)}
+            self.counters.update_one({"_id": f"type:{duck_type}"}, update, upsert=True)
+
+    def record_delete(self, duck: Duck) -> None:
+        """Stop counting a duck that was deleted"""
+        key = f"type:{duck.get('type')}"
+        value = numeric_value(duck.get("value"))
+        if value is None:
+            self.counters.update_one({"_id": key}, {"$inc": {"count": -1}})
+            return
+        self.counters.update_one(
+            {"_id": key}, {"$inc": {"count": -1, "valued": -1, "total": -value}}
+        )
+        # If it was the minimum or the maximum, we no longer know them
+        self.counters.update_one(
+            {"_id": key, "$or": [{"min": {"$gte": value}}, {"max": {"$lte": value}}]},
+            {"$inc": {"stale": 1}},
+        )
+
+    def record_update(self, before: Duck, after: Duck) -> None:
+        """Count a change to the type or value of a duck"""
+        if (before.get("type"), before.get("value")) != (after.get("type"), after.get("value")):
+            self.record_delete(before)
+            self.record_insert([after])
+
+    def groups(self, duck_type: Optional[str] = None) -> List[Duck]:
+        """The counters of every type (only `duck_type`, if given), like stats_pipeline()"""
+        query: Dict[str, Any] = {"count": {"$gt": 0}}
+        query["_id"] = f"type:{duck_type}" if duck_type is not None else {"$regex": "^type:"}
+        groups = []
+        for counter in self.counters.find(query).sort("_id", 1):
+            if counter["stale"] != counter["fresh"]:
+                self._refresh_min_max(counter)
+            groups.append({"_id": counter["type"], **{field: counter.get(field) for field in FIELDS}})
+        return groups
+
+    def _refresh_min_max(self, counter: Duck) -> None:
+        """Recompute the stale minimum and maximum of one type (and update `counter`)"""
+        stale = counter["stale"]
+        group = next(self.ducks.aggregate(stats_pipeline(counter["type"])), {})
+        counter["min"], counter["max"] = group.get("min"), group.get("max")
+        known = {field: counter[field] for field in ("min", "max") if counter[field] is not None}
+        unknown = {field: "" for field in ("min", "max") if counter[field] is None}
+        update: Dict[str, Any] = {"$set": {**known, "fresh": stale}}
+        if unknown:
+            update["$unset"] = unknown
+        # Only mark them fresh if no other delete made them stale meanwhile
+        self.counters.update_one({"_id": counter["_id"], "stale": stale}, update)
@@ -0,0 +1,655 @@
+"""Where DuckApp keeps the ducks.
+
+The routes only use the operations of DuckStore, so the ducks can live in
+either store:
+
+  - MongoDuckStore keeps them in a MongoDB collection, and the change
+    counter behind the listings' ETag in a second one. AsyncMongoDuckStore
+    is the same for the async app (async_app.py), with the same queries.
+  - MemoryDuckStore keeps them in this process: a dict of ducks by _id, and
+    indexes by name, by type and for search (see search.py). It needs no
+    database, so the tests and benchmarks run without a mongod, and nothing
+    is persisted or shared between processes.
+
+Choose one with the DUCK_STORE environment variable ("mongo", the default,
+or "memory"), see DuckApp.__init__().
+"""
+
+import threading
+import uuid
+from abc import ABC, abstractmethod
+from bisect import bisect_left, bisect_right, insort
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple
+
+from bson import ObjectId
+from pymongo import ASCENDING, ReturnDocument
+from pymongo.asynchronous.collection import AsyncCollection
+from pymongo.asynchronous.cursor import AsyncCursor
+from pymongo.collection import Collection
+from pymongo.errors import DuplicateKeyError
+
+from bulk import BulkReport, Item, write_batch, write_batch_async
+from search import (
+    SEARCH_FIELD,
+    backfill_updates,
+    indexed,
+    rank,
+    search_keys,
+    search_pipeline,
+)
+from stats import numeric_value, stats_pipeline
+from streaming import async_batches, batches
+
+Duck = Dict[str, Any]
+
+
+class DuplicateDuck(Exception):
+    """A duck with this name already exists"""
+
+
+def duck_etag(duck: Duck) -> str:
+    """ETag of a duck: "<_id>-<version>", where every write increments the version
+
+    The _id tells apart a deleted duck from a new one with the same name.
+    Ducks added before versions existed have no version field and count as version 0.
+    """
+    return f"{duck['_id']}-{duck.get('version', 0)}"
+
+
+def etag_filter(etags: Optional[Set[str]]) -> Dict[str, Any]:
+    """MongoDB filter for ducks whose ETag is one of `etags` (None: any ETag)"""
+    if etags is None:
+        return {}
+    matches = []
+    for etag in etags:
+        duck_id, _, version = etag.rpartition("-")
+        if ObjectId.is_valid(duck_id) and version.isdigit():
+            # Version 0 also matches ducks without a version field
+            versions = [int(version), None] if int(version) == 0 else [int(version)]
+            matches.append({"_id": ObjectId(duck_id), "version": {"$in": versions}})
+    return {"$or": matches} if matches else {"_id": {"$in": []}}
+
+
+def mongo_projection(fields: Optional[List[str]]) -> Dict[str, Any]:
+    """MongoDB projection of `fields` (None: all of them), never with the search keys"""
+    if fields is None:
+        return {SEARCH_FIELD: 0}
+    # An empty projection would mean all the fields: ask for the _id alone instead
+    return dict.fromkeys([field for field in fields if field != SEARCH_FIELD] or ["_id"], 1)
+
+
+def project(duck: Duck, fields: Optional[List[str]]) -> Duck:
+    """A copy of a duck with only `fields` (and _id), or with all of them if None"""
+    if fields is None:
+        return dict(duck)
+    return {field: duck[field] for field in ["_id", *fields] if field in duck}
+
+
+def page(ducks: List[Duck], limit: int) -> Dict[str, Any]:
+    """The page of a find_page() from up to `limit` + 1 ducks (the extra one means "more")"""
+    next_cursor = str(ducks[limit - 1]["_id"]) if len(ducks) > limit else None
+    return {"ducks": ducks[:limit], "next": next_cursor}
+
+
+# The MongoDB queries of MongoDuckStore and AsyncMongoDuckStore, which only
+# differ in how they send them
+
+# The fields of a duck that update() and delete() return
+UPDATE_PROJECTION = {"version": 1, "type": 1, "value": 1}
+DELETE_PROJECTION = {"type": 1, "value": 1}
+
+# The document of the change counter, in the counters collection
+COUNTER = {"_id": "ducks"}
+
+
+def type_filter(duck_type: Optional[str]) -> Dict[str, Any]:
+    """MongoDB filter for the ducks of `duck_type` (None: all of them)"""
+    return {} if duck_type is None else {"type": duck_type}
+
+
+def page_filter(duck_type: Optional[str], after: Optional[str]) -> Dict[str, Any]:
+    """MongoDB filter for a find_page(): the ducks of `duck_type` after the _id `after`
+
+    Raises:
+        InvalidId: If `after` is not an ObjectId.
+    """
+    query = type_filter(duck_type)
+    if after is not None:
+        query = {"$and": [query, {"_id": {"$gt": ObjectId(after)}}]}
+    return query
+
+
+def update_filter(name: str, changes: Duck, etags: Optional[Set[str]]) -> Dict[str, Any]:
+    """MongoDB filter for an update(): the duck, if a change differs from it and an ETag matches"""
+    different = [{field: {"$ne": value}} for field, value in changes.items()]
+    return {"$and": [{"name": name}, {"$or": different}, etag_filter(etags)]}
+
+
+def update_document(changes: Duck) -> Dict[str, Any]:
+    """MongoDB update of an update(): set the changes and increment the version"""
+    return {"$set": changes, "$inc": {"version": 1}}
+
+
+def delete_filter(name: str, etags: Optional[Set[str]]) -> Dict[str, Any]:
+    """MongoDB filter for a delete(): the duck, if one of `etags` matches"""
+    return {"$and": [{"name": name}, etag_filter(etags)]}
+
+
+def change_update() -> Dict[str, Any]:
+    """MongoDB update of the change counter for record_change()
+
+    The count's "epoch" is chosen at random when the count is created, so
+    that a new count never repeats an old ETag.
+    """
+    return {"$inc": {"changes": 1}, "$setOnInsert": {"epoch": uuid.uuid4().hex}}
+
+
+def counter_start() -> Dict[str, Any]:
+    """MongoDB update that creates the change counter at 0 if it does not exist"""
+    return {"$setOnInsert": {"changes": 0, "epoch": uuid.uuid4().hex}}
+
+
+def counter_etag(counter: Duck) -> str:
+    """The ETag of the ducks, from the change counter"""
+    return f"{counter['epoch']}-{counter['changes']}"
+
+
+def validator_options(schema: Dict[str, Any]) -> Dict[str, Any]:
+    """Options of the collMod command of set_validator()
+
+    The "moderate" level leaves alone the changes to ducks that were
+    already invalid, so that they can still be fixed one field at a time.
+    """
+    return {"validator": {"$jsonSchema": schema}, "validationLevel": "moderate"}
+
+
+class DuckStore(ABC):
+    """The operations DuckApp needs from its storage"""
+
+    def ensure_indexes(self) -> None:
+        """Prepare the store for the queries below"""
+
+    @abstractmethod
+    def set_validator(self, schema: Dict[str, Any]) -> None:
+        """Have the store itself reject the ducks that break `schema`, a $jsonSchema
+
+        Stores that only hold the app's own writes may ignore it: the app
+        already validates every duck (see schema.py).
+        """
+
+    @abstractmethod
+    def clear(self) -> None:
+        """Delete every duck (for tests and benchmarks)"""
+
+    @abstractmethod
+    def get(self, name: str, fields: Optional[List[str]] = None) -> Optional[Duck]:
+        """The duck called `name` (only `fields` and _id, if given), or None"""
+
+    @abstractmethod
+    def find(self, duck_type: Optional[str] = None) -> Iterable[Duck]:
+        """Every duck (only those of `duck_type`, if given), read as they are iterated"""
+
+    @abstractmethod
+    def find_page(
+        self,
+        duck_type: Optional[str],
+        after: Optional[str],
+        limit: int,
+        fields: Optional[List[str]],
+    ) -> Dict[str, Any]:
+        """Get one page of ducks in _id order (only those of `duck_type`, if given)
+
+        Keyset pagination: instead of skipping the ducks of the earlier pages,
+        the page starts right after the last _id the client has seen, so
+        every page costs the same no matter how many ducks there are.
+
+        Args:
+            duck_type: Only list the ducks of this type (None for all of them)
+            after: _id of the last duck of the previous page (None for the first page)
+            limit: Maximum number of ducks on the page
+            fields: Fields to return (None for all of them); _id is always returned
+
+        Returns:
+            {"ducks": [...], "next": _id to pass as `after` for the next page, or None}
+
+        Raises:
+            InvalidId: If `after` is not an ObjectId.
+        """
+
+    @abstractmethod
+    def search(self, query: str, limit: int) -> List[Duck]:
+        """Up to `limit` ducks whose name matches a normalized query, best first
+
+        See search.py for the matching and the ranking.
+        """
+
+    @abstractmethod
+    def insert(self, duck: Duck) -> None:
+        """Add a duck, setting its _id
+
+        Raises:
+            DuplicateDuck: If a duck with the same name exists.
+        """
+
+    @abstractmethod
+    def write_batch(self, batch: List[Item], report: BulkReport) -> List[Duck]:
+        """Add valid ducks, reporting those that fail; return the inserted ones"""
+
+    @abstractmethod
+    def update(self, name: str, changes: Duck, etags: Optional[Set[str]]) -> Optional[Duck]:
+        """Set `changes` and increment the version of a duck, in one atomic step
+
+        Nothing happens unless a duck called `name` exists, at least one of
+        `changes` differs from it, and its ETag is one of `etags` (if not None).
+
+        Returns:
+            The _id, version, type and value of the duck before the update, or
+            None if it was not updated.
+        """
+
+    @abstractmethod
+    def delete(self, name: str, etags: Optional[Set[str]]) -> Optional[Duck]:
+        """Delete a duck if its ETag is one of `etags` (if not None)
+
+        Returns:
+            The _id, type and value of the deleted duck, or None.
+        """
+
+    @abstractmethod
+    def stats_groups(self, duck_type: Optional[str] = None) -> List[Duck]:
+        """Per-type statistics groups, as stats_pipeline() gives them"""
+
+    @abstractmethod
+    def record_change(self) -> None:
+        """Count a change to the ducks (call it after every write)"""
+
+    @abstractmethod
+    def etag(self) -> str:
+        """ETag of all the ducks, which changes with every record_change()"""
+
+
+class MongoDuckStore(DuckStore):
+    """Ducks in a MongoDB collection, and the change count in `counters`
+
+    DuckApp replaces both collections after a fork (see DuckApp.connect()).
+    """
+
+    def __init__(self, collection: Collection, counters: Collection, indexes: List[Any]) -> None:
+        self.collection = collection
+        self.counters = counters
+        self.indexes = indexes
+
+    def ensure_indexes(self) -> None:
+        """Create the indexes (does nothing for those that already exist)
+
+        Also gives search keys to the ducks that have none, i.e., those added
+        before search existed.
+
+        Raises:
+            DuplicateKeyError: If two ducks already have the same name.
+        """
+        self.collection.create_indexes(self.indexes)
+        missing = self.collection.find({SEARCH_FIELD: {"$exists": False}}, {"name": 1})
+        for batch in batches(missing):
+            self.collection.bulk_write(backfill_updates(batch), ordered=False)
+
+    def set_validator(self, schema: Dict[str, Any]) -> None:
+        """Make MongoDB check every write, from any client, see validator_options()"""
+        self.collection.database.command(
+            "collMod", self.collection.name, **validator_options(schema)
+        )
+
+    def clear(self) -> None:
+        self.collection.delete_many({})
+
+    def get(self, name: str, fields: Optional[List[str]] = None) -> Optional[Duck]:
+        return self.collection.find_one({"name": name}, mongo_projection(fields))
+
+    def find(self, duck_type: Optional[str] = None) -> Iterable[Duck]:
+        return self.collection.find(type_filter(duck_type), mongo_projection(None))
+
+    def find_page(
+        self,
+        duck_type: Optional[str],
+        after: Optional[str],
+        limit: int,
+        fields: Optional[List[str]],
+    ) -> Dict[str, Any]:
+        query = page_filter(duck_type, after)
+        # Fetch one extra duck to know whether there is a next page
+        cursor = self.collection.find(query, mongo_projection(fields))
+        return page(list(cursor.sort("_id", ASCENDING).limit(limit + 1)), limit)
+
+    def search(self, query: str, limit: int) -> List[Duck]:
+        return rank(list(self.collection.aggregate(search_pipeline(query, limit))), query)
+
+    def insert(self, duck: Duck) -> None:
+        try:
+            self.collection.insert_one(indexed(duck))
+        except DuplicateKeyError:
+            raise DuplicateDuck(duck["name"]) from None
+
+    def write_batch(self, batch: List[Item], report: BulkReport) -> List[Duck]:
+        return write_batch(self.collection, batch, report)
+
+    def update(self, name: str, changes: Duck, etags: Optional[Set[str]]) -> Optional[Duck]:
+        return self.collection.find_one_and_update(
+            update_filter(name, changes, etags),
+            update_document(changes),
+            projection=UPDATE_PROJECTION,
+            return_document=ReturnDocument.BEFORE,
+        )
+
+    def delete(self, name: str, etags: Optional[Set[str]]) -> Optional[Duck]:
+        return self.collection.find_one_and_delete(
+            delete_filter(name, etags), projection=DELETE_PROJECTION
+        )
+
+    def stats_groups(self, duck_type: Optional[str] = None) -> List[Duck]:
+        return list(self.collection.aggregate(stats_pipeline(duck_type)))
+
+    def record_change(self) -> None:
+        """Count a change in the database, so every server process sees the others' changes"""
+        self.counters.update_one(COUNTER, change_update(), upsert=True)
+
+    def etag(self) -> str:
+        counter = self.counters.find_one(COUNTER)
+        if counter is None:
+            self.counters.update_one(COUNTER, counter_start(), upsert=True)
+            counter = self.counters.find_one(COUNTER)
+        return counter_etag(counter)
+
+
+class AsyncMongoDuckStore:
+    """MongoDuckStore for the async app: the same queries, sent with pymongo's async API
+
+    Its methods are the coroutines of DuckStore's, except find(), which
+    returns an async cursor.
+    """
+
+    def __init__(
+        self, collection: AsyncCollection, counters: AsyncCollection, indexes: List[Any]
+    ) -> None:
+        self.collection = collection
+        self.counters = counters
+        self.indexes = indexes
+
+    async def ensure_indexes(self) -> None:
+        """See MongoDuckStore.ensure_indexes()"""
+        await self.collection.create_indexes(self.indexes)
+        missing = self.collection.find({SEARCH_FIELD: {"$exists": False}}, {"name": 1})
+        async for batch in async_batches(missing):
+            await self.collection.bulk_write(backfill_updates(batch), ordered=False)
+
+    async def set_validator(self, schema: Dict[str, Any]) -> None:
+        await self.collection.database.command(
+            "collMod", self.collection.name, **validator_options(schema)
+        )
+
+    async def clear(self) -> None:
+        await self.collection.delete_many({})
+
+    async def get(self, name: str, fields: Optional[List[str]] = None) -> Optional[Duck]:
+        return await self.collection.find_one({"name": name}, mongo_projection(fields))
+
+    def find(self, duck_type: Optional[str] = None) -> AsyncCursor:
+        return self.collection.find(type_filter(duck_type), mongo_projection(None))
+
+    async def find_page(
+        self,
+        duck_type: Optional[str],
+        after: Optional[str],
+        limit: int,
+        fields: Optional[List[str]],
+    ) -> Dict[str, Any]:
+        query = page_filter(duck_type, after)
+        cursor = self.collection.find(query, mongo_projection(fields))
+        return page(await cursor.sort("_id", ASCENDING).limit(limit + 1).to_list(), limit)
+
+    async def search(self, query: str, limit: int) -> List[Duck]:
+        cursor = await self.collection.aggregate(search_pipeline(query, limit))
+        return rank(await cursor.to_list(), query)
+
+    async def insert(self, duck: Duck) -> None:
+        try:
+            await self.collection.insert_one(indexed(duck))
+        except DuplicateKeyError:
+            raise DuplicateDuck(duck["name"]) from None
+
+    async def write_batch(self, batch: List[Item], report: BulkReport) -> List[Duck]:
+        return await write_batch_async(self.collection, batch, report)
+
+    async def update(
+        self, name: str, changes: Duck, etags: Optional[Set[str]]
+    ) -> Optional[Duck]:
+        return await self.collection.find_one_and_update(
+            update_filter(name, changes, etags),
+            update_document(changes),
+            projection=UPDATE_PROJECTION,
+            return_document=ReturnDocument.BEFORE,
+        )
+
+    async def delete(self, name: str, etags: Optional[Set[str]]) -> Optional[Duck]:
+        return await self.collection.find_one_and_delete(
+            delete_filter(name, etags), projection=DELETE_PROJECTION
+        )
+
+    async def stats_groups(self, duck_type: Optional[str] = None) -> List[Duck]:
+        cursor = await self.collection.aggregate(stats_pipeline(duck_type))
+        return await cursor.to_list()
+
+    async def record_change(self) -> None:
+        await self.counters.update_one(COUNTER, change_update(), upsert=True)
+
+    async def etag(self) -> str:
+        counter = await self.counters.find_one(COUNTER)
+        if counter is None:
+            await self.counters.update_one(COUNTER, counter_start(), upsert=True)
+            counter = await self.counters.find_one(COUNTER)
+        return counter_etag(counter)
+
+
+class MemoryDuckStore(DuckStore):
+    """Ducks in this process, indexed by _id, by name and by type
+
+    New ducks get increasing ObjectIds, so the _id lists stay sorted by
+    appending, and a page starts with a binary search for its `after`. The
+    search index is a sorted list of (key, _id), where a search starts with
+    a binary search for its query.
+    Every operation holds one lock, which makes each write atomic like
+    MongoDB's single-document writes.
+    """
+
+    def __init__(self) -> None:
+        self._ducks: Dict[ObjectId, Duck] = {}
+        self._ids_by_name: Dict[Any, ObjectId] = {}
+        # All the _ids, and the _ids of each type, in ascending order
+        self._ids: List[ObjectId] = []
+        self._ids_by_type: Dict[Any, List[ObjectId]] = {}
+        self._search_keys: List[Tuple[str, ObjectId]] = []
+        self._epoch = uuid.uuid4().hex
+        self._changes = 0
+        self._lock = threading.RLock()
+
+    def set_validator(self, schema: Dict[str, Any]) -> None:
+        """Nothing to do: only the app writes here, and it validates every duck"""
+
+    def clear(self) -> None:
+        with self._lock:
+            self._ducks.clear()
+            self._ids_by_name.clear()
+            self._ids.clear()
+            self._ids_by_type.clear()
+            self._search_keys.clear()
+
+    def get(self, name: str, fields: Optional[List[str]] = None) -> Optional[Duck]:
+        with self._lock:
+            duck_id = self._ids_by_name.get(name)
+            return project(self._ducks[duck_id], fields) if duck_id is not None else None
+
+    def find(self, duck_type: Optional[str] = None) -> Iterable[Duck]:
+        with self._lock:
+            ids = list(self._ids if duck_type is None else self._ids_by_type.get(duck_type, []))
+        # Like a cursor, skip the ducks deleted while the caller iterates
+        return (dict(duck) for duck in map(self._ducks.get, ids) if duck is not None)
+
+    def find_page(
+        self,
+        duck_type: Optional[str],
+        after: Optional[str],
+        limit: int,
+        fields: Optional[List[str]],
+    ) -> Dict[str, Any]:
+        start_after = ObjectId(after) if after is not None else None
+        with self._lock:
+            ids = self._ids if duck_type is None else self._ids_by_type.get(duck_type, [])
+            start = bisect_right(ids, start_after) if start_after is not None else 0
+            ids = ids[start:start + limit + 1]
+            ducks = [project(self._ducks[duck_id], fields) for duck_id in ids]
+        return page(ducks, limit)
+
+    def search(self, query: str, limit: int) -> List[Duck]:
+        with self._lock:
+            ids: List[ObjectId] = []
+            position = bisect_left(self._search_keys, (query,))
+            last_key = None
+            while position < len(self._search_keys):
+                key, duck_id = self._search_keys[position]
+                # Past `limit` ducks, only those tied with the last one may still rank higher
+                if not key.startswith(query) or (len(ids) >= limit and key != last_key):
+                    break
+                # A name can match by several keys ("duck duck")
+                if duck_id not in ids:
+                    ids.append(duck_id)
+                    last_key = key
+                position += 1
+            ducks = [dict(self._ducks[duck_id]) for duck_id in ids]
+        return rank(ducks, query)[:limit]
+
+    def insert(self, duck: Duck) -> None:
+        with self._lock:
+            self._insert(duck)
+
+    def write_batch(self, batch: List[Item], report: BulkReport) -> List[Duck]:
+        inserted = []
+        with self._lock:
+            for position, duck in batch:
+                try:
+                    self._insert(duck, sort_keys=False)
+                except DuplicateDuck:
+                    report.error(position, f"Duck '{duck['name']}' already exists")
+                except TypeError:
+                    report.error(position, "_id must be an ObjectId")
+                else:
+                    report.inserted += 1
+                    inserted.append(duck)
+            # One sort merges the batch's keys, instead of shifting the list for each one
+            self._search_keys.sort()
+        return inserted
+
+    def update(self, name: str, changes: Duck, etags: Optional[Set[str]]) -> Optional[Duck]:
+        with self._lock:
+            duck_id = self._ids_by_name.get(name)
+            if duck_id is None:
+                return None
+            duck = self._ducks[duck_id]
+            if all(duck.get(field) == value for field, value in changes.items()):
+                return None
+            if etags is not None and duck_etag(duck) not in etags:
+                return None
+            after = {**duck, **changes, "version": duck.get("version", 0) + 1}
+            self._ducks[duck_id] = after
+            if after.get("type") != duck.get("type"):
+                self._unindex_type(duck)
+                insort(self._ids_by_type.setdefault(after.get("type"), []), duck_id)
+            return project(duck, ["version", "type", "value"])
+
+    def delete(self, name: str, etags: Optional[Set[str]]) -> Optional[Duck]:
+        with self._lock:
+            duck_id = self._ids_by_name.get(name)
+            if duck_id is None:
+                return None
+            duck = self._ducks[duck_id]
+            if etags is not None and duck_etag(duck) not in etags:
+                return None
+            self._remove(duck)
+            return project(duck, ["type", "value"])
+
+    def stats_groups(self, duck_type: Optional[str] = None) -> List[Duck]:
+        with self._lock:
+            types = sorted(self._ids_by_type, key=str) if duck_type is None else [duck_type]
+            groups = []
+            for group_type in types:
+                ids = self._ids_by_type.get(group_type, [])
+                if not ids:
+                    continue
+                values = (numeric_value(self._ducks[i].get("value")) for i in ids)
+                numbers = [number for number in values if number is not None]
+                groups.append({
+                    "_id": group_type,
+                    "count": len(ids),
+                    "valued": len(numbers),
+                    "total": sum(numbers),
+                    "min": min(numbers) if numbers else None,
+                    "max": max(numbers) if numbers else None,
+                })
+        return groups
+
+    def record_change(self) -> None:
+        with self._lock:
+            self._changes += 1
+
+    def etag(self) -> str:
+        return f"{self._epoch}-{self._changes}"
+
+    def _insert(self, duck: Duck, sort_keys: bool = True) -> None:
+        """Add a duck, setting its _id (the caller holds the lock)
+
+        Either the duck and all its index entries are added, or nothing is:
+        everything is checked and found first, then the store is changed.
+        With sort_keys=False, its search keys are appended: the caller must
+        sort them before releasing the lock.
+
+        Raises:
+            DuplicateDuck: If a duck with the same name exists.
+            TypeError: If the duck has an _id that is not an ObjectId, which
+                could not be sorted with the others.
+        """
+        if duck["name"] in self._ids_by_name:
+            raise DuplicateDuck(duck["name"])
+        duck_id = duck.get("_id", ObjectId())
+        if not isinstance(duck_id, ObjectId):
+            raise TypeError("_id must be an ObjectId")
+        type_ids = self._ids_by_type.get(duck.get("type"), [])
+        keys = [(key, duck_id) for key in search_keys(duck["name"])]
+        position = bisect_right(self._ids, duck_id)
+        type_position = bisect_right(type_ids, duck_id)
+        key_positions = [bisect_right(self._search_keys, key) for key in keys] if sort_keys else []
+
+        duck["_id"] = duck_id
+        self._ducks[duck_id] = dict(duck)
+        self._ids_by_name[duck["name"]] = duck_id
+        self._ids.insert(position, duck_id)
+        self._ids_by_type.setdefault(duck.get("type"), type_ids).insert(type_position, duck_id)
+        if sort_keys:
+            # Insert from the last position, so the earlier positions stay right
+            for key_position, key in sorted(zip(key_positions, keys), reverse=True):
+                self._search_keys.insert(key_position, key)
+        else:
+            self._search_keys.extend(keys)
+
+    def _remove(self, duck: Duck) -> None:
+        """Drop a duck and its index entries (the caller holds the lock)"""
+        del self._ducks[duck["_id"]]
+        del self._ids_by_name[duck["name"]]
+        del self._ids[bisect_right(self._ids, duck["_id"]) - 1]
+        for key in search_keys(duck["name"]):
+            del self._search_keys[bisect_left(self._search_keys, (key, duck["_id"]))]
+        self._unindex_type(duck)
+
+    def _unindex_type(self, duck: Duck) -> None:
+        """Drop a duck from the index of its type (the caller holds the lock)"""
+        ids = self._ids_by_type[duck.get("type")]
+        del ids[bisect_right(ids, duck["_id"]) - 1]
+        if not ids:
+            del self._ids_by_type[duck.get("type")]
@@ -0,0 +1,98 @@
+"""Streaming JSON encoders for large duck listings.
+
+jsonify() needs the whole result as a Python list and then builds the whole
+response body as one string, so a big listing is held in memory several
+times over. These generators read the pymongo cursor one batch at a time
+and yield the encoded text of each batch as soon as it is ready, so the
+memory used stays the same however many ducks are sent.
+"""
+
+from itertools import islice
+from typing import Any, AsyncIterator, Callable, Dict, Iterable, Iterator, List
+
+from pymongo.asynchronous.cursor import AsyncCursor
+from pymongo.cursor import Cursor
+
+# Documents fetched from MongoDB per round trip, and encoded per chunk
+STREAM_BATCH_SIZE = 1000
+
+# Content types of the streaming formats
+MIMETYPES = {
+    "json": "application/json",
+    "ndjson": "application/x-ndjson",
+}
+
+
+def batches(cursor: Iterable[Dict[str, Any]]) -> Iterator[List[Dict[str, Any]]]:
+    """Read a cursor (or any iterable of ducks) STREAM_BATCH_SIZE documents at a time"""
+    if isinstance(cursor, Cursor):
+        cursor.batch_size(STREAM_BATCH_SIZE)
+    documents = iter(cursor)
+    try:
+        while batch := list(islice(documents, STREAM_BATCH_SIZE)):
+            yield batch
+    finally:
+        # Also frees the server-side cursor when the client disconnects early
+        if isinstance(cursor, Cursor):
+            cursor.close()
+
+
+def iter_json_array(
+    cursor: Iterable[Dict[str, Any]], dumps: Callable[[Any], str]
+) -> Iterator[str]:
+    """Encode the documents of a cursor as one JSON array, a batch at a time"""
+    separator = "["
+    for batch in batches(cursor):
+        # One call per batch: encode it as an array and drop the brackets
+        yield separator + dumps(batch)[1:-1]
+        separator = ","
+    # An empty result still needs its opening bracket
+    yield "[]" if separator == "[" else "]"
+
+
+def iter_ndjson(cursor: Iterable[Dict[str, Any]], dumps: Callable[[Any], str]) -> Iterator[str]:
+    """Encode the documents of a cursor as newline-delimited JSON, one per line"""
+    for batch in batches(cursor):
+        yield "".join(dumps(duck) + "\n" for duck in batch)
+
+
+ENCODERS: Dict[str, Callable[[Iterable[Dict[str, Any]], Callable[[Any], str]], Iterable[str]]] = {
+    "json": iter_json_array,
+    "ndjson": iter_ndjson,
+}
+
+
+# The same encoders for the async cursors of async_app.py
+
+
+async def async_batches(cursor: AsyncCursor) -> AsyncIterator[List[Dict[str, Any]]]:
+    """batches() for an async cursor"""
+    cursor.batch_size(STREAM_BATCH_SIZE)
+    try:
+        while batch := await cursor.to_list(STREAM_BATCH_SIZE):
+            yield batch
+    finally:
+        await cursor.close()
+
+
+async def aiter_json_array(
+    cursor: AsyncCursor, dumps: Callable[[Any], str]
+) -> AsyncIterator[str]:
+    """iter_json_array() for an async cursor"""
+    separator = "["
+    async for batch in async_batches(cursor):
+        yield separator + dumps(batch)[1:-1]
+        separator = ","
+    yield "[]" if separator == "[" else "]"
+
+
+async def aiter_ndjson(cursor: AsyncCursor, dumps: Callable[[Any], str]) -> AsyncIterator[str]:
+    """iter_ndjson() for an async cursor"""
+    async for batch in async_batches(cursor):
+        yield "".join(dumps(duck) + "\n" for duck in batch)
+
+
+ASYNC_ENCODERS: Dict[str, Callable[[AsyncCursor, Callable[[Any], str]], AsyncIterator[str]]] = {
+    "json": aiter_json_array,
+    "ndjson": aiter_ndjson,
+}
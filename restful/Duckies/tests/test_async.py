@@ -0,0 +1,226 @@
+from typing import Dict, Any, Awaitable, Callable, List, cast
+import asyncio
+import json
+import pytest
+import threading
+from quart.testing import QuartClient
+from async_app import AsyncDuckApp
+from events import AsyncSubscription, EventHub, async_sse_stream
+
+AsyncTest = Callable[[QuartClient], Awaitable[None]]
+
+
+def run_with_client(test: AsyncTest) -> None:
+    """Run an async test with a client of a fresh AsyncDuckApp
+
+    The app is created inside the event loop, as AsyncMongoClient must be
+    used on the loop it was first used on.
+    """
+
+    async def main() -> None:
+        duck_app = AsyncDuckApp(test_mode=True)
+        # Clear the test database before each test
+        await duck_app.store.clear()
+        await duck_app.prepare_store()
+        await test(duck_app.app.test_client())
+        await duck_app.client.close()
+
+    asyncio.run(main())
+
+
+@pytest.fixture
+def sample_duck() -> Dict[str, Any]:
+    """Sample duck data for testing"""
+    return {
+        "name": "test_duck",
+        "type": "collectible",
+        "value": 10,
+        "test_marker": True,
+    }
+
+
+def test_add_and_get_duck(sample_duck: Dict[str, Any]) -> None:
+    """Test adding a duck and getting it back, then getting 304 with its ETag"""
+
+    async def test(client: QuartClient) -> None:
+        response = await client.post("/add_duck", json=sample_duck)
+        assert response.status_code == 201
+
+        response = await client.get(f"/ducks/{sample_duck['name']}")
+        assert response.status_code == 200
+        data = cast(Dict[str, Any], await response.get_json())
+        assert data["name"] == sample_duck["name"]
+        assert isinstance(data["_id"], str)
+        assert "test_marker" not in data
+
+        etag = response.headers["ETag"]
+        response = await client.get(
+            f"/ducks/{sample_duck['name']}", headers={"If-None-Match": etag}
+        )
+        assert response.status_code == 304
+
+        response = await client.post("/add_duck", json=sample_duck)
+        assert response.status_code == 409
+
+    run_with_client(test)
+
+
+def test_update_and_delete_duck(sample_duck: Dict[str, Any]) -> None:
+    """Test PUT and DELETE, with and without a matching If-Match header"""
+
+    async def test(client: QuartClient) -> None:
+        await client.post("/add_duck", json=sample_duck)
+        response = await client.get(f"/ducks/{sample_duck['name']}")
+        etag = response.headers["ETag"]
+
+        response = await client.put(
+            f"/ducks/{sample_duck['name']}", json={"value": 20}, headers={"If-Match": etag}
+        )
+        assert response.status_code == 200
+        assert response.headers["ETag"] != etag
+
+        response = await client.put(
+            f"/ducks/{sample_duck['name']}", json={"value": 30}, headers={"If-Match": etag}
+        )
+        assert response.status_code == 412
+
+        response = await client.put(f"/ducks/{sample_duck['name']}", json={"value": 20})
+        data = cast(Dict[str, Any], await response.get_json())
+        assert data["message"] == "No changes made"
+
+        response = await client.delete(f"/ducks/{sample_duck['name']}")
+        assert response.status_code == 200
+        response = await client.get(f"/ducks/{sample_duck['name']}")
+        assert response.status_code == 404
+
+    run_with_client(test)
+
+
+def test_bulk_stream_and_page() -> None:
+    """Test adding ducks from NDJSON, then streaming and paging through them"""
+
+    async def test(client: QuartClient) -> None:
+        lines = [json.dumps({"name": f"duck{i}", "type": "rubber", "value": i + 1}) for i in range(5)]
+        body = "\n".join(lines + ["not json", lines[0]])
+        response = await client.post(
+            "/ducks/bulk", data=body, headers={"Content-Type": "application/x-ndjson"}
+        )
+        report = cast(Dict[str, Any], await response.get_json())
+        assert report["received"] == 7
+        assert report["inserted"] == 5
+        assert [error["index"] for error in report["errors"]] == [5, 6]
+
+        response = await client.get("/ducks?stream=ndjson")
+        assert response.mimetype == "application/x-ndjson"
+        body = await response.get_data(as_text=True)
+        ducks = [json.loads(line) for line in body.splitlines()]
+        assert [duck["name"] for duck in ducks] == [f"duck{i}" for i in range(5)]
+
+        response = await client.get("/ducks?stream=json")
+        assert len(json.loads(await response.get_data(as_text=True))) == 5
+
+        response = await client.get("/ducks?limit=3")
+        page = cast(Dict[str, Any], await response.get_json())
+        assert len(page["ducks"]) == 3
+        response = await client.get(f"/ducks?limit=3&after={page['next']}")
+        page = cast(Dict[str, Any], await response.get_json())
+        assert [duck["name"] for duck in page["ducks"]] == ["duck3", "duck4"]
+        assert page["next"] is None
+
+    run_with_client(test)
+
+
+def test_duck_stats() -> None:
+    """Test the statistics, and 304 on the collection's ETag until a write"""
+
+    async def test(client: QuartClient) -> None:
+        ducks: List[Dict[str, Any]] = [
+            {"name": "a", "type": "rubber", "value": 2},
+            {"name": "b", "type": "rubber", "value": 4},
+            {"name": "c", "type": "wooden", "value": 9},
+        ]
+        await client.post("/ducks/bulk", json=ducks)
+
+        response = await client.get("/ducks/stats")
+        data = cast(Dict[str, Any], await response.get_json())
+        assert data["count"] == 3
+        assert data["total_value"] == 15
+        assert [group["type"] for group in data["types"]] == ["rubber", "wooden"]
+
+        response = await client.get("/ducks/type/rubber/stats")
+        data = cast(Dict[str, Any], await response.get_json())
+        assert data["avg_value"] == 3
+        assert data["min_value"] == 2
+
+        etag = response.headers["ETag"]
+        headers = {"If-None-Match": etag}
+        response = await client.get("/ducks/type/rubber/stats", headers=headers)
+        assert response.status_code == 304
+        await client.delete("/ducks/a")
+        response = await client.get("/ducks/type/rubber/stats", headers=headers)
+        assert response.status_code == 200
+
+    run_with_client(test)
+
+
+def test_search_ducks() -> None:
+    """Test the typeahead search, and that the search keys are never returned"""
+
+    async def test(client: QuartClient) -> None:
+        ducks = [{"name": name, "type": "rubber", "value": 1} for name in ["Big Duck", "duckling"]]
+        await client.post("/ducks/bulk", json=ducks)
+        await client.post("/add_duck", json={"name": "Duck", "type": "rubber", "value": 1})
+
+        response = await client.get("/ducks/search?q=DUCK")
+        found = cast(List[Dict[str, Any]], await response.get_json())
+        assert [duck["name"] for duck in found] == ["Duck", "Big Duck", "duckling"]
+        assert all("search" not in duck for duck in found)
+        listing = cast(List[Dict[str, Any]], await (await client.get("/ducks")).get_json())
+        assert all("search" not in duck for duck in listing)
+        assert (await client.get("/ducks/search?q=--")).status_code == 400
+
+    run_with_client(test)
+
+
+def test_async_subscription() -> None:
+    """Test that a coroutine gets the events published from other threads, without a thread"""
+
+    async def main() -> None:
+        hub = EventHub()
+        subscription = AsyncSubscription()
+        hub.subscribe(None, subscription)
+        assert await subscription.get_async(0.01) == (False, [])
+
+        publisher = threading.Timer(0.05, hub.publish, [{"op": "delete", "_id": 1}])
+        publisher.start()
+        reset, events = await subscription.get_async(5)
+        publisher.join()
+        assert not reset and [event for _, event in events] == [{"op": "delete", "_id": 1}]
+
+        stream = async_sse_stream(hub, subscription, json.dumps)
+        assert await stream.__anext__() == "retry: 3000\n\n"
+        hub.publish({"op": "delete", "_id": 2})
+        assert (await stream.__anext__()).endswith('event: delete\ndata: {"_id": 2}\n\n')
+        await stream.aclose()
+        assert hub.subscriber_count() == 0
+
+    asyncio.run(main())
+
+
+def test_duck_events(sample_duck: Dict[str, Any]) -> None:
+    """Test that writes are streamed from /ducks/events, as in app.py"""
+
+    async def test(client: QuartClient) -> None:
+        async with client.request("/ducks/events") as connection:
+            await connection.send_complete()
+            await client.post("/add_duck", json=sample_duck)
+            await client.put(f"/ducks/{sample_duck['name']}", json={"value": 2})
+            await client.delete(f"/ducks/{sample_duck['name']}")
+            data = b""
+            while data.count(b"event: ") < 3:
+                data += await connection.receive()
+            await connection.disconnect()
+        events = [line for line in data.decode().split("\n") if line.startswith("event: ")]
+        assert events == ["event: insert", "event: update", "event: delete"]
+
+    run_with_client(test)
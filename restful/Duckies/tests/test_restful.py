@@ -1,16 +1,48 @@
 from typing import Dict, Any, List, cast
+import datetime
+import json
+import os
 import pytest
+from bson.decimal128 import Decimal128
 from flask.testing import FlaskClient
+from pymongo.monitoring import (
+    ConnectionCheckedInEvent,
+    ConnectionCheckedOutEvent,
+    ConnectionCheckOutFailedEvent,
+    ConnectionCheckOutStartedEvent,
+    ConnectionCreatedEvent,
+)
 from app import DuckApp
+from bulk import BulkReport
+from cache import LRUCache, MemoryStore, SharedCache
+from clients import PoolMetrics, available_compressors, client_options, get_client
+from events import EventHub, change_to_event
+from schema import DUCK_SCHEMA, DUCK_VALIDATOR, json_schema
+from search import normalize, search_keys
+from stats import numeric_value
+from storage import MemoryDuckStore, MongoDuckStore
+
+
+@pytest.fixture(params=["mongo", "memory"])
+def duck_app(request: pytest.FixtureRequest) -> DuckApp:
+    """Create the app on each storage backend (see storage.py)"""
+    store = MemoryDuckStore() if request.param == "memory" else None
+    app = DuckApp(test_mode=True, store=store)
+    # Clear the test database before each test
+    app.store.clear()
+    return app
+
+
+def mongo_store(app: DuckApp) -> MongoDuckStore:
+    """The MongoDB store of an app created without a store"""
+    assert isinstance(app.store, MongoDuckStore)
+    return app.store
 
 
 @pytest.fixture
-def client() -> FlaskClient:
+def client(duck_app: DuckApp) -> FlaskClient:
     """Create a test client for the app"""
-    app = DuckApp(test_mode=True)
-    # Clear the test database before each test
-    app.collection.delete_many({})
-    return app.app.test_client()
+    return duck_app.app.test_client()
 
 
 @pytest.fixture
@@ -181,3 +213,684 @@ def test_get_ducks_by_type_with_data(
     assert len(data) == 1
     assert data[0]["name"] == sample_duck["name"]
     assert data[0]["type"] == sample_duck["type"]
+
+
+def test_get_ducks_paginated(client: FlaskClient) -> None:  # noqa
+    """Test walking through all ducks one page at a time"""
+    for i in range(5):
+        client.post("/add_duck", json={"name": f"duck_{i}", "type": "rubber", "value": i + 1})
+
+    names = []
+    after = None
+    while True:
+        url = "/ducks?limit=2" + (f"&after={after}" if after else "")
+        response = client.get(url)
+        assert response.status_code == 200
+        data = cast(Dict[str, Any], response.json)
+        assert len(data["ducks"]) <= 2
+        names += [duck["name"] for duck in data["ducks"]]
+        after = data["next"]
+        if after is None:
+            break
+    assert names == [f"duck_{i}" for i in range(5)]
+
+
+def test_get_ducks_fields(
+    client: FlaskClient, sample_duck: Dict[str, Any]  # noqa
+) -> None:
+    """Test getting only some fields of the ducks"""
+    client.post("/add_duck", json=sample_duck)
+
+    response = client.get("/ducks?fields=name,value")
+    assert response.status_code == 200
+    data = cast(Dict[str, Any], response.json)
+    assert data["next"] is None
+    assert set(data["ducks"][0]) == {"_id", "name", "value"}
+
+
+def test_get_ducks_invalid_page(client: FlaskClient) -> None:  # noqa
+    """Test getting a page with an invalid cursor or limit"""
+    assert client.get("/ducks?after=not-an-id").status_code == 400
+    assert client.get("/ducks?limit=0").status_code == 400
+    assert client.get("/ducks?limit=abc").status_code == 400
+
+
+def test_get_ducks_streamed(
+    client: FlaskClient, sample_duck: Dict[str, Any]  # noqa
+) -> None:
+    """Test streaming all ducks as a JSON array and as NDJSON"""
+    response = client.get("/ducks?stream=json")
+    assert response.status_code == 200
+    assert response.json == []
+
+    client.post("/add_duck", json=sample_duck)
+    client.post("/add_duck", json={"name": "other_duck", "type": "rubber", "value": 5})
+
+    response = client.get("/ducks?stream=json")
+    data = cast(List[Dict[str, Any]], response.json)
+    assert [duck["name"] for duck in data] == [sample_duck["name"], "other_duck"]
+
+    response = client.get(f"/ducks/type/{sample_duck['type']}?stream=ndjson")
+    assert response.mimetype == "application/x-ndjson"
+    lines = response.get_data(as_text=True).splitlines()
+    assert len(lines) == 1
+    assert json.loads(lines[0])["name"] == sample_duck["name"]
+
+    assert client.get("/ducks?stream=xml").status_code == 400
+
+
+def test_add_duck_duplicate_name(
+    client: FlaskClient, sample_duck: Dict[str, Any]  # noqa
+) -> None:
+    """Test adding a duck with a name that is already taken"""
+    assert client.post("/add_duck", json=dict(sample_duck)).status_code == 201
+    response = client.post("/add_duck", json=dict(sample_duck))
+    assert response.status_code == 409
+    data = cast(Dict[str, Any], response.json)
+    assert data["error"] == f"Duck '{sample_duck['name']}' already exists"
+
+
+def plan_stages(plan: Dict[str, Any]) -> List[str]:
+    """All the stages of an explain() query plan, e.g., ["FETCH", "IXSCAN"]"""
+    stages = [plan["stage"]] if "stage" in plan else []
+    children = [plan[key] for key in ("inputStage", "queryPlan") if key in plan]
+    children += plan.get("inputStages", [])
+    for child in children:
+        stages += plan_stages(child)
+    return stages
+
+
+@pytest.mark.parametrize(
+    "query",
+    [
+        {"name": "test_duck"},  # GET/PUT/DELETE /ducks/<name>, /find_duck
+        {"type": "collectible"},  # GET /ducks/type/<duck_type>
+        {"search": {"$regex": "^yellow d"}},  # GET /ducks/search
+    ],
+)
+def test_hot_queries_use_index(query: Dict[str, Any]) -> None:
+    """Test that the queries of the hot routes never scan the whole collection"""
+    app = DuckApp(test_mode=True)
+    plan = mongo_store(app).collection.find(query).explain()["queryPlanner"]["winningPlan"]
+    stages = plan_stages(plan)
+    assert "COLLSCAN" not in stages
+    assert "IXSCAN" in stages
+
+
+def test_add_ducks_bulk(client: FlaskClient) -> None:  # noqa
+    """Test adding a JSON array of ducks, some of them invalid"""
+    ducks = [
+        {"name": "bulk_1", "type": "rubber", "value": 1},
+        {"name": "bulk_2", "type": "rubber"},
+        {"name": "bulk_1", "type": "rubber", "value": 3},
+        "not a duck",
+        {"name": "bulk_3", "type": "wooden", "value": 4},
+    ]
+    response = client.post("/ducks/bulk", json=ducks)
+    assert response.status_code == 200
+    data = cast(Dict[str, Any], response.json)
+    assert data["received"] == 5
+    assert data["inserted"] == 2
+    errors = {error["index"]: error["error"] for error in data["errors"]}
+    assert errors == {
+        1: "Missing required fields: value",
+        2: "Duck 'bulk_1' already exists",
+        3: "Not a JSON object",
+    }
+
+    response = client.get("/ducks")
+    names = [duck["name"] for duck in cast(List[Dict[str, Any]], response.json)]
+    assert sorted(names) == ["bulk_1", "bulk_3"]
+
+
+def test_add_ducks_bulk_ndjson(client: FlaskClient) -> None:  # noqa
+    """Test adding ducks from newline-delimited JSON"""
+    lines = [json.dumps({"name": f"duck_{i}", "type": "rubber", "value": i + 1}) for i in range(3)]
+    body = "\n".join(lines[:2] + ["{not json"] + lines[2:]) + "\n"
+    response = client.post("/ducks/bulk", data=body, content_type="application/x-ndjson")
+    assert response.status_code == 200
+    data = cast(Dict[str, Any], response.json)
+    assert data["inserted"] == 3
+    assert data["errors"] == [{"index": 2, "error": "Invalid JSON"}]
+
+    assert client.post("/ducks/bulk", json={"name": "x"}).status_code == 400
+
+
+def test_update_duck_no_changes(
+    client: FlaskClient, sample_duck: Dict[str, Any]  # noqa
+) -> None:
+    """Test updating a duck with the values it already has"""
+    client.post("/add_duck", json=sample_duck)
+
+    response = client.put(f"/ducks/{sample_duck['name']}", json={"value": sample_duck["value"]})
+    assert response.status_code == 200
+    data = cast(Dict[str, Any], response.json)
+    assert data["message"] == "No changes made"
+
+
+def test_update_duck_if_match(
+    client: FlaskClient, sample_duck: Dict[str, Any]  # noqa
+) -> None:
+    """Test that an update with a stale ETag is refused"""
+    client.post("/add_duck", json=sample_duck)
+    etag = client.get(f"/ducks/{sample_duck['name']}").headers["ETag"]
+
+    # The first writer has the current version
+    response = client.put(
+        f"/ducks/{sample_duck['name']}", json={"value": 20}, headers={"If-Match": etag}
+    )
+    assert response.status_code == 200
+    assert response.headers["ETag"] != etag
+
+    # The second writer read the same version, which is now stale
+    response = client.put(
+        f"/ducks/{sample_duck['name']}", json={"value": 30}, headers={"If-Match": etag}
+    )
+    assert response.status_code == 412
+    response = client.delete(f"/ducks/{sample_duck['name']}", headers={"If-Match": etag})
+    assert response.status_code == 412
+
+    get_response = client.get(f"/ducks/{sample_duck['name']}")
+    assert cast(Dict[str, Any], get_response.json)["value"] == 20
+    response = client.delete(
+        f"/ducks/{sample_duck['name']}", headers={"If-Match": get_response.headers["ETag"]}
+    )
+    assert response.status_code == 200
+
+
+def test_duck_cache(
+    client: FlaskClient, sample_duck: Dict[str, Any]  # noqa
+) -> None:
+    """Test that GET /ducks/<name> is cached and that writes invalidate it"""
+    client.post("/add_duck", json=sample_duck)
+    url = f"/ducks/{sample_duck['name']}"
+    before = cast(Dict[str, Any], client.get("/metrics").json)["cache"]
+
+    client.get(url)
+    client.get(url)
+    client.put(url, json={"value": 99})
+    response = client.get(url)
+    assert cast(Dict[str, Any], response.json)["value"] == 99
+    client.delete(url)
+    assert client.get(url).status_code == 404
+
+    after = cast(Dict[str, Any], client.get("/metrics").json)["cache"]
+    assert after["hits"] - before["hits"] == 1
+    assert after["misses"] - before["misses"] == 3
+
+
+def test_lru_cache_eviction_and_ttl() -> None:
+    """Test that the LRU cache evicts the least recently used duck and expires old ones"""
+    cache = LRUCache(maxsize=2, ttl=60)
+    for name in ["a", "b", "a", "c"]:
+        cache.get_or_load(name, lambda: {"name": name})
+    assert cache.stats()["evictions"] == 1
+    assert cache.get_or_load("a", lambda: None) == {"name": "a"}
+    assert cache.get_or_load("b", lambda: None) is None
+
+    cache.ttl = -1
+    cache.get_or_load("d", lambda: {"name": "d"})
+    assert cache.get_or_load("d", lambda: None) is None
+
+
+def test_shared_cache() -> None:
+    """Test that an invalidation reaches every process sharing the store"""
+    store = MemoryStore()
+    first, second = SharedCache(store), SharedCache(store)
+    first.get_or_load("a", lambda: {"name": "a", "value": 1})
+    assert second.get_or_load("a", lambda: None) == {"name": "a", "value": 1}
+    second.invalidate("a")
+    assert first.get_or_load("a", lambda: None) is None
+
+
+def test_shared_cache_whole_second_ttl() -> None:
+    """Test that a fractional DUCK_CACHE_TTL still gives Redis a whole number of seconds"""
+    store = MemoryStore()
+    with pytest.raises(TypeError):
+        store.set("a", b"{}", ex=0.5)  # type: ignore[arg-type]
+    with pytest.raises(ValueError):
+        store.set("a", b"{}", ex=0)
+    cache = SharedCache(store, ttl=0.5)
+    cache.get_or_load("a", lambda: {"name": "a"})
+    assert cache.get_or_load("a", lambda: None) == {"name": "a"}
+
+
+def test_get_ducks_not_modified(
+    client: FlaskClient, sample_duck: Dict[str, Any]  # noqa
+) -> None:
+    """Test that polling an unchanged collection gets 304 Not Modified"""
+    client.post("/add_duck", json=sample_duck)
+    for url in ["/ducks", f"/ducks/type/{sample_duck['type']}", f"/ducks/{sample_duck['name']}"]:
+        etag = client.get(url).headers["ETag"]
+        response = client.get(url, headers={"If-None-Match": etag})
+        assert response.status_code == 304
+        assert response.data == b""
+
+    etag = client.get("/ducks").headers["ETag"]
+    duck_etag = client.get(f"/ducks/{sample_duck['name']}").headers["ETag"]
+    client.put(f"/ducks/{sample_duck['name']}", json={"value": 42})
+    response = client.get("/ducks", headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    assert cast(List[Dict[str, Any]], response.json)[0]["value"] == 42
+    response = client.get(f"/ducks/{sample_duck['name']}", headers={"If-None-Match": duck_etag})
+    assert response.status_code == 200
+
+
+def test_bson_types_encoded(duck_app: DuckApp) -> None:  # noqa
+    """Test that ObjectId, datetime and Decimal128 values are sent as JSON"""
+    app = duck_app
+    app.store.insert(
+        {
+            "name": "fancy_duck",
+            "type": "collectible",
+            "value": Decimal128("12.50"),
+            "added": datetime.datetime(2025, 5, 13, 3, 19, 7),
+        }
+    )
+    for use_orjson in [True, False]:
+        app.app.json.use_orjson = use_orjson  # type: ignore
+        data = cast(Dict[str, Any], app.app.test_client().get("/ducks/fancy_duck").json)
+        assert data["value"] == "12.50"
+        assert data["added"] == "2025-05-13T03:19:07"
+        data = cast(List[Dict[str, Any]], app.app.test_client().get("/ducks").json)
+        assert isinstance(data[0]["_id"], str)
+
+
+@pytest.mark.parametrize(
+    "backend, stats_counters", [("mongo", False), ("mongo", True), ("memory", False)]
+)
+def test_duck_stats(backend: str, stats_counters: bool) -> None:
+    """Test the statistics, computed by aggregation or kept up to date on writes"""
+    if backend == "mongo":
+        app = DuckApp(test_mode=True)
+        mongo_store(app).collection.delete_many({})
+        mongo_store(app).counters.delete_many({})
+        app = DuckApp(test_mode=True, stats_counters=stats_counters)
+    else:
+        app = DuckApp(test_mode=True, store=MemoryDuckStore())
+    client = app.app.test_client()
+
+    client.post("/add_duck", json={"name": "a", "type": "rubber", "value": 1})
+    client.post(
+        "/ducks/bulk",
+        json=[
+            {"name": "b", "type": "rubber", "value": 3},
+            {"name": "c", "type": "wooden", "value": "5"},
+            {"name": "d", "type": "wooden", "value": 2},
+        ],
+    )
+    client.put("/ducks/b", json={"value": 10})
+    client.delete("/ducks/d")
+
+    data = cast(Dict[str, Any], client.get("/ducks/stats").json)
+    assert data["count"] == 3
+    assert data["total_value"] == 16
+    assert data["avg_value"] == pytest.approx(16 / 3)
+    assert (data["min_value"], data["max_value"]) == (1, 10)
+    assert [group["type"] for group in data["types"]] == ["rubber", "wooden"]
+
+    # The numeric string from the form counts as a number
+    data = cast(Dict[str, Any], client.get("/ducks/type/wooden/stats").json)
+    assert data == {
+        "type": "wooden",
+        "count": 1,
+        "total_value": 5,
+        "avg_value": 5,
+        "min_value": 5,
+        "max_value": 5,
+    }
+    data = cast(Dict[str, Any], client.get("/ducks/type/plastic/stats").json)
+    assert data["count"] == 0
+
+
+@pytest.mark.parametrize(
+    "backend, stats_counters", [("mongo", False), ("mongo", True), ("memory", False)]
+)
+def test_duck_stats_value_types(backend: str, stats_counters: bool) -> None:
+    """Test that every backend counts numeric strings and Decimal128 values, and only those"""
+    if backend == "mongo":
+        app = DuckApp(test_mode=True)
+        mongo_store(app).collection.delete_many({})
+        mongo_store(app).counters.delete_many({})
+        app = DuckApp(test_mode=True, stats_counters=stats_counters)
+    else:
+        app = DuckApp(test_mode=True, store=MemoryDuckStore())
+    client = app.app.test_client()
+    client.post("/add_duck", json={"name": "a", "type": "rubber", "value": "2.5"})
+    client.post("/ducks/bulk", json=[{"name": "b", "type": "rubber", "value": 4}])
+    # Ducks written without the app's validation, e.g., from mongosh
+    app.store.insert({"name": "c", "type": "rubber", "value": Decimal128("1.5")})
+    app.store.insert({"name": "d", "type": "rubber", "value": "lots"})
+    app.store.insert({"name": "e", "type": "rubber", "value": True})
+    if app.stats:
+        app.stats.record_insert([app.store.get(name) for name in "cde"])
+
+    data = cast(Dict[str, Any], client.get("/ducks/type/rubber/stats").json)
+    assert data["count"] == 5
+    assert (data["total_value"], data["avg_value"]) == (8, 8 / 3)
+    assert (data["min_value"], data["max_value"]) == (1.5, 4)
+    client.delete("/ducks/c")
+    data = cast(Dict[str, Any], client.get("/ducks/type/rubber/stats").json)
+    assert (data["total_value"], data["min_value"]) == (6.5, 2.5)
+
+
+def test_numeric_value() -> None:
+    """Test which values count towards the statistics, and as what"""
+    assert numeric_value(3) == 3
+    assert numeric_value("-1.5") == -1.5
+    assert numeric_value("1e3") == 1000
+    assert numeric_value(Decimal128("12.50")) == 12.5
+    for value in [True, None, "", "ten", " 1", "1_000", [1]]:
+        assert numeric_value(value) is None
+
+
+def test_client_shared_and_configured(monkeypatch: pytest.MonkeyPatch) -> None:
+    """Test that apps share one client, configured from app.ini and the environment"""
+    assert DuckApp(test_mode=True).client is DuckApp(test_mode=True).client
+
+    monkeypatch.setenv("MONGODB_MAX_POOL_SIZE", "7")
+    monkeypatch.setenv("MONGODB_COMPRESSORS", "no_such_compressor,zlib")
+    options = client_options()
+    assert options["maxPoolSize"] == 7
+    assert options["compressors"] == "zlib"
+    assert options["serverSelectionTimeoutMS"] == 5000
+    # Different options, different client
+    assert DuckApp(test_mode=True).client is not get_client("mongodb://localhost:27017")
+
+    data = cast(Dict[str, Any], DuckApp(test_mode=True).app.test_client().get("/metrics").json)
+    assert {"uri", "options", "open", "in_use", "checkouts"} <= set(data["mongodb"][0])
+
+
+def test_client_after_fork() -> None:
+    """Test that a forked worker drops its parent's client, and opens its own on first use"""
+    app = DuckApp(test_mode=True)
+    parent_client = app.client
+    read_end, write_end = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        dropped = app._client is None and app._store is None
+        os.write(write_end, b"new" if dropped and app.client is not parent_client else b"")
+        os._exit(0)
+    os.waitpid(pid, 0)
+    assert os.read(read_end, 3) == b"new"
+    assert app.client is parent_client
+
+
+def test_available_compressors(monkeypatch: pytest.MonkeyPatch) -> None:
+    """Test that zstd needs a module pymongo uses, not the zstandard package"""
+    installed = {"zlib", "zstandard"}
+
+    def import_module(name: str) -> None:
+        if name not in installed:
+            raise ImportError(name)
+
+    monkeypatch.setattr("clients.importlib.import_module", import_module)
+    assert available_compressors("zstd, snappy, zlib") == "zlib"
+    installed.add("backports.zstd")
+    assert available_compressors("zstd, snappy, zlib") == "zstd,zlib"
+
+
+def test_pool_metrics() -> None:
+    """Test the pool counters, fed with the events pymongo sends"""
+    metrics = PoolMetrics()
+    address = ("localhost", 27017)
+    metrics.connection_created(ConnectionCreatedEvent(address, 1))
+    metrics.connection_check_out_started(ConnectionCheckOutStartedEvent(address))
+    metrics.connection_checked_out(ConnectionCheckedOutEvent(address, 1, 0.002))
+    metrics.connection_check_out_started(ConnectionCheckOutStartedEvent(address))
+    stats = metrics.stats()
+    assert (stats["open"], stats["in_use"], stats["waiting"]) == (1, 1, 1)
+    metrics.connection_check_out_failed(ConnectionCheckOutFailedEvent(address, "timeout", 5.0))
+    metrics.connection_checked_in(ConnectionCheckedInEvent(address, 1))
+    stats = metrics.stats()
+    assert (stats["in_use"], stats["max_in_use"], stats["waiting"]) == (0, 1, 0)
+    assert (stats["checkouts"], stats["checkout_failures"], stats["avg_wait_ms"]) == (1, 1, 2.0)
+
+
+def test_duck_changes_type(client: FlaskClient) -> None:  # noqa
+    """Test that listings by type follow a duck whose type changes"""
+    for i in range(3):
+        client.post("/add_duck", json={"name": f"duck{i}", "type": "rubber", "value": i + 1})
+    client.put("/ducks/duck1", json={"type": "wooden"})
+    client.delete("/ducks/duck2")
+
+    rubber = cast(List[Dict[str, Any]], client.get("/ducks/type/rubber").json)
+    assert [duck["name"] for duck in rubber] == ["duck0"]
+    page = cast(Dict[str, Any], client.get("/ducks?limit=5&fields=type").json)
+    assert [duck["type"] for duck in page["ducks"]] == ["rubber", "wooden"]
+    assert set(page["ducks"][1]) == {"_id", "type"}
+    assert client.get("/ducks/type/plastic?stream=ndjson").data == b""
+
+
+def test_store_from_env(monkeypatch: pytest.MonkeyPatch) -> None:
+    """Test that DUCK_STORE chooses the storage backend"""
+    monkeypatch.setenv("DUCK_STORE", "memory")
+    assert isinstance(DuckApp(test_mode=True).store, MemoryDuckStore)
+    monkeypatch.setenv("DUCK_STORE", "floppy")
+    with pytest.raises(ValueError):
+        DuckApp(test_mode=True)
+
+
+def test_server_fields_rejected(client: FlaskClient) -> None:  # noqa
+    """Test that clients cannot set the _id, version or search keys of a duck"""
+    duck = {"name": "a", "type": "rubber", "value": 1}
+    for field, value in [("_id", "a"), ("version", 7), ("search", ["z"])]:
+        response = client.post("/add_duck", json={**duck, field: value})
+        assert response.status_code == 400
+        assert cast(Dict[str, Any], response.json)["error"] == f"{field} cannot be set by clients"
+    report = cast(Dict[str, Any], client.post("/ducks/bulk", json=[{**duck, "_id": 1}]).json)
+    assert report["inserted"] == 0
+    assert client.get("/ducks/a").status_code == 404
+
+
+def test_memory_insert_all_or_nothing() -> None:
+    """Test that a duck the memory store cannot index leaves no trace"""
+    store = MemoryDuckStore()
+    store.insert({"name": "a", "type": "rubber"})
+    with pytest.raises(TypeError):
+        store.insert({"_id": "b", "name": "b", "type": "rubber"})
+    assert store.get("b") is None
+    assert [duck["name"] for duck in store.find()] == ["a"]
+    store.insert({"name": "b", "type": "rubber"})
+
+    report = BulkReport()
+    batch = [(0, {"name": "c", "_id": 3}), (1, {"name": "d"}), (2, {"name": "b"})]
+    inserted = store.write_batch(batch, report)
+    assert [duck["name"] for duck in inserted] == ["d"]
+    assert [error["index"] for error in report.errors] == [0, 2]
+    assert [duck["name"] for duck in store.find()] == ["a", "b", "d"]
+    assert [duck["name"] for duck in store.search("d", 10)] == ["d"]
+
+
+def test_app_on_given_mongo_store() -> None:
+    """Test that DuckApp takes everything from a MongoDuckStore it is given"""
+    collections = mongo_store(DuckApp(test_mode=True)).collection.database
+    store = MongoDuckStore(collections["test_ducks"], collections["test_counters"], DuckApp.INDEXES)
+    store.clear()
+    store.counters.delete_many({})
+    client = DuckApp(test_mode=True, stats_counters=True, store=store).app.test_client()
+    client.post("/add_duck", json={"name": "a", "type": "rubber", "value": 1})
+    assert cast(Dict[str, Any], client.get("/ducks/stats").json)["count"] == 1
+
+
+def test_event_hub_replay() -> None:
+    """Test that a reconnecting subscriber gets the events it missed, or a reset"""
+    hub = EventHub(history_size=3)
+    for i in range(4):
+        hub.publish({"op": "delete", "_id": i})
+    reset, events = hub.subscribe(hub.event_id(2)).get(0)
+    assert not reset and [event["_id"] for _, event in events] == [2, 3]
+    # Too old, from another process, or garbage
+    for last_event_id in (hub.event_id(0), "0123456789ab-3", "nonsense"):
+        assert hub.subscribe(last_event_id).get(0) == (True, [])
+    subscription = hub.subscribe()
+    hub.publish({"op": "reset"})
+    assert subscription.get(0) == (False, [(5, {"op": "reset"})])
+    hub.unsubscribe(subscription)
+    assert hub.subscriber_count() == 4
+
+
+def test_change_to_event() -> None:
+    """Test the deltas made from change stream documents"""
+    key = {"_id": 1}
+    duck = {"_id": 1, "name": "a"}
+    insert = {"operationType": "insert", "documentKey": key, "fullDocument": duck}
+    assert change_to_event(insert) == {"op": "insert", "_id": 1, "duck": duck}
+    update = {
+        "operationType": "update",
+        "documentKey": key,
+        "updateDescription": {"updatedFields": {"value": 2}, "removedFields": ["color"]},
+    }
+    event = change_to_event(update)
+    assert event is not None and event["changes"] == {"value": 2, "color": None}
+    assert change_to_event({"operationType": "drop"}) == {"op": "reset"}
+
+    # The search keys never reach clients
+    update["updateDescription"] = {
+        "updatedFields": {"value": 3, "search": ["a"], "search.1": "b"},
+        "removedFields": ["search"],
+    }
+    event = change_to_event(update)
+    assert event is not None and event["changes"] == {"value": 3}
+    update["updateDescription"] = {"updatedFields": {"search": ["a"]}, "removedFields": []}
+    assert change_to_event(update) is None
+
+
+def test_duck_events(client: FlaskClient) -> None:  # noqa
+    """Test that writes are streamed from /ducks/events, and replayed on reconnect"""
+    response = client.get("/ducks/events", buffered=False)
+    assert response.mimetype == "text/event-stream"
+    client.post("/add_duck", json={"name": "a", "type": "rubber", "value": 1})
+    client.put("/ducks/a", json={"value": 2})
+    client.delete("/ducks/a")
+    chunks = (chunk.decode() for chunk in response.response)
+    assert next(chunks) == "retry: 3000\n\n"
+    messages = [next(chunks).split("\n") for _ in range(3)]
+    response.close()
+    assert [message[1] for message in messages] == [
+        "event: insert",
+        "event: update",
+        "event: delete",
+    ]
+    update = json.loads(messages[1][2].removeprefix("data: "))
+    assert update["changes"] == {"value": 2, "version": 2}
+
+    # Reconnect after the insert
+    last_event_id = messages[0][0].removeprefix("id: ")
+    response = client.get("/ducks/events", headers={"Last-Event-ID": last_event_id}, buffered=False)
+    chunks = (chunk.decode() for chunk in response.response)
+    next(chunks)
+    assert next(chunks).startswith(f"id: {messages[1][0].removeprefix('id: ')}\nevent: update")
+    response.close()
+
+
+def test_search_keys() -> None:
+    """Test how names and queries are split into words"""
+    assert search_keys("Big_Yellow Duck") == ["big yellow duck", "yellow duck", "duck"]
+    assert search_keys(42) == ["42"]
+    assert normalize("  big-YEL ") == "big yel"
+    assert normalize("?!") == ""
+
+
+def test_search_ducks(client: FlaskClient) -> None:  # noqa
+    """Test that search matches prefixes of the words of the names, best match first"""
+    names = ["Big Yellow Duck", "yellow", "Duck", "duck duck", "duckling", "Mallard"]
+    ducks = [{"name": name, "type": "rubber", "value": 1} for name in names]
+    client.post("/ducks/bulk", json=ducks[:3])
+    for duck in ducks[3:]:
+        client.post("/add_duck", json=duck)
+
+    def search(url: str) -> List[str]:
+        response = client.get(url)
+        assert response.status_code == 200
+        found = cast(List[Dict[str, Any]], response.json)
+        assert all("search" not in duck for duck in found)
+        return [duck["name"] for duck in found]
+
+    assert search("/ducks/search?q=duck") == [
+        "Duck",
+        "Big Yellow Duck",
+        "duck duck",
+        "duckling",
+    ]
+    assert search("/ducks/search?q=YEL") == ["yellow", "Big Yellow Duck"]
+    assert search("/ducks/search?q=big+yellow+d") == ["Big Yellow Duck"]
+    assert search("/ducks/search?q=yellow+big") == []
+    assert search("/ducks/search?q=d&limit=2") == ["Duck", "Big Yellow Duck"]
+
+    client.delete("/ducks/duck duck")
+    client.put("/ducks/Duck", json={"value": 2})
+    assert search("/ducks/search?q=duck") == ["Duck", "Big Yellow Duck", "duckling"]
+    listing = cast(List[Dict[str, Any]], client.get("/ducks").json)
+    assert all("search" not in duck for duck in listing)
+    assert client.get("/ducks/search?q=").status_code == 400
+    assert client.get("/ducks/search?q=duck&limit=101").status_code == 400
+
+
+def test_search_limit_keeps_best(client: FlaskClient) -> None:  # noqa
+    """Test that ?limit= keeps the best ranked ducks, not the first ones found"""
+    for name in ["zed duck", "big duck", "a duck", "Duck"]:
+        client.post("/add_duck", json={"name": name, "type": "rubber", "value": 1})
+
+    def search(url: str) -> List[str]:
+        return [duck["name"] for duck in cast(List[Dict[str, Any]], client.get(url).json)]
+
+    assert search("/ducks/search?q=duck&limit=1") == ["Duck"]
+    assert search("/ducks/search?q=duck&limit=2") == ["Duck", "a duck"]
+    client.delete("/ducks/Duck")
+    assert search("/ducks/search?q=du&limit=2") == ["a duck", "big duck"]
+
+    # Asking for the hidden search keys alone gives the _id alone
+    page = cast(Dict[str, Any], client.get("/ducks?fields=search").json)
+    assert all(set(duck) == {"_id"} for duck in page["ducks"])
+
+
+def test_search_backfill() -> None:
+    """Test that ducks added before search existed are given search keys at startup"""
+    duck_app = DuckApp(test_mode=True)
+    duck_app.store.clear()
+    mongo_store(duck_app).collection.insert_one({"name": "Old Duck", "type": "rubber", "value": 1})
+    client = DuckApp(test_mode=True).app.test_client()
+    found = cast(List[Dict[str, Any]], client.get("/ducks/search?q=old").json)
+    assert [duck["name"] for duck in found] == ["Old Duck"]
+
+
+def test_duck_schema() -> None:
+    """Test the validator compiled from DUCK_SCHEMA, and its $jsonSchema"""
+    duck = {"name": "a", "type": "rubber", "value": 0, "color": ["any"]}
+    assert DUCK_VALIDATOR.validate(duck) is None
+    assert DUCK_VALIDATOR.validate({**duck, "value": "-1.5"}) is None
+    assert DUCK_VALIDATOR.validate({"name": "a", "value": None}) == (
+        "Missing required fields: type, value"
+    )
+    assert DUCK_VALIDATOR.validate({**duck, "name": 7, "value": True}) == (
+        "name must be a non-empty string; value must be a number or a numeric string"
+    )
+    assert DUCK_VALIDATOR.validate(["a"]) == "Expected a JSON object"
+    assert DUCK_VALIDATOR.validate({"value": "ten"}, partial=True) is not None
+    assert DUCK_VALIDATOR.updates({"name": "b", "value": 2, "x": 1}) == {"value": 2}
+
+    schema = json_schema(DUCK_SCHEMA)
+    assert schema["required"] == ["name", "type", "value"]
+    assert schema["properties"]["value"]["anyOf"][1]["pattern"] == "^-?[0-9]+(\\.[0-9]+)?$"
+
+
+def test_schema_checked_on_writes(client: FlaskClient) -> None:  # noqa
+    """Test that add, bulk and PUT all reject ducks of the wrong types"""
+    response = client.post("/add_duck", json={"name": "a", "type": "rubber", "value": "ten"})
+    assert response.status_code == 400
+    response = client.post("/add_duck", json={"name": "a", "type": "rubber", "value": 0})
+    assert response.status_code == 201
+    assert client.post("/add_duck", json=["a"]).status_code == 400
+
+    response = client.put("/ducks/a", json={"value": None})
+    assert response.status_code == 400
+    assert cast(Dict[str, Any], response.json)["error"] == (
+        "value must be a number or a numeric string"
+    )
+    assert client.put("/ducks/a", json={"value": "12"}).status_code == 200
+
+    ducks = [{"name": "b", "type": "rubber", "value": 1}, {"name": "c", "type": 3, "value": 1}]
+    report = cast(Dict[str, Any], client.post("/ducks/bulk", json=ducks).json)
+    assert report["inserted"] == 1
+    assert report["errors"] == [{"index": 1, "error": "type must be a non-empty string"}]
@@ -38,6 +38,8 @@ def flask_app():
     test_port = find_free_port()
 
     app = DuckApp(test_mode=True)
+    # Duck names are unique, so start from an empty collection
+    app.store.clear()
 
     def run_app():
         app.run(port=test_port, debug=False)
@@ -0,0 +1,115 @@
+# @file: alias.py
+# @brief: Weighted random choice in O(1) time with Vose's alias method.
+#
+# random.choices(words, weights=...) adds up all the weights on every call, so
+# each draw costs O(n) for n words. The alias method does that work once: it
+# splits the total weight into n equal-sized buckets, each holding at most two
+# words (the bucket's own word and an "alias"). A draw then picks a bucket
+# uniformly and flips one biased coin to choose between its two words.
+
+import random
+from bisect import bisect
+from typing import Generic, List, Optional, Sequence, TypeVar
+
+Item = TypeVar("Item")
+
+
+class AliasTable(Generic[Item]):
+    """Items with weights, sampled in proportion to their weight.
+
+    Items can be added after the table is built. They go to a small "pending"
+    list that is sampled with a binary search; once it holds more than an
+    eighth of the items, everything is rebuilt into one alias table. This
+    keeps adding an item O(1) amortized and drawing O(1) (the pending list
+    stays small).
+    """
+
+    def __init__(self, items: Sequence[Item] = (), weights: Sequence[float] = ()) -> None:
+        self._items: List[Item] = []
+        self._weights: List[float] = []
+        # Alias table over the first len(self._probability) items
+        self._probability: List[float] = []
+        self._alias: List[int] = []
+        self._table_weight = 0.0
+        # Cumulative weights of the items added since the last rebuild
+        self._pending_cumulative: List[float] = []
+        for item, weight in zip(items, weights):
+            self._append(item, weight)
+        self._rebuild()
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    @property
+    def total_weight(self) -> float:
+        pending = self._pending_cumulative[-1] if self._pending_cumulative else 0.0
+        return self._table_weight + pending
+
+    def add(self, item: Item, weight: float = 1.0) -> None:
+        """Add an item with the given weight."""
+        self._append(item, weight)
+        pending = self._pending_cumulative[-1] if self._pending_cumulative else 0.0
+        self._pending_cumulative.append(pending + weight)
+        if len(self._pending_cumulative) > max(8, len(self._probability) // 8):
+            self._rebuild()
+
+    def sample(self, rng: Optional[random.Random] = None) -> Item:
+        """Draw one item, with probability proportional to its weight.
+
+        Args:
+            rng: Random number generator to use (default: the random module)
+
+        Raises:
+            IndexError: If the table is empty or all weights are zero.
+        """
+        total = self.total_weight
+        if total <= 0:
+            raise IndexError("Cannot sample from an empty alias table")
+        u = (rng or random).random() * total
+        if u >= self._table_weight:
+            position = bisect(self._pending_cumulative, u - self._table_weight)
+            position = min(position, len(self._pending_cumulative) - 1)
+            return self._items[len(self._probability) + position]
+        # Reuse the random number: its integer part picks the bucket and its
+        # fractional part is the coin flip inside the bucket
+        scaled = u / self._table_weight * len(self._probability)
+        bucket = min(int(scaled), len(self._probability) - 1)
+        if scaled - bucket < self._probability[bucket]:
+            return self._items[bucket]
+        return self._items[self._alias[bucket]]
+
+    def sample_many(self, count: int, rng: Optional[random.Random] = None) -> List[Item]:
+        """Draw `count` items independently."""
+        sample = self.sample
+        return [sample(rng) for _ in range(count)]
+
+    def _append(self, item: Item, weight: float) -> None:
+        if weight < 0:
+            raise ValueError(f"Negative weight {weight} for {item!r}")
+        self._items.append(item)
+        self._weights.append(weight)
+
+    def _rebuild(self) -> None:
+        """Build the alias table over all items (Vose's algorithm, O(n))."""
+        n = len(self._weights)
+        total = sum(self._weights)
+        self._probability = [1.0] * n
+        self._alias = list(range(n))
+        self._table_weight = total
+        self._pending_cumulative = []
+        if total <= 0:
+            return
+        # Scale so that the average weight is 1; split into small and large
+        scaled = [weight * n / total for weight in self._weights]
+        small = [i for i, p in enumerate(scaled) if p < 1.0]
+        large = [i for i, p in enumerate(scaled) if p >= 1.0]
+        while small and large:
+            under, over = small.pop(), large.pop()
+            # Bucket `under` holds that item with probability scaled[under], the rest is `over`
+            self._probability[under] = scaled[under]
+            self._alias[under] = over
+            scaled[over] -= 1.0 - scaled[under]
+            (small if scaled[over] < 1.0 else large).append(over)
+        # Whatever is left is (up to rounding errors) exactly one bucket full
+        for i in small + large:
+            self._probability[i] = 1.0
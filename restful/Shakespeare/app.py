@@ -1,27 +1,56 @@
 # @file: app.py
 # @brief: This is a simple Flask application that generates random Shakespearean insults.
 
-import random
-from flask import Flask, render_template
+import os
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from flask import Flask, Response, jsonify, render_template, request, session
 
 import vocab
+from export import ENCODERS, MIMETYPES, random_pairs
+from insult_space import insults, next_unique_insult
+from rng import stream, thread_rng
+from sampler import SEEDED_CHUNK_SIZE, sample_insults, sample_insults_seeded
+from weighted import weighted_insults
 
 # Instantiate the Flask application
 app = Flask(__name__)
+# The session cookie remembers where each client is in its no-repeats order
+app.config["SECRET_KEY"] = os.environ.get("SECRET_KEY", "your-secret-key-here")
 
-def generate_insult():
+# Largest batch a client can request from /insults in a single call
+MAX_BATCH = 10000
+
+# Largest number of random insults in a single streamed (ndjson/csv) response
+MAX_STREAM = 10000000
+
+# Threads used to generate large seeded batches. With the standard (GIL) build of
+# Python, threads take turns running Python code, so leave this at 1 unless you run
+# a free-threaded build, where each thread can use its own core.
+BATCH_WORKERS = int(os.environ.get("BATCH_WORKERS", "1"))
+batch_executor = ThreadPoolExecutor(BATCH_WORKERS) if BATCH_WORKERS > 1 else None
+
+def generate_insult(no_repeats=None):
     """Generate a random Shakespearean insult.
     This function randomly selects words from three columns of a vocabulary
     list and combines them into a Shakespearean-style insult.
     The insult is prefixed with "Thou" and ends with an exclamation mark.
 
+    Args:
+        no_repeats (dict, optional): Per-client state. If given, the client gets
+            every possible insult once before any insult is repeated
+            (see next_unique_insult() in insult_space.py).
+
     Returns:
         str: A randomly generated Shakespearean insult.
     """
+    if no_repeats is not None:
+        return next_unique_insult(no_repeats)
+    rng = thread_rng()
     insult = "Thou "
-    insult += random.choice(vocab.column1) + " "
-    insult += random.choice(vocab.column2) + " "
-    insult += random.choice(vocab.column3) + "!"
+    insult += rng.choice(vocab.column1) + " "
+    insult += rng.choice(vocab.column2) + " "
+    insult += rng.choice(vocab.column3) + "!"
     return insult
     
 @app.route('/')
@@ -35,9 +64,175 @@ def insulter():
     
     @return: Rendered HTML template index.html (in the templates/ directory)
     """
-    some_insult = generate_insult()
+    if wants_no_repeats():
+        with no_repeats_state() as state:
+            some_insult = generate_insult(no_repeats=state)
+    else:
+        some_insult = generate_insult()
     return render_template("index.html", insult=some_insult)
 
+def seed_parameter():
+    """Read the optional ?seed= query parameter.
+
+    @return: (seed or None, None) if valid, (None, error response) otherwise
+    """
+    seed = request.args.get("seed")
+    if seed is None:
+        return None, None
+    try:
+        return int(seed), None
+    except ValueError:
+        return None, (jsonify({"error": "Invalid seed parameter. Must be an integer."}), 400)
+
+def is_true(value):
+    """True if a query parameter value means yes, e.g., ?unique=true or ?unique=1."""
+    return value is not None and value.lower() in ("true", "1", "yes")
+
+def wants_no_repeats():
+    """True if the request asks for insults without repeats (?unique=true)."""
+    return is_true(request.args.get("unique"))
+
+@contextmanager
+def no_repeats_state():
+    """Load this client's no-repeats state from the session and save it back afterwards."""
+    state = session.get("no_repeats", {})
+    yield state
+    session["no_repeats"] = state
+
+@app.route('/insults')
+def get_insults():
+    """Generate a batch of Shakespearean insults, or list them page by page.
+    Query parameters:
+        count (int, optional): Number of random insults to generate (default: 1, max: MAX_BATCH)
+        format (str, optional): "json", "text", "ndjson" or "csv" (default: "json")
+        unique (bool, optional): If true, never repeat an insult this client has
+            already been given (json and text only; default: false)
+        theme (str, optional): Only use words tagged with this theme (see GET /themes)
+        weighted (bool, optional): If true, pick words according to the weights in
+            vocab.py (always the case with a theme; default: false)
+        seed (int, optional): Seed for the random insults; the same request with the
+            same seed always returns the same insults (not with unique)
+        offset, limit (int, optional): If either is given, return the insults with ids
+            offset, ..., offset + limit - 1 in id order instead of random ones
+            (default offset: 0, default limit: 100, max limit: MAX_BATCH)
+
+    @return: JSON object {"insults": [...]}, or plain text with one insult per line
+    """
+    response_format = request.args.get("format", default="json")
+    if response_format in ENCODERS:
+        return stream_insults(response_format)
+    if response_format not in ("json", "text"):
+        return jsonify({"error": "Invalid format parameter. Must be 'json', 'text', 'ndjson' or 'csv'."}), 400
+
+    if "offset" in request.args or "limit" in request.args:
+        return get_insults_page()
+
+    count = request.args.get("count", default=1, type=int)
+    if count < 1 or count > MAX_BATCH:
+        return jsonify({"error": f"Invalid count parameter. Must be between 1 and {MAX_BATCH}."}), 400
+
+    theme = request.args.get("theme")
+    if theme is not None and theme not in vocab.themes:
+        return jsonify({"error": f"Unknown theme '{theme}'. See /themes for the available themes."}), 400
+
+    seed, error = seed_parameter()
+    if error:
+        return error
+
+    if wants_no_repeats():
+        if seed is not None:
+            return jsonify({"error": "The seed parameter cannot be combined with unique."}), 400
+        with no_repeats_state() as state:
+            insults_batch = [generate_insult(no_repeats=state) for _ in range(count)]
+    elif theme is not None or is_true(request.args.get("weighted")):
+        rng = stream(seed) if seed is not None else None
+        insults_batch = weighted_insults.generate_many(count, theme, rng)
+    elif seed is not None:
+        executor = batch_executor if count > SEEDED_CHUNK_SIZE else None
+        insults_batch = sample_insults_seeded(count, seed, executor)
+    else:
+        insults_batch = sample_insults(count)
+    if response_format == "text":
+        return "\n".join(insults_batch) + "\n", 200, {"Content-Type": "text/plain; charset=utf-8"}
+    return jsonify({"insults": insults_batch}), 200
+
+def get_insults_page():
+    """Return one page of the insults in id order (see insult_space.py).
+    The response has a "next" offset for the following page, or null on the last page.
+    """
+    offset = request.args.get("offset", default=0, type=int)
+    limit = request.args.get("limit", default=100, type=int)
+    if offset < 0:
+        return jsonify({"error": "Invalid offset parameter. Must be 0 or more."}), 400
+    if limit < 1 or limit > MAX_BATCH:
+        return jsonify({"error": f"Invalid limit parameter. Must be between 1 and {MAX_BATCH}."}), 400
+
+    total = len(insults)
+    page = [{"id": insult_id, "insult": insult} for insult_id, insult in insults.page(offset, limit)]
+    next_offset = offset + limit if offset + limit < total else None
+    return jsonify({"insults": page, "offset": offset, "limit": limit,
+                    "total": total, "next": next_offset}), 200
+
+def stream_insults(response_format):
+    """Stream insults as NDJSON or CSV, generating them while the response is sent.
+    With `count`, streams that many random insults (max MAX_STREAM). Otherwise
+    streams the insults in id order starting at `offset` (default 0), `limit` of
+    them (default: all the rest). Every line has the insult id, so an interrupted
+    download can be resumed with offset=<last id + 1>.
+    """
+    if "count" in request.args:
+        count = request.args.get("count", default=1, type=int)
+        if count < 1 or count > MAX_STREAM:
+            return jsonify({"error": f"Invalid count parameter. Must be between 1 and {MAX_STREAM}."}), 400
+        seed, error = seed_parameter()
+        if error:
+            return error
+        pairs = random_pairs(count, seed)
+    else:
+        offset = request.args.get("offset", default=0, type=int)
+        limit = request.args.get("limit", default=len(insults), type=int)
+        if offset < 0:
+            return jsonify({"error": "Invalid offset parameter. Must be 0 or more."}), 400
+        if limit < 1:
+            return jsonify({"error": "Invalid limit parameter. Must be 1 or more."}), 400
+        pairs = insults.page(offset, limit)
+
+    encode = ENCODERS[response_format]
+    return Response(encode(pairs), mimetype=MIMETYPES[response_format])
+
+@app.route('/themes')
+def get_themes():
+    """List the insult themes and how many words each has in every column.
+
+    @return: JSON object {"themes": {"animal": [4, 7, 11], ...}}
+    """
+    columns = (vocab.column1, vocab.column2, vocab.column3)
+    counts = {
+        theme: [sum(word in tagged for word in column) for column in columns]
+        for theme, tagged in vocab.themes.items()
+    }
+    return jsonify({"themes": counts}), 200
+
+@app.route('/insults/count')
+def count_insults():
+    """Return how many different insults the current vocabulary can produce.
+
+    @return: JSON object {"count": ..., "version": [len(column1), len(column2), len(column3)]}
+    """
+    return jsonify({"count": len(insults), "version": list(insults.version)}), 200
+
+@app.route('/insults/<int:insult_id>')
+def get_insult(insult_id):
+    """Return the insult with the given id, so that an insult can be linked to.
+
+    @return: JSON object {"id": ..., "insult": ...}, or 404 if the id is out of range
+    """
+    try:
+        insult = insults.unrank(insult_id)
+    except IndexError:
+        return jsonify({"error": f"Insult {insult_id} not found. Ids go from 0 to {len(insults) - 1}."}), 404
+    return jsonify({"id": insult_id, "insult": insult}), 200
+
 if __name__ == '__main__':
     # Run the Flask application on the local server on port 5005
     # with debug mode enabled.
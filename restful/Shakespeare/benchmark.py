@@ -0,0 +1,94 @@
+# @file: benchmark.py
+# @brief: Micro-benchmarks for the Shakespearean insult generator.
+#
+# Run with `python benchmark.py` from this directory.
+
+import os
+import random
+import time
+import timeit
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from alias import AliasTable
+from app import app, generate_insult
+from sampler import sample_insults, sample_insults_seeded
+
+# Batch sizes to measure; the largest one takes a few seconds
+BATCH_SIZES = [1, 1000, 1000000]
+
+
+def per_insult_ns(func, count, repeat=5):
+    """Return the best per-insult cost of `func(count)` in nanoseconds."""
+    number = max(1, 100000 // count)
+    best = min(timeit.repeat(lambda: func(count), number=number, repeat=repeat))
+    return best / (number * count) * 1e9
+
+
+def one_at_a_time(count):
+    """Baseline: call generate_insult() once per insult."""
+    return [generate_insult() for _ in range(count)]
+
+
+def bench_batch():
+    print("Per-insult cost (ns), generate_insult() loop vs. sample_insults()")
+    print(f"{'N':>10} {'loop':>10} {'batch':>10} {'speedup':>8}")
+    for count in BATCH_SIZES:
+        loop = per_insult_ns(one_at_a_time, count)
+        batch = per_insult_ns(sample_insults, count)
+        print(f"{count:>10} {loop:>10.0f} {batch:>10.0f} {loop / batch:>7.1f}x")
+
+
+def bench_export():
+    """Stream the exports through Flask's test client and count insults per second."""
+    client = app.test_client()
+    print("Streaming export throughput (insults/s)")
+    for query in ["format=ndjson", "format=csv", "format=ndjson&count=1000000", "format=csv&count=1000000"]:
+        start = time.perf_counter()
+        response = client.get(f"/insults?{query}", buffered=False)
+        lines = sum(chunk.count(b"\n") for chunk in response.response)
+        elapsed = time.perf_counter() - start
+        if "csv" in query:
+            lines -= 1  # header
+        print(f"{query:<28} {lines:>8} insults {lines / elapsed:>12,.0f}/s")
+
+
+def bench_weighted():
+    """Cost of one weighted draw: random.choices(weights=...) vs. an alias table."""
+    print("Weighted draw cost (ns/draw), random.choices(weights=...) vs. AliasTable")
+    print(f"{'words':>10} {'choices k=1':>12} {'alias':>8} {'choices k=1000':>15} {'alias x1000':>12}")
+    for size in [50, 10000, 1000000]:
+        words = [f"word{i}" for i in range(size)]
+        weights = [random.uniform(0.5, 3.0) for _ in range(size)]
+        table = AliasTable(words, weights)
+        number = max(1, 200000 // size)
+        single = timeit.timeit(lambda: random.choices(words, weights), number=number) / number
+        alias = timeit.timeit(table.sample, number=100000) / 100000
+        batch = timeit.timeit(lambda: random.choices(words, weights, k=1000), number=number) / number / 1000
+        alias_batch = timeit.timeit(lambda: table.sample_many(1000), number=100) / 100 / 1000
+        print(f"{size:>10} {single * 1e9:>12,.0f} {alias * 1e9:>8,.0f} {batch * 1e9:>15,.0f} {alias_batch * 1e9:>12,.0f}")
+
+
+def bench_seeded(count=1000000):
+    """Seeded batch of `count` insults, serially and on thread and process pools."""
+    print(f"Seeded batch of {count:,} insults on {os.cpu_count()} CPU(s) (insults/s)")
+    start = time.perf_counter()
+    expected = sample_insults_seeded(count, 42)
+    print(f"{'serial':<12} {count / (time.perf_counter() - start):>12,.0f}")
+    for name, pool in [("threads", ThreadPoolExecutor), ("processes", ProcessPoolExecutor)]:
+        for workers in [2, 4]:
+            with pool(workers) as executor:
+                start = time.perf_counter()
+                result = sample_insults_seeded(count, 42, executor)
+                elapsed = time.perf_counter() - start
+            assert result == expected, "seeded batches must not depend on the executor"
+            print(f"{name + ' x' + str(workers):<12} {count / elapsed:>12,.0f}")
+
+
+if __name__ == '__main__':
+    bench_batch()
+    print()
+    bench_export()
+    print()
+    bench_weighted()
+    print()
+    bench_seeded()
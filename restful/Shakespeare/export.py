@@ -0,0 +1,74 @@
+# @file: export.py
+# @brief: Streaming NDJSON and CSV encoders for large numbers of insults.
+#
+# Each encoder is a generator that turns (id, insult) pairs into chunks of
+# text. Flask sends every chunk to the client as soon as it is produced, so the
+# server only ever holds one chunk in memory no matter how many insults are
+# exported.
+
+import csv
+import io
+import json
+from itertools import islice
+from typing import Iterable, Iterator, Optional, Tuple
+
+from rng import thread_rng
+from sampler import sample_insults, seeded_chunks
+
+# Number of insults encoded into each chunk of the response
+CHUNK_SIZE = 1000
+
+# Content types of the supported export formats
+MIMETYPES = {
+    "ndjson": "application/x-ndjson",
+    "csv": "text/csv",
+}
+
+
+def iter_ndjson(pairs: Iterable[Tuple[Optional[int], str]]) -> Iterator[str]:
+    """Encode (id, insult) pairs as newline-delimited JSON, one object per line.
+    Random insults have no id, so their lines only have an "insult" field.
+    """
+    pairs = iter(pairs)
+    while chunk := list(islice(pairs, CHUNK_SIZE)):
+        yield "".join(
+            f'{{"insult": {json.dumps(insult)}}}\n' if insult_id is None
+            else f'{{"id": {insult_id}, "insult": {json.dumps(insult)}}}\n'
+            for insult_id, insult in chunk
+        )
+
+
+def iter_csv(pairs: Iterable[Tuple[Optional[int], str]]) -> Iterator[str]:
+    """Encode (id, insult) pairs as CSV with an "id,insult" header line."""
+    pairs = iter(pairs)
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, lineterminator="\n")
+    writer.writerow(["id", "insult"])
+    while chunk := list(islice(pairs, CHUNK_SIZE)):
+        writer.writerows(chunk)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    # An empty export still gets its header
+    if buffer.tell():
+        yield buffer.getvalue()
+
+
+def random_pairs(count: int, seed: Optional[int] = None) -> Iterator[Tuple[None, str]]:
+    """Yield `count` random insults, generated a chunk at a time.
+    With a seed, these are the same insults as sample_insults_seeded(count, seed).
+    """
+    if seed is not None:
+        chunks = seeded_chunks(count, seed)
+    else:
+        rng = thread_rng()
+        chunks = (sample_insults(min(CHUNK_SIZE, count - start), rng) for start in range(0, count, CHUNK_SIZE))
+    for chunk in chunks:
+        for insult in chunk:
+            yield None, insult
+
+
+ENCODERS = {
+    "ndjson": iter_ndjson,
+    "csv": iter_csv,
+}
@@ -0,0 +1,217 @@
+# @file: insult_space.py
+# @brief: Numbering of every possible Shakespearean insult.
+#
+# Picking one word from each of the three vocabulary columns gives
+# len(column1) * len(column2) * len(column3) different insults. We number them
+# like a three-digit number whose digits are the column indices:
+#
+#     id = (index1 * len(column2) + index2) * len(column3) + index3
+#
+# so going from an id to an insult ("unrank") and back ("rank") is just a few
+# multiplications and divisions, and we never have to build the list of all
+# insults.
+
+import random
+from functools import lru_cache
+from itertools import islice
+from typing import Dict, Iterator, List, Sequence, Tuple
+
+import vocab
+from rng import thread_rng
+
+
+class InsultSpace:
+    """All the insults that can be built from three word columns.
+
+    The columns are kept by reference, not copied, so words appended to them
+    at runtime (e.g., by the /vocabulary page of the wtforms app) are picked
+    up automatically. Because the ids are computed from the current column
+    lengths, appending words renumbers the insults: an id is only meaningful
+    together with the vocabulary `version` it was issued for.
+    """
+
+    def __init__(self, *columns: Sequence[str]) -> None:
+        self.columns = columns
+        # word -> index lookup tables for rank(), rebuilt when a column grows
+        self._indexes: List[Dict[str, int]] = [{} for _ in columns]
+        self._indexed_lengths = [-1 for _ in columns]
+
+    def __len__(self) -> int:
+        total = 1
+        for column in self.columns:
+            total *= len(column)
+        return total
+
+    @property
+    def version(self) -> Tuple[int, ...]:
+        """The column sizes; they change whenever a word is added."""
+        return tuple(len(column) for column in self.columns)
+
+    def unrank(self, insult_id: int) -> str:
+        """Return the insult with the given id.
+
+        Raises:
+            IndexError: If the id is not in [0, len(self)).
+        """
+        return format_insult(self.words(insult_id))
+
+    def words(self, insult_id: int) -> List[str]:
+        """Return the words (one per column) of the insult with the given id."""
+        if insult_id < 0 or insult_id >= len(self):
+            raise IndexError(f"Insult id {insult_id} out of range")
+        words = []
+        for column in reversed(self.columns):
+            insult_id, index = divmod(insult_id, len(column))
+            words.append(column[index])
+        words.reverse()
+        return words
+
+    def rank(self, insult: str) -> int:
+        """Return the id of an insult such as "Thou artless base-court apple-john!".
+
+        Raises:
+            ValueError: If the insult cannot be built from the current columns.
+        """
+        if not (insult.startswith("Thou ") and insult.endswith("!")):
+            raise ValueError(f"Not a Shakespearean insult: {insult!r}")
+        tokens = insult[len("Thou "):-1].split(" ")
+        # Words added at runtime may contain spaces, so try every way of
+        # splitting the tokens into three words (usually there is just one)
+        for i in range(1, len(tokens) - 1):
+            for j in range(i + 1, len(tokens)):
+                words = (" ".join(tokens[:i]), " ".join(tokens[i:j]), " ".join(tokens[j:]))
+                try:
+                    return self.rank_words(*words)
+                except ValueError:
+                    continue
+        raise ValueError(f"Not a Shakespearean insult: {insult!r}")
+
+    def rank_words(self, *words: str) -> int:
+        """Return the id of the insult made of the given words (one per column)."""
+        insult_id = 0
+        for position, (column, word) in enumerate(zip(self.columns, words)):
+            index = self._index(position).get(word)
+            if index is None:
+                raise ValueError(f"{word!r} is not in column {position + 1}")
+            insult_id = insult_id * len(column) + index
+        return insult_id
+
+    def page(self, offset: int, limit: int) -> Iterator[Tuple[int, str]]:
+        """Yield (id, insult) pairs for ids offset, offset + 1, ... in order.
+
+        At most `limit` pairs are produced, fewer at the end of the space.
+        """
+        offset = max(offset, 0)
+        if limit <= 0 or offset >= len(self):
+            return
+        words = islice(_words_from(self.columns, offset), limit)
+        for insult_id, insult_words in enumerate(words, offset):
+            yield insult_id, format_insult(insult_words)
+
+    def _index(self, position: int) -> Dict[str, int]:
+        column = self.columns[position]
+        if self._indexed_lengths[position] != len(column):
+            # setdefault keeps the first index if a word was added twice
+            index: Dict[str, int] = {}
+            for i, word in enumerate(column):
+                index.setdefault(word, i)
+            self._indexes[position] = index
+            self._indexed_lengths[position] = len(column)
+        return self._indexes[position]
+
+
+class Permutation:
+    """A shuffled order of the numbers 0, 1, ..., size - 1, without storing it.
+
+    permutation[i] is computed on the fly with a small Feistel network (the
+    trick block ciphers use to scramble bits reversibly). The network shuffles
+    all numbers below the next power of 4; numbers that land outside
+    [0, size) are put through it again ("cycle walking") until they land
+    inside, which keeps it a one-to-one mapping and takes fewer than four
+    rounds on average. The whole shuffle is determined by (size, seed).
+    """
+
+    ROUNDS = 4
+
+    def __init__(self, size: int, seed: int) -> None:
+        self.size = size
+        # Split the numbers into two halves of `half_bits` bits each
+        self.half_bits = max(1, ((size - 1).bit_length() + 1) // 2)
+        self.mask = (1 << self.half_bits) - 1
+        keys = random.Random(seed)
+        self.keys = [keys.getrandbits(32) for _ in range(self.ROUNDS)]
+
+    def __len__(self) -> int:
+        return self.size
+
+    def __getitem__(self, i: int) -> int:
+        if i < 0 or i >= self.size:
+            raise IndexError(f"Permutation index {i} out of range")
+        while True:
+            i = self._scramble(i)
+            if i < self.size:
+                return i
+
+    def _scramble(self, x: int) -> int:
+        left, right = x >> self.half_bits, x & self.mask
+        for key in self.keys:
+            # Any function of (right, key) works here; this one mixes bits well
+            mixed = ((right ^ key) * 0x9E3779B1) & 0xFFFFFFFF
+            mixed ^= mixed >> 16
+            left, right = right, left ^ (mixed & self.mask)
+        return (left << self.half_bits) | right
+
+
+@lru_cache(maxsize=1024)
+def permutation(size: int, seed: int) -> Permutation:
+    """Return the (cached) Permutation for the given size and seed."""
+    return Permutation(size, seed)
+
+
+def _words_from(columns: Sequence[Sequence[str]], offset: int) -> Iterator[Tuple[str, ...]]:
+    """Yield the word tuples of the insults with ids offset, offset + 1, ...
+
+    Works like an odometer over the columns, so moving on to the next insult
+    does not need any multiplications or divisions.
+    """
+    first, rest = columns[0], columns[1:]
+    if not rest:
+        for word in first[offset:]:
+            yield (word,)
+        return
+    inner = 1
+    for column in rest:
+        inner *= len(column)
+    start, offset = divmod(offset, inner)
+    for word in first[start:]:
+        for tail in _words_from(rest, offset):
+            yield (word,) + tail
+        offset = 0
+
+
+def format_insult(words: Sequence[str]) -> str:
+    """Build the insult string from one word per column."""
+    return "Thou " + " ".join(words) + "!"
+
+
+# The insult space of the default vocabulary
+insults = InsultSpace(vocab.column1, vocab.column2, vocab.column3)
+
+
+def next_unique_insult(state: Dict, space: InsultSpace = insults) -> str:
+    """Hand out the insults of `space` one by one in a shuffled order, without repeats.
+
+    `state` is a small per-client dict (e.g., stored in the Flask session) that
+    only holds the shuffle seed, a cursor into the shuffled order and the
+    vocabulary version, so it takes the same few bytes however many insults
+    the client has seen. When the vocabulary changes or every insult has been
+    handed out, the state is reset and a new shuffle begins.
+    """
+    version = list(space.version)
+    if state.get("version") != version or state.get("cursor", 0) >= len(space):
+        state["seed"] = thread_rng().getrandbits(32)
+        state["cursor"] = 0
+        state["version"] = version
+    insult_id = permutation(len(space), state["seed"])[state["cursor"]]
+    state["cursor"] += 1
+    return space.unrank(insult_id)
@@ -0,0 +1,39 @@
+# @file: rng.py
+# @brief: Independent random number streams for the insult generator.
+#
+# The functions of the random module (random.choice, random.choices, ...) all
+# use one hidden generator shared by every thread, and there is no way to get
+# the same insults twice. Instead, this module hands out separate
+# random.Random generators:
+#   - thread_rng(): one generator per thread, seeded from the operating system,
+#     so threads never share generator state;
+#   - stream(seed, i): a generator fully determined by (seed, i). Different
+#     stream numbers give independent streams (their seeds are hashed), so a
+#     big batch can be split into chunks, chunk i drawn from stream(seed, i) by
+#     whichever thread or process is free, and the result is the same every time.
+
+import hashlib
+import os
+import random
+import threading
+
+_local = threading.local()
+
+
+def thread_rng() -> random.Random:
+    """Return the calling thread's own random number generator."""
+    rng = getattr(_local, "rng", None)
+    if rng is None:
+        rng = _local.rng = random.Random(os.urandom(32))
+    return rng
+
+
+def stream(seed: int, *stream_ids: int) -> random.Random:
+    """Return a new generator determined by `seed` and the stream number(s).
+
+    Args:
+        seed: The seed chosen by the user, e.g., from the ?seed= query parameter
+        stream_ids: Which of the seed's streams to return (e.g., a chunk number)
+    """
+    key = ",".join(str(number) for number in (seed, *stream_ids)).encode()
+    return random.Random(int.from_bytes(hashlib.sha256(key).digest(), "big"))
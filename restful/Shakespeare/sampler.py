@@ -0,0 +1,72 @@
+# @file: sampler.py
+# @brief: Batch sampling of Shakespearean insults.
+
+import random
+from concurrent.futures import Executor
+from typing import Iterator, List, Optional, Tuple
+
+import vocab
+from rng import stream, thread_rng
+
+# Every insult has the same shape, so we format them all with one bound method
+INSULT_FORMAT = "Thou {} {} {}!".format
+
+# Seeded batches are generated in chunks of this many insults, chunk i from
+# stream(seed, i), so the result does not depend on how the chunks are shared
+# out between threads
+SEEDED_CHUNK_SIZE = 1000
+
+
+def sample_insults(count: int, rng: Optional[random.Random] = None) -> List[str]:
+    """Generate a batch of random Shakespearean insults.
+    Instead of calling random.choice three times per insult, this function
+    draws all the words for each column in one call to random.choices and
+    then formats the whole batch in a single pass over the three word lists.
+
+    Args:
+        count: Number of insults to generate.
+        rng: Random number generator to use (default: this thread's own, see rng.py).
+
+    Returns:
+        list: `count` randomly generated Shakespearean insults.
+    """
+    rng = rng or thread_rng()
+    words1 = rng.choices(vocab.column1, k=count)
+    words2 = rng.choices(vocab.column2, k=count)
+    words3 = rng.choices(vocab.column3, k=count)
+    return list(map(INSULT_FORMAT, words1, words2, words3))
+
+
+def seeded_chunks(count: int, seed: int) -> Iterator[List[str]]:
+    """Generate `count` insults for a seed, one chunk at a time (see SEEDED_CHUNK_SIZE)."""
+    for chunk in _chunk_specs(count, seed):
+        yield _sample_chunk(chunk)
+
+
+def sample_insults_seeded(count: int, seed: int, executor: Optional[Executor] = None) -> List[str]:
+    """Generate a reproducible batch: the same count and seed always give the same insults.
+
+    Args:
+        count: Number of insults to generate.
+        seed: Seed of the batch.
+        executor: If given, the chunks are generated in parallel on it (e.g., a
+            ThreadPoolExecutor, or a ProcessPoolExecutor to use several cores
+            with the GIL). Each chunk has its own generator, so the workers
+            share no state and no lock.
+
+    Returns:
+        list: `count` Shakespearean insults.
+    """
+    chunks = _chunk_specs(count, seed)
+    results = executor.map(_sample_chunk, chunks) if executor else map(_sample_chunk, chunks)
+    return [insult for chunk in results for insult in chunk]
+
+
+def _chunk_specs(count: int, seed: int) -> Iterator[Tuple[int, int, int]]:
+    for index, start in enumerate(range(0, count, SEEDED_CHUNK_SIZE)):
+        yield seed, index, min(SEEDED_CHUNK_SIZE, count - start)
+
+
+def _sample_chunk(chunk: Tuple[int, int, int]) -> List[str]:
+    seed, index, size = chunk
+    return sample_insults(size, stream(seed, index))
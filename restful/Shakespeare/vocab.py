@@ -162,3 +162,39 @@ column3 = [
     "whey-face",
     "wagtail",
 ]
+
+# Relative weights for weighted insults (see weighted.py); words that are not
+# listed here have weight 1.0, so "villainous" comes up three times as often
+weights = {
+    "beslubbering": 2.0,
+    "villainous": 3.0,
+    "clapper-clawed": 2.0,
+    "tickle-brained": 2.0,
+    "fustilarian": 3.0,
+    "canker-blossom": 2.0,
+}
+
+# Theme tags for themed insults; a themed insult uses the tagged words of
+# each column (or the whole column if none of its words have the tag)
+themes = {
+    "animal": {
+        "currish", "fawning", "goatish", "ruttish",
+        "bat-fowling", "beetle-headed", "doghearted", "flap-mouthed", "fly-bitten",
+        "sheep-biting", "toad-spotted",
+        "barnacle", "boar-pig", "gudgeon", "harpy", "hedge-pig", "horn-beast",
+        "maggot-pie", "minnow", "moldwarp", "puttock", "wagtail",
+    },
+    "food": {
+        "frothy", "reeky", "yeasty",
+        "beef-witted", "fat-kidneyed", "full-gorged", "guts-griping", "milk-livered",
+        "onion-eyed", "rump-fed",
+        "apple-john", "dewberry", "malt-worm", "pigeon-egg", "pignut", "pumpion",
+        "whey-face",
+    },
+    "dimwit": {
+        "artless", "droning", "loggerheaded", "lumpish",
+        "beef-witted", "beetle-headed", "boil-brained", "clay-brained", "hasty-witted",
+        "idle-headed", "motley-minded", "tickle-brained",
+        "clotpole", "coxcomb", "gudgeon", "joithead", "lout", "measle",
+    },
+}
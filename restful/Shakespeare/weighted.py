@@ -0,0 +1,112 @@
+# @file: weighted.py
+# @brief: Weighted and themed Shakespearean insults.
+#
+# Each column gets an alias table (see alias.py) built from the word weights in
+# vocab.py, so drawing a word costs the same no matter how long the column is.
+# A theme restricts every column to the words tagged with that theme.
+
+import random
+from typing import Callable, Dict, List, Mapping, Optional, Sequence, Set
+
+import vocab
+from alias import AliasTable
+from rng import thread_rng
+from sampler import INSULT_FORMAT
+
+
+class WeightedColumn:
+    """An alias table that follows a vocabulary column as words are appended to it."""
+
+    def __init__(
+        self,
+        column: Sequence[str],
+        weights: Mapping[str, float],
+        keep: Callable[[str], bool] = lambda word: True,
+    ) -> None:
+        """
+        Args:
+            column: The vocabulary column (kept by reference)
+            weights: Word weights; words that are not in it have weight 1.0
+            keep: Only words for which this returns True are sampled
+        """
+        self.column = column
+        self.weights = weights
+        self.keep = keep
+        self.table: AliasTable[str] = AliasTable()
+        self._synced = 0
+
+    def table_for_current_column(self) -> AliasTable:
+        """Return the alias table, after adding any words appended to the column."""
+        if self._synced < len(self.column):
+            new_words = [word for word in self.column[self._synced:] if self.keep(word)]
+            if len(self.table) == 0:
+                # First use: build the whole table in one go
+                self.table = AliasTable(new_words, [self.weights.get(w, 1.0) for w in new_words])
+            else:
+                for word in new_words:
+                    self.table.add(word, self.weights.get(word, 1.0))
+            self._synced = len(self.column)
+        return self.table
+
+
+class WeightedInsults:
+    """Generates insults with weighted word choice, optionally limited to a theme."""
+
+    def __init__(
+        self,
+        columns: Sequence[Sequence[str]],
+        weights: Mapping[str, float],
+        themes: Mapping[str, Set[str]],
+    ) -> None:
+        self.columns = columns
+        self.weights = weights
+        self.themes = themes
+        # theme (None for all words) -> one WeightedColumn per vocabulary column
+        self._tables: Dict[Optional[str], List[WeightedColumn]] = {}
+
+    def generate(self, theme: Optional[str] = None, rng: Optional[random.Random] = None) -> str:
+        """Generate one insult.
+
+        Args:
+            theme: Name of a theme in vocab.themes, or None for any words
+            rng: Random number generator to use (default: this thread's own, see rng.py)
+
+        Raises:
+            KeyError: If the theme does not exist.
+        """
+        rng = rng or thread_rng()
+        words = [table.sample(rng) for table in self._column_tables(theme)]
+        return "Thou " + " ".join(words) + "!"
+
+    def generate_many(
+        self, count: int, theme: Optional[str] = None, rng: Optional[random.Random] = None
+    ) -> List[str]:
+        """Generate `count` insults (see generate())."""
+        rng = rng or thread_rng()
+        tables = self._column_tables(theme)
+        words = [table.sample_many(count, rng) for table in tables]
+        return list(map(INSULT_FORMAT, *words))
+
+    def _column_tables(self, theme: Optional[str]) -> List[AliasTable]:
+        if theme not in self._tables:
+            if theme is None:
+                columns = [WeightedColumn(column, self.weights) for column in self.columns]
+            else:
+                tagged = self.themes[theme]
+                columns = [
+                    WeightedColumn(column, self.weights, tagged.__contains__)
+                    for column in self.columns
+                ]
+            self._tables[theme] = columns
+        tables = [column.table_for_current_column() for column in self._tables[theme]]
+        if theme is not None:
+            # A column without any word of this theme falls back to all its words
+            all_words = self._column_tables(None)
+            tables = [t if t.total_weight > 0 else a for t, a in zip(tables, all_words)]
+        return tables
+
+
+# Weighted and themed insults over the default vocabulary
+weighted_insults = WeightedInsults(
+    (vocab.column1, vocab.column2, vocab.column3), vocab.weights, vocab.themes
+)
@@ -4,6 +4,7 @@ This module implements a Flask web application that generates random Shakespeare
 and provides user authentication and vocabulary management functionality.
 """
 
+import atexit
 import configparser
 import random
 from pathlib import Path
@@ -23,6 +24,9 @@ from wtforms.validators import DataRequired, Length
 import vocab
 from forms import LoginForm, RegisterForm
 from models import User
+from vocab_log import VocabularyLog
+from vocab_shm import SharedVocabulary
+from vocab_store import VocabularyStore
 
 # Load configuration
 config = configparser.ConfigParser()
@@ -39,6 +43,29 @@ login_manager.login_view = config["login"]["LOGIN_VIEW"]
 login_manager.login_message = config["login"]["LOGIN_MESSAGE"]
 login_manager.login_message_category = config["login"]["LOGIN_MESSAGE_CATEGORY"]
 
+# Initial vocabulary: from a packed file if one is configured, else from vocab.py
+packed_vocab = config["vocab"]["PACKED_FILE"]
+if packed_vocab:
+    initial_vocab = VocabularyStore.load(Path(__file__).parent / packed_vocab)
+else:
+    initial_vocab = VocabularyStore([vocab.column1, vocab.column2, vocab.column3])
+
+# Words added through /vocabulary are saved in DATA_DIR ...
+vocab_dir = Path(__file__).parent / config["vocab"]["DATA_DIR"]
+vocab_log = VocabularyLog(
+    vocab_dir,
+    initial_vocab,
+    fsync_batch=config["vocab"].getint("FSYNC_BATCH"),
+    fsync_interval=config["vocab"].getfloat("FSYNC_INTERVAL"),
+    snapshot_every=config["vocab"].getint("SNAPSHOT_EVERY"),
+)
+atexit.register(vocab_log.close)
+
+# ... and published in shared memory, where every worker reads them without locking
+shared_vocab = SharedVocabulary(vocab_dir / "vocab.shm", vocab_log.store)
+vocab_log.on_change = shared_vocab.publish
+vocab_log.publish()
+
 
 @login_manager.user_loader
 def load_user(user_id):
@@ -68,7 +95,8 @@ class VocabularyForm(FlaskForm):
 
 def generate_insult():
     """Generate a random Shakespearean insult."""
-    return f"Thou {random.choice(vocab.column1)} {random.choice(vocab.column2)} {random.choice(vocab.column3)}!"
+    words = shared_vocab.current()
+    return f"Thou {random.choice(words.column1)} {random.choice(words.column2)} {random.choice(words.column3)}!"
 
 
 @app.route("/")
@@ -139,12 +167,13 @@ def vocabulary():
             flash("Column must be 1, 2, or 3", "error")
             return redirect(url_for("vocabulary"))
 
-        vocab_list = [vocab.column1, vocab.column2, vocab.column3][int(column) - 1]
-        vocab_list.append(word)
+        if not vocab_log.add_word(int(column), word):
+            flash(f'"{word}" is already in column {column}', "error")
+            return redirect(url_for("vocabulary"))
         flash(f'Successfully added "{word}" to column {column}!', "success")
         return redirect(url_for("vocabulary"))
 
-    return render_template("vocabulary.html", form=form, vocab=vocab)
+    return render_template("vocabulary.html", form=form, vocab=shared_vocab.current())
 
 
 if __name__ == "__main__":
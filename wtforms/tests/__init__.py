@@ -0,0 +1 @@
+"""Test package for the WTForms insult application."""
@@ -0,0 +1,102 @@
+import os
+from pathlib import Path
+
+from vocab_log import LOG_FILE, SNAPSHOT_FILE, VocabularyLog, _format_record
+from vocab_store import VocabularyStore
+
+
+def store() -> VocabularyStore:
+    """The vocabulary to start from: one word per column"""
+    return VocabularyStore([["base1"], ["base2"], ["base3"]])
+
+
+def words(log: VocabularyLog, column: int) -> list:
+    """The words of a column of a log's vocabulary"""
+    return list(log.store.columns[column - 1])
+
+
+def log_lines(data_dir: Path) -> list:
+    """The lines of the log file"""
+    return (data_dir / LOG_FILE).read_bytes().splitlines()
+
+
+def test_replay(tmp_path: Path) -> None:
+    """Test that logged words are replayed on startup, and reach the other workers"""
+    log = VocabularyLog(str(tmp_path), store())
+    other = VocabularyLog(str(tmp_path), store())
+    assert log.add_word(1, "gleeking")
+    assert log.add_word(3, "flap-dragon")
+    assert not log.add_word(1, "gleeking")
+    # The other worker counts a word this one added as a duplicate
+    assert not other.add_word(3, "flap-dragon")
+    assert words(other, 3) == ["base3", "flap-dragon"]
+    log.close()
+    other.close()
+
+    restarted = VocabularyLog(str(tmp_path), store())
+    assert words(restarted, 1) == ["base1", "gleeking"]
+    assert words(restarted, 3) == ["base3", "flap-dragon"]
+    assert restarted.store.log_offset == os.path.getsize(tmp_path / LOG_FILE)
+    restarted.close()
+
+
+def test_truncated_and_corrupt_records(tmp_path: Path) -> None:
+    """Test that torn and corrupt records are skipped, and the next word still gets logged"""
+    log = VocabularyLog(str(tmp_path), store())
+    log.add_word(1, "gleeking")
+    log.close()
+    corrupt = _format_record(2, "rump-fed").replace(b"rump", b"rumP")
+    with open(tmp_path / LOG_FILE, "ab") as file:
+        file.write(corrupt + _format_record(2, "fat-kidneyed")[:-5])
+
+    restarted = VocabularyLog(str(tmp_path), store())
+    assert words(restarted, 1) == ["base1", "gleeking"]
+    assert words(restarted, 2) == ["base2"]
+    # The torn line is ended, so the new record is a line of its own
+    assert restarted.add_word(2, "fat-kidneyed")
+    restarted.close()
+
+    restarted = VocabularyLog(str(tmp_path), store())
+    assert words(restarted, 2) == ["base2", "fat-kidneyed"]
+    restarted.close()
+
+
+def test_snapshot_compacts_log(tmp_path: Path) -> None:
+    """Test that a snapshot empties the log, for this worker, the others and a restart"""
+    log = VocabularyLog(str(tmp_path), store(), snapshot_every=2)
+    other = VocabularyLog(str(tmp_path), store(), snapshot_every=2)
+    log.add_word(1, "gleeking")
+    assert len(log_lines(tmp_path)) == 1
+    log.add_word(2, "rump-fed")
+    assert (tmp_path / SNAPSHOT_FILE).exists()
+    assert log_lines(tmp_path) == []
+    log.add_word(3, "flap-dragon")
+    assert len(log_lines(tmp_path)) == 1
+
+    # The other worker still has the old log open: it reloads the snapshot
+    assert other.add_word(3, "measle")
+    assert words(other, 1) == ["base1", "gleeking"]
+    assert words(other, 3) == ["base3", "flap-dragon", "measle"]
+    log.close()
+    other.close()
+
+    restarted = VocabularyLog(str(tmp_path), store())
+    assert words(restarted, 2) == ["base2", "rump-fed"]
+    assert words(restarted, 3) == ["base3", "flap-dragon", "measle"]
+    restarted.close()
+
+
+def test_crash_before_compaction(tmp_path: Path) -> None:
+    """Test that a snapshot whose log was never replaced replays it without duplicates"""
+    log = VocabularyLog(str(tmp_path), store())
+    log.add_word(1, "gleeking")
+    log.add_word(2, "rump-fed")
+    # What snapshot() writes before it replaces the log
+    log.store.log_offset = 0
+    log.store.save(str(tmp_path / SNAPSHOT_FILE))
+    log.close()
+
+    restarted = VocabularyLog(str(tmp_path), store())
+    assert words(restarted, 1) == ["base1", "gleeking"]
+    assert words(restarted, 2) == ["base2", "rump-fed"]
+    restarted.close()
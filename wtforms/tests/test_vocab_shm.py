@@ -0,0 +1,111 @@
+import os
+from pathlib import Path
+
+import pytest
+
+from vocab_log import FileLock
+from vocab_shm import SEGMENT_HEADER, SEQUENCE, SharedVocabulary
+from vocab_store import VocabularyStore
+
+
+@pytest.fixture
+def shm_path(tmp_path: Path) -> str:
+    """Path of a fresh shared vocabulary file"""
+    return str(tmp_path / "vocab.shm")
+
+
+def store(*words: str) -> VocabularyStore:
+    """A vocabulary with one word per column"""
+    return VocabularyStore([[word] for word in words])
+
+
+def sequence(path: str) -> int:
+    """The sequence number in the header of a shared vocabulary file"""
+    with open(path, "rb") as file:
+        return SEQUENCE.unpack(file.read(SEQUENCE.size))[0]
+
+
+def test_publish_and_read(shm_path: str) -> None:
+    """Test that a reader sees each published vocabulary, and reuses it until the next one"""
+    writer = SharedVocabulary(shm_path, store("a", "b", "c"))
+    reader = SharedVocabulary(shm_path, store("a", "b", "c"))
+    assert list(reader.current().column1) == ["a"]
+
+    writer.publish(store("x", "y", "z"))
+    current = reader.current()
+    assert list(current.column2) == ["y"]
+    assert reader.current() is current
+
+    # An older (e.g., reset) vocabulary replaces a newer one too
+    newer = store("n", "n", "n")
+    newer.version = 5
+    writer.publish(newer)
+    writer.publish(store("o", "o", "o"))
+    assert list(reader.current().column3) == ["o"]
+    assert sequence(shm_path) % 2 == 0
+
+
+def test_torn_read_discarded(shm_path: str) -> None:
+    """Test that a reader keeps its vocabulary while a write is in progress or races its copy"""
+    writer = SharedVocabulary(shm_path, store("a", "b", "c"))
+    reader = SharedVocabulary(shm_path, store("a", "b", "c"))
+    writer.publish(store("x", "y", "z"))
+    assert list(reader.current().column1) == ["x"]
+
+    # A writer made the sequence odd and is halfway through the data
+    with open(shm_path, "r+b") as file:
+        file.write(SEQUENCE.pack(sequence(shm_path) + 1))
+        file.seek(SEGMENT_HEADER.size)
+        file.write(b"\0" * 8)
+    assert list(reader.current().column1) == ["x"]
+
+    # The sequence changed between the reader's two reads: its copy is discarded
+    stale = sequence(shm_path) - 3
+    assert list(reader._reload(stale).column1) == ["x"]
+    assert reader._sequence != stale
+
+
+def test_writer_crash_recovered(shm_path: str) -> None:
+    """Test that a writer dying halfway does not leave the sequence number odd for good"""
+    first = SharedVocabulary(shm_path, store("a", "b", "c"))
+    first.publish(store("x", "y", "z"))
+    assert list(first.current().column1) == ["x"]
+
+    pid = os.fork()
+    if pid == 0:
+        # The writer starts publishing and dies before it makes the sequence even
+        fd = os.open(shm_path, os.O_RDWR)
+        with FileLock(fd):
+            os.pwrite(fd, SEQUENCE.pack(sequence(shm_path) + 1), 0)
+            os.pwrite(fd, b"torn", SEGMENT_HEADER.size)
+            os._exit(0)
+    os.waitpid(pid, 0)
+    assert sequence(shm_path) % 2 == 1
+
+    # A process that opens the file drops the torn data and makes the sequence even
+    second = SharedVocabulary(shm_path, store("a", "b", "c"))
+    assert list(second.current().column1) == ["a"]
+    assert sequence(shm_path) % 2 == 0
+    assert list(first.current().column1) == ["x"]
+
+    second.publish(store("p", "q", "r"))
+    assert sequence(shm_path) % 2 == 0
+    assert list(first.current().column1) == ["p"]
+    assert list(second.current().column1) == ["p"]
+
+
+def test_forked_worker_opens_its_own_file(shm_path: str) -> None:
+    """Test that a worker forked after the file was opened opens it again"""
+    shared = SharedVocabulary(shm_path, store("a", "b", "c"))
+    shared.publish(store("x", "y", "z"))
+    parent_map = shared._map
+    read_end, write_end = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        shared.publish(store("w", "w", "w"))
+        os.write(write_end, b"new" if shared._map is not parent_map else b"")
+        os._exit(0)
+    os.waitpid(pid, 0)
+    assert os.read(read_end, 3) == b"new"
+    assert shared._map is parent_map
+    assert list(shared.current().column1) == ["w"]
@@ -0,0 +1,298 @@
+"""Crash-safe persistence of the vocabulary for the Shakespearean insult generator.
+
+Words added through the /vocabulary page are written to an append-only log
+file, one line per word:
+
+    <column>\t<word as a JSON string>\t<crc32 of "<column>\t<word as a JSON string>">\n
+
+The checksum lets us recognize a line that was only partly written when the
+server crashed; such lines are skipped. Every so often the whole vocabulary is
+written to a snapshot file (the packed format of vocab_store.py), and the log
+is compacted: it is replaced by an empty one, as the snapshot has every word
+it held. On startup the snapshot is mapped into memory and only the log
+written after it is replayed.
+
+Several server processes (workers) can share the same data directory. Writers
+take an exclusive lock on the log while appending, and first catch up with
+the lines other workers added since their last write (reading only those). A
+worker that finds the log was compacted by another one reloads the snapshot.
+A worker forked after the log was opened opens it again, as it would
+otherwise share the parent's lock.
+Workers do not read the log to serve requests: the app hands new words to
+them through the shared memory of vocab_shm.py, see `on_change`; the log is
+what makes them survive a restart.
+
+Calling os.fsync() after every word would make adding words slow, so the log
+is synced to disk once `fsync_batch` words are waiting or `fsync_interval`
+seconds have passed since the first unsynced word was added.
+"""
+
+import contextlib
+import fcntl
+import json
+import os
+import threading
+import time
+import zlib
+from typing import Callable, Iterator, Optional
+
+from vocab_store import VocabularyStore
+
+LOG_FILE = "vocab.log"
+SNAPSHOT_FILE = "vocab.snapshot"
+
+
+class VocabularyLog:
+    """Keeps a VocabularyStore in sync with a log file shared by all workers.
+
+    Attributes:
+        store (VocabularyStore): The vocabulary, including every logged word
+    """
+
+    def __init__(
+        self,
+        data_dir: str,
+        default_store: VocabularyStore,
+        fsync_batch: int = 10,
+        fsync_interval: float = 1.0,
+        snapshot_every: int = 1000,
+        on_change: Optional[Callable[[VocabularyStore], None]] = None,
+    ) -> None:
+        """Open (or create) the vocabulary log in `data_dir` and load the vocabulary.
+
+        Args:
+            data_dir: Directory for the log and snapshot files
+            default_store: Vocabulary to start from when there is no snapshot yet
+            fsync_batch: Sync the log to disk after this many unsynced words
+            fsync_interval: ... or when the oldest unsynced word is this many seconds old
+            snapshot_every: Write a new snapshot (and compact the log) after this
+                many words have been logged
+            on_change: Called with the store after this worker adds a word, while
+                the log is still locked (e.g., SharedVocabulary.publish)
+        """
+        os.makedirs(data_dir, exist_ok=True)
+        self.data_dir = data_dir
+        self.log_path = os.path.join(data_dir, LOG_FILE)
+        self.snapshot_path = os.path.join(data_dir, SNAPSHOT_FILE)
+        self.fsync_batch = fsync_batch
+        self.fsync_interval = fsync_interval
+        self.snapshot_every = snapshot_every
+        self.on_change = on_change
+
+        # The log is opened before the snapshot is read: if another worker
+        # compacts the log in between, this is the old log, which the new
+        # snapshot already contains, so replaying it again adds nothing
+        self._log_fd = self._open_log()
+        self._pid = os.getpid()
+        if os.path.exists(self.snapshot_path):
+            self.store = VocabularyStore.load(self.snapshot_path)
+        else:
+            self.store = default_store
+        self._unsynced = 0
+        self._first_unsynced_at = 0.0
+        self._sync_timer: Optional[threading.Timer] = None
+        self._words_since_snapshot = 0
+        # flock() does not keep threads of the same process apart, this does
+        self._lock = threading.RLock()
+        self._lock_depth = 0
+        self.refresh()
+
+    def refresh(self) -> None:
+        """Apply the words other workers have logged since this one last looked.
+
+        Only the part of the log file that is new is read. The app does this
+        before each word it adds, not for every request.
+        """
+        with self._locked():
+            self._sync_if_due(time.monotonic())
+
+            size = os.fstat(self._log_fd).st_size
+            if size <= self.store.log_offset:
+                return
+            new_data = os.pread(self._log_fd, size - self.store.log_offset, self.store.log_offset)
+            # Leave an unfinished last line for the next refresh
+            complete = new_data.rfind(b"\n") + 1
+            for line in new_data[:complete].splitlines():
+                record = _parse_record(line)
+                if record is not None and 1 <= record[0] <= len(self.store.columns):
+                    self.store.add_word(*record)
+                    self._words_since_snapshot += 1
+            self.store.log_offset += complete
+
+    def add_word(self, column: int, word: str) -> bool:
+        """Add a word to a column and append it to the log.
+
+        Args:
+            column: Column number, starting at 1
+            word: The word to add
+
+        Returns:
+            True if the word was added, False if the column already had it
+        """
+        with self._locked():
+            # Catch up first, so a word another worker just added counts as a duplicate
+            self.refresh()
+            self._repair_torn_line()
+            if word in self.store.columns[column - 1]:
+                return False
+            os.write(self._log_fd, _format_record(column, word))
+            self.store.add_word(column, word)
+            self.store.log_offset = os.fstat(self._log_fd).st_size
+            self._words_since_snapshot += 1
+            if self._unsynced == 0:
+                self._first_unsynced_at = time.monotonic()
+                self._start_sync_timer()
+            self._unsynced += 1
+            self._sync_if_due(time.monotonic())
+            if self._words_since_snapshot >= self.snapshot_every:
+                self.snapshot()
+            if self.on_change is not None:
+                self.on_change(self.store)
+        return True
+
+    def publish(self) -> None:
+        """Catch up with the log and pass the whole vocabulary to `on_change`."""
+        with self._locked():
+            self.refresh()
+            if self.on_change is not None:
+                self.on_change(self.store)
+
+    def snapshot(self) -> None:
+        """Write the whole vocabulary to the snapshot file and compact the log.
+
+        The snapshot is on disk before the log is replaced by an empty one:
+        after a crash in between, the old log is replayed over the snapshot,
+        which only finds words the snapshot already has.
+        """
+        with self._locked():
+            self.refresh()
+            self.sync()
+            self.store.log_offset = 0
+            self.store.save(self.snapshot_path)
+            _fsync_directory(self.data_dir)
+
+            temporary = f"{self.log_path}.tmp"
+            fd = os.open(temporary, os.O_RDWR | os.O_APPEND | os.O_CREAT | os.O_TRUNC, 0o644)
+            # Nobody else can have the new log yet: lock it before it replaces the old one
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            os.replace(temporary, self.log_path)
+            _fsync_directory(self.data_dir)
+            # Closing the old log unlocks it: workers waiting for it see that it was
+            # replaced, and wait for the new one (see _locked())
+            os.close(self._log_fd)
+            self._log_fd = fd
+            self._words_since_snapshot = 0
+
+    def sync(self) -> None:
+        """Force all logged words to disk."""
+        if self._unsynced:
+            os.fsync(self._log_fd)
+            self._unsynced = 0
+
+    def close(self) -> None:
+        """Sync the log and close it."""
+        with self._lock:
+            if self._sync_timer is not None:
+                self._sync_timer.cancel()
+            self.sync()
+            os.close(self._log_fd)
+
+    @contextlib.contextmanager
+    def _locked(self) -> Iterator[None]:
+        # Hold the log's flock (once, however deeply nested) while inside the block
+        with self._lock:
+            if self._lock_depth == 0:
+                self._lock_current_log()
+            self._lock_depth += 1
+            try:
+                yield
+            finally:
+                self._lock_depth -= 1
+                if self._lock_depth == 0:
+                    fcntl.flock(self._log_fd, fcntl.LOCK_UN)
+
+    def _open_log(self) -> int:
+        return os.open(self.log_path, os.O_RDWR | os.O_APPEND | os.O_CREAT, 0o644)
+
+    def _lock_current_log(self) -> None:
+        if self._pid != os.getpid():
+            # A worker forked from us shares our open log, and so its flock: it
+            # needs its own
+            os.close(self._log_fd)
+            self._log_fd = self._open_log()
+            self._pid = os.getpid()
+        # Another worker may have compacted the log while we waited for the
+        # lock: then the file we hold is no longer the log, and the snapshot
+        # has everything it held
+        while True:
+            fcntl.flock(self._log_fd, fcntl.LOCK_EX)
+            if os.path.samestat(os.fstat(self._log_fd), os.stat(self.log_path)):
+                return
+            self.sync()
+            os.close(self._log_fd)
+            self._log_fd = self._open_log()
+            self.store = VocabularyStore.load(self.snapshot_path)
+            self._words_since_snapshot = 0
+
+    def _start_sync_timer(self) -> None:
+        # Make sure words are synced within fsync_interval even if no more words come
+        def timed_sync() -> None:
+            with self._lock:
+                self.sync()
+
+        self._sync_timer = threading.Timer(self.fsync_interval, timed_sync)
+        self._sync_timer.daemon = True
+        self._sync_timer.start()
+
+    def _sync_if_due(self, now: float) -> None:
+        if self._unsynced >= self.fsync_batch or (
+            self._unsynced and now - self._first_unsynced_at >= self.fsync_interval
+        ):
+            self.sync()
+
+    def _repair_torn_line(self) -> None:
+        # A crash in the middle of a write can leave a line without its "\n".
+        # End it, so that our record starts on a line of its own; the torn
+        # line itself fails its checksum and is skipped.
+        size = os.fstat(self._log_fd).st_size
+        if size > self.store.log_offset:
+            os.write(self._log_fd, b"\n")
+            self.store.log_offset = size + 1
+
+
+class FileLock:
+    """Context manager holding an exclusive lock on a file while inside the block."""
+
+    def __init__(self, fd: int) -> None:
+        self.fd = fd
+
+    def __enter__(self) -> None:
+        fcntl.flock(self.fd, fcntl.LOCK_EX)
+
+    def __exit__(self, *exc_info) -> None:
+        fcntl.flock(self.fd, fcntl.LOCK_UN)
+
+
+def _fsync_directory(path: str) -> None:
+    # Make a file replaced in the directory stay replaced after a crash
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _format_record(column: int, word: str) -> bytes:
+    payload = f"{column}\t{json.dumps(word)}".encode("utf-8")
+    return payload + b"\t%08x\n" % zlib.crc32(payload)
+
+
+def _parse_record(line: bytes) -> Optional[tuple]:
+    payload, _, checksum = line.rpartition(b"\t")
+    try:
+        if int(checksum, 16) != zlib.crc32(payload):
+            return None
+        column, word = payload.decode("utf-8").split("\t", 1)
+        return int(column), json.loads(word)
+    except ValueError:
+        return None
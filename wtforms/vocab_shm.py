@@ -0,0 +1,145 @@
+"""Vocabulary shared between worker processes through a memory-mapped file.
+
+When the app runs under several worker processes, every worker maps the same
+file into memory. The file holds the packed vocabulary (see vocab_store.py)
+behind a small header:
+
+    sequence number (64 bit), length of the packed vocabulary (64 bit)
+
+The sequence number works like a seqlock: a writer makes it odd before it
+starts changing the data and even again when it is done. (It sets the parity
+rather than adding 1, and each process repairs an odd number it finds when it
+opens the file, so a writer that died halfway cannot leave it flipped.) Readers never take a
+lock. On the hot path (every generate_insult() call) a reader only reads the
+8-byte sequence number; if it is the same as last time, the vocabulary it
+already has is still current. Only when the number has changed does the reader
+copy the new packed vocabulary out of the file, and it checks that the
+sequence number is still the same afterwards, so it never uses data that was
+changed while being copied.
+
+Writers (workers adding a word) take an exclusive lock on the file, so there
+is only one writer at a time. Each process opens the file itself, on first
+use, so that workers forked from a preloaded app do not share one lock. The
+app publishes while it holds the lock of the vocabulary log (see vocab_log.py),
+after catching up with it, so the last vocabulary published is always the
+current one, even when it is older than the one it replaces (e.g., after
+vocab_data/ was deleted).
+"""
+
+import mmap
+import os
+import struct
+import threading
+from typing import Optional
+
+from vocab_log import FileLock
+from vocab_store import VocabularyStore
+
+SEGMENT_HEADER = struct.Struct("=QQ")
+SEQUENCE = struct.Struct("=Q")
+
+
+class SharedVocabulary:
+    """A vocabulary published in a memory-mapped file for all workers to read."""
+
+    def __init__(self, path: str, fallback: VocabularyStore) -> None:
+        """Prepare to map the shared vocabulary file (it is opened on first use).
+
+        Args:
+            path: Path of the shared file (e.g., in the vocabulary data directory)
+            fallback: Vocabulary to use until one has been published
+        """
+        self.path = path
+        # Process that opened the file: a forked worker opens it again
+        self._pid: Optional[int] = None
+        self._fd = -1
+        self._map: Optional[mmap.mmap] = None
+        self._open_lock = threading.Lock()
+        self._sequence = -1
+        self._store = fallback
+
+    def current(self) -> VocabularyStore:
+        """Return the latest published vocabulary, without taking any lock."""
+        if self._pid != os.getpid():
+            self._open()
+        sequence = SEQUENCE.unpack_from(self._map, 0)[0]
+        if sequence == self._sequence:
+            return self._store
+        return self._reload(sequence)
+
+    def publish(self, store: VocabularyStore) -> None:
+        """Make `store` the shared vocabulary."""
+        if self._pid != os.getpid():
+            self._open()
+        data = store.to_bytes()
+        with FileLock(self._fd):
+            # Odd sequence number: readers know the data is being changed
+            sequence = SEQUENCE.unpack_from(self._map, 0)[0] | 1
+            end = SEGMENT_HEADER.size + len(data)
+            if os.fstat(self._fd).st_size < end:
+                os.ftruncate(self._fd, end)
+            self._remap(end)
+            SEQUENCE.pack_into(self._map, 0, sequence)
+            self._map[SEGMENT_HEADER.size:end] = data
+            SEGMENT_HEADER.pack_into(self._map, 0, sequence + 1, len(data))
+
+    def close(self) -> None:
+        """Unmap and close the shared file (if this process opened it)."""
+        if self._pid == os.getpid():
+            self._map.close()
+            os.close(self._fd)
+        self._pid = None
+
+    def _open(self) -> None:
+        """Open and map the shared file in this process, creating it if needed.
+
+        An odd sequence number found here was left by a writer that died while
+        publishing (a live writer would hold the lock): its data may be torn,
+        so it is dropped, and readers keep their vocabulary until the next
+        publish().
+        """
+        with self._open_lock:
+            if self._pid == os.getpid():
+                return  # Another thread was first
+            fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+            with FileLock(fd):
+                if os.fstat(fd).st_size < SEGMENT_HEADER.size:
+                    os.ftruncate(fd, SEGMENT_HEADER.size)
+                segment = mmap.mmap(fd, 0)
+                sequence = SEQUENCE.unpack_from(segment, 0)[0]
+                if sequence % 2:
+                    SEGMENT_HEADER.pack_into(segment, 0, sequence + 1, 0)
+            # The parent's file and map (if forked) are left to the parent
+            self._fd, self._map, self._sequence = fd, segment, -1
+            self._pid = os.getpid()
+
+    def _reload(self, sequence: int) -> VocabularyStore:
+        if sequence % 2:
+            # A writer is busy; keep using the previous vocabulary for now
+            return self._store
+        length = SEGMENT_HEADER.unpack_from(self._map, 0)[1]
+        if not self._remap(SEGMENT_HEADER.size + length):
+            return self._store
+        data = self._map[SEGMENT_HEADER.size:SEGMENT_HEADER.size + length]
+        if SEQUENCE.unpack_from(self._map, 0)[0] != sequence:
+            # Changed while we were copying it; try again on the next call
+            return self._store
+        if length:
+            self._store = VocabularyStore.from_buffer(data)
+        self._sequence = sequence
+        return self._store
+
+    def _remap(self, size: int) -> bool:
+        """Make sure at least `size` bytes of the file are mapped.
+
+        Returns:
+            False if the file is smaller than `size` (a writer is growing it)
+        """
+        if len(self._map) >= size:
+            return True
+        if os.fstat(self._fd).st_size < size:
+            return False
+        # Other threads may still be reading the old map, so it is not closed
+        # here; it goes away once nobody uses it any more
+        self._map = mmap.mmap(self._fd, 0)
+        return True
@@ -0,0 +1,258 @@
+"""Vocabulary storage for the Shakespearean insult generator.
+
+This module replaces the plain word lists of vocab.py with a VocabularyStore:
+three columns of interned, de-duplicated words with O(1) membership tests and
+a version number that goes up every time a word is added.
+
+A store can also be saved in a packed binary form: for each column, one
+contiguous UTF-8 blob holding all the words plus an array of offsets telling
+where each word starts. Loading a packed file maps it into memory (mmap)
+instead of building a Python string for every word, so even columns with
+hundreds of thousands of words load instantly; words are decoded only when
+they are used.
+
+Packed file layout (all integers are unsigned 32-bit in native byte order,
+except the 64-bit store version and log offset):
+
+    header:  magic "VOCB", format version, store version (64 bit),
+             log offset (64 bit), column count
+    columns: for each column, its word count and blob size in bytes
+    offsets: for each column, word count + 1 offsets into its blob
+    blobs:   for each column, the UTF-8 bytes of all its words, back to back
+
+Pack the words of vocab.py with `python vocab_store.py vocab.packed`.
+"""
+
+import mmap
+import os
+import struct
+import sys
+from array import array
+from typing import Dict, Iterable, Iterator, List, Optional, Sequence
+
+MAGIC = b"VOCB"
+FORMAT_VERSION = 2
+HEADER = struct.Struct("=4sIQQI")
+COLUMN_HEADER = struct.Struct("=II")
+
+
+class VocabularyColumn(Sequence[str]):
+    """One column of words, in the order they were added, without duplicates.
+
+    The first words of a column may come from a packed blob (see
+    VocabularyStore.load()); they are decoded from it when accessed. Words
+    added later are kept in a regular list.
+    """
+
+    def __init__(
+        self,
+        words: Iterable[str] = (),
+        blob: Optional[memoryview] = None,
+        offsets: Optional[memoryview] = None,
+    ) -> None:
+        """Create a column from packed data and/or a list of words.
+
+        Args:
+            words: Words to add to the column (duplicates are skipped)
+            blob: UTF-8 bytes of the packed words, if any
+            offsets: Start offset of each packed word in `blob`, plus the end offset
+        """
+        self._blob = blob
+        self._offsets = offsets
+        self._packed_count = len(offsets) - 1 if offsets is not None else 0
+        self._words: List[str] = []
+        # word -> position, built on first use so that loading stays cheap
+        self._index: Optional[Dict[str, int]] = None
+        for word in words:
+            self.add(word)
+
+    def __len__(self) -> int:
+        return self._packed_count + len(self._words)
+
+    def __getitem__(self, i):  # type: ignore[override]
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        if 0 <= i < self._packed_count:
+            start, end = self._offsets[i], self._offsets[i + 1]
+            return sys.intern(str(self._blob[start:end], "utf-8"))
+        return self._words[i - self._packed_count]
+
+    def __iter__(self) -> Iterator[str]:
+        for i in range(self._packed_count):
+            yield self[i]
+        yield from self._words
+
+    def __contains__(self, word: object) -> bool:
+        return word in self.index
+
+    @property
+    def index(self) -> Dict[str, int]:
+        """Dictionary mapping each word to its position in the column."""
+        if self._index is None:
+            self._index = {word: i for i, word in enumerate(self)}
+        return self._index
+
+    def add(self, word: str) -> bool:
+        """Append a word to the column unless it is already there.
+
+        Args:
+            word: The word to add
+
+        Returns:
+            True if the word was added, False if it was already in the column
+        """
+        if word in self:
+            return False
+        word = sys.intern(word)
+        self.index[word] = len(self)
+        self._words.append(word)
+        return True
+
+
+class VocabularyStore:
+    """The three word columns insults are built from.
+
+    Attributes:
+        columns (list): The VocabularyColumn objects, column 1 first
+        version (int): Number that increases every time a word is added
+        log_offset (int): How much of the word log (see vocab_log.py) is
+            already included in the store
+    """
+
+    def __init__(
+        self, columns: Sequence[Iterable[str]] = (), version: int = 0, log_offset: int = 0
+    ) -> None:
+        """Create a store from lists of words.
+
+        Args:
+            columns: One iterable of words per column
+            version: Initial version number
+            log_offset: Initial word log offset
+        """
+        self.columns = [VocabularyColumn(words) for words in columns]
+        self.version = version
+        self.log_offset = log_offset
+        self._mmap: Optional[mmap.mmap] = None
+
+    # Attribute access used by the templates and generate_insult()
+    @property
+    def column1(self) -> VocabularyColumn:
+        return self.columns[0]
+
+    @property
+    def column2(self) -> VocabularyColumn:
+        return self.columns[1]
+
+    @property
+    def column3(self) -> VocabularyColumn:
+        return self.columns[2]
+
+    def add_word(self, column: int, word: str) -> bool:
+        """Add a word to a column.
+
+        Args:
+            column: Column number, starting at 1
+            word: The word to add
+
+        Returns:
+            True if the word was added, False if the column already had it
+        """
+        if not self.columns[column - 1].add(word):
+            return False
+        self.version += 1
+        return True
+
+    def to_bytes(self) -> bytes:
+        """Return the packed binary form of the store (see the module docstring)."""
+        blobs = []
+        offsets = []
+        for column in self.columns:
+            encoded = [word.encode("utf-8") for word in column]
+            column_offsets = array("I", [0])
+            for word in encoded:
+                column_offsets.append(column_offsets[-1] + len(word))
+            blobs.append(b"".join(encoded))
+            offsets.append(column_offsets)
+        parts = [
+            HEADER.pack(MAGIC, FORMAT_VERSION, self.version, self.log_offset, len(self.columns))
+        ]
+        parts += [COLUMN_HEADER.pack(len(o) - 1, len(b)) for o, b in zip(offsets, blobs)]
+        parts += [o.tobytes() for o in offsets]
+        parts += blobs
+        return b"".join(parts)
+
+    @classmethod
+    def from_buffer(cls, buffer) -> "VocabularyStore":
+        """Create a store that reads its words straight out of packed data.
+
+        Args:
+            buffer: Packed store (bytes, mmap, ...); it must stay alive as long as the store
+
+        Returns:
+            The new store
+
+        Raises:
+            ValueError: If the buffer does not hold a packed vocabulary
+        """
+        data = memoryview(buffer)
+        if len(data) < HEADER.size:
+            raise ValueError("Not a packed vocabulary: file too short")
+        magic, format_version, version, log_offset, column_count = HEADER.unpack_from(data)
+        if magic != MAGIC or format_version != FORMAT_VERSION:
+            raise ValueError("Not a packed vocabulary: bad header")
+
+        position = HEADER.size
+        sizes = []
+        for _ in range(column_count):
+            sizes.append(COLUMN_HEADER.unpack_from(data, position))
+            position += COLUMN_HEADER.size
+        offsets = []
+        for word_count, _ in sizes:
+            end = position + 4 * (word_count + 1)
+            offsets.append(data[position:end].cast("I"))
+            position = end
+        store = cls(version=version, log_offset=log_offset)
+        for (_, blob_size), column_offsets in zip(sizes, offsets):
+            blob = data[position:position + blob_size]
+            position += blob_size
+            store.columns.append(VocabularyColumn(blob=blob, offsets=column_offsets))
+        return store
+
+    def save(self, path: str) -> None:
+        """Write the packed store to a file.
+
+        The data is written to a temporary file that then replaces `path`, so
+        a crash in the middle leaves the previous file intact.
+        """
+        temporary = f"{path}.tmp"
+        with open(temporary, "wb") as f:
+            f.write(self.to_bytes())
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temporary, path)
+
+    @classmethod
+    def load(cls, path: str) -> "VocabularyStore":
+        """Map a packed store file into memory and return a store reading from it.
+
+        Args:
+            path: Path of a file written by save()
+
+        Returns:
+            The loaded store
+        """
+        with open(path, "rb") as f:
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        store = cls.from_buffer(mapped)
+        store._mmap = mapped
+        return store
+
+
+if __name__ == "__main__":
+    import vocab
+
+    if len(sys.argv) != 2:
+        sys.exit(f"Usage: python {sys.argv[0]} OUTPUT_FILE")
+    VocabularyStore([vocab.column1, vocab.column2, vocab.column3]).save(sys.argv[1])